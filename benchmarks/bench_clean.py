@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Measure how the cleaning routine scales with the size of the library and the speed of the storage it is on.
+
+For every library size, a synthetic library of watched movies and episodes is generated, including stacked movies and
+several related files per video. The main steps of a cleaning run are then timed one after another, reporting the wall
+time, the time the file system calls would have taken on the chosen storage, the peak memory use and the number of
+calls into Kodi of each step.
+
+Run from the addon folder with a Python 2 interpreter:
+  ``python benchmarks/bench_clean.py --sizes 10000,100000,500000 --latency smb``
+"""
+
+import argparse
+import resource
+import sys
+import time
+
+import fakes
+
+ADDON_MODULES = ["default", "settings", "utils", "vfs", "planner", "executor", "exclusions", "diskspace", "copier",
+                 "watermarks", "journal", "metrics", "intents", "control", "governor", "pruner"]
+RELATED = (".nfo", ".srt", "-poster.jpg", "-fanart.jpg")
+
+
+def peak_memory():
+    """The peak resident memory of this process so far, in megabytes."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024.0 / (1024.0 if sys.platform == "darwin" else 1.0)
+
+
+class Measurement(object):
+    """
+    Times a single step of a cleaning run and records the calls it made into the fake Kodi modules.
+
+    *Example*
+      ``with Measurement(kodi, "clean", 1000) as m: cleaner.clean(cleaner.MOVIES)``
+    """
+
+    def __init__(self, kodi, name, items):
+        self.kodi = kodi
+        self.name = name
+        self.items = items
+        self.calls = None
+        self.seconds = 0.0
+        self.simulated = 0.0
+        self.memory = 0.0
+
+    def __enter__(self):
+        self.before = self.kodi.calls.copy()
+        self.simulated_before = self.kodi.vfs.simulated
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.time() - self.started
+        self.simulated = self.kodi.vfs.simulated - self.simulated_before
+        self.memory = peak_memory()
+        self.calls = self.kodi.calls.copy()
+        self.calls.subtract(self.before)
+        self.calls = dict((name, count) for name, count in self.calls.items() if count > 0)
+        return False
+
+    def row(self):
+        calls = ", ".join("%s=%d" % (name.split(".", 1)[-1], count) for name, count in sorted(self.calls.items()))
+        return "%-26s %8d %9.2f %9.2f %9.1f  %s" % (self.name, self.items, self.seconds, self.simulated, self.memory,
+                                                   calls)
+
+
+def run(size, latency, sleep, stacked, move):
+    """
+    Measure the steps of a cleaning run on a library of the given size.
+
+    :type size: int
+    :param size: The total number of videos, split evenly into movies and episodes.
+    :rtype: list
+    :return: The measurement of every step.
+    """
+    for name in ADDON_MODULES:
+        sys.modules.pop(name, None)
+
+    holding = "/hold"
+    kodi = fakes.install({"clean_movies": "true", "clean_tv_shows": "true", "cleaning_type": "0" if move else "1",
+                          "holding_folder": holding, "clean_related": "true", "delete_folders": "true",
+                          "exclusion_enabled": "true", "exclusion1": "/media/TV/Show 1/",
+                          "exclusion2": "/media/Movies/Movie 2 (2000)/", "query_page_size": "1000"},
+                         latency=latency, sleep=sleep)
+    fakes.populate(kodi, movies=size // 2, episodes=size - size // 2, stacked=stacked, related=RELATED)
+    kodi.library.sources = ["/media/"]
+
+    import default
+    import utils
+
+    cleaner = default.Cleaner()
+    cleaner.prepare()
+    measurements = []
+
+    for video_type in (cleaner.MOVIES, cleaner.TVSHOWS):
+        with Measurement(kodi, "get_expired_videos:%s" % video_type[:5], 0) as m:
+            videos = list(cleaner.get_expired_videos(video_type))
+        m.items = len(videos)
+        measurements.append(m)
+
+    paths = [path for video in kodi.library.videos["movies"] + kodi.library.videos["episodes"]
+             for path in cleaner.unstack(video["file"])]
+    with Measurement(kodi, "is_excluded", len(paths)) as m:
+        excluded = sum(1 for path in paths if cleaner.is_excluded(path))
+    measurements.append(m)
+
+    # Clean the related files of a sample of movies on their own, the rest are cleaned along with their videos
+    sample = [video["file"] for video in kodi.library.videos["movies"][:min(1000, size // 10)]]
+    destination = cleaner.get_destination("related") if move else None
+    if destination is not None:
+        cleaner.fs.mkdirs(destination)
+    with Measurement(kodi, "clean_related_files", len(sample)) as m:
+        for filename in sample:
+            cleaner.clean_related_files(filename, destination)
+    measurements.append(m)
+
+    cleaned = []
+    for video_type in (cleaner.MOVIES, cleaner.TVSHOWS):
+        with Measurement(kodi, "clean:%s" % video_type[:5], 0) as m:
+            files, m.items = cleaner.clean(video_type)
+        cleaned.extend(files)
+        measurements.append(m)
+
+    with Measurement(kodi, "prune_folders", len(cleaner.touched)) as m:
+        cleaner.prune_folders()
+    measurements.append(m)
+
+    with Measurement(kodi, "Log.prepend", len(cleaned)) as m:
+        utils.Log(cleaner.settings).prepend(cleaned)
+    measurements.append(m)
+
+    print("  %d videos excluded, %d videos cleaned." % (excluded, len(cleaned)))
+    return measurements
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--sizes", default="10000", help="comma separated library sizes, default 10000")
+    parser.add_argument("--latency", default="local", choices=sorted(fakes.LATENCY_PROFILES),
+                        help="latency profile of the storage, default local")
+    parser.add_argument("--sleep", action="store_true", help="actually wait for the latency of every call")
+    parser.add_argument("--stacked", type=int, default=10, help="stack every so many movies, default 10")
+    parser.add_argument("--move", action="store_true", help="move videos to a holding folder instead of deleting")
+    args = parser.parse_args(argv)
+
+    for size in [int(size) for size in args.sizes.split(",")]:
+        print("Library of %d videos on %s storage" % (size, args.latency))
+        measurements = run(size, args.latency, args.sleep, args.stacked, args.move)
+        print("%-26s %8s %9s %9s %9s  %s" % ("step", "items", "seconds", "io (s)", "peak MB", "calls"))
+        for measurement in measurements:
+            print(measurement.row())
+        print("")
+
+
+if __name__ == "__main__":
+    main()
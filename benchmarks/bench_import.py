@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Measure how long it takes to import the entry points of the addon, and check that the service stays lightweight.
+
+Every entry point is imported in a fresh interpreter, a number of times, reporting the median import time and the
+modules it pulled in. When Kodi starts, only the scheduler of the service should be loaded. The cleaning engine, the
+Windows disk code and the user interface are loaded on first use. With ``--check``, the script exits with an error if
+the service imports any of those, or takes longer than the allowed time, so it can be used as a regression test.
+
+Run from the addon folder with a Python 2 interpreter:
+  ``python benchmarks/bench_import.py --runs 20 --check``
+"""
+
+import __builtin__
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import fakes
+
+ENTRY_POINTS = ["service", "default"]
+# Modules the service must not import at startup
+DEFERRED = ["default", "diskspace", "ctypes", "xbmcgui", "copier", "executor", "planner", "vfs", "intents", "metrics"]
+
+
+def measure(module):
+    """
+    Import a module and record every module imported along the way. Only call this in a fresh interpreter.
+
+    :type module: str
+    :param module: The name of the module to import.
+    :rtype: dict
+    :return: The number of seconds the import took, and the names of all modules that were imported.
+    """
+    fakes.install()
+    imported = set()
+    original = __builtin__.__import__
+
+    def recording_import(name, *args, **kwargs):
+        imported.add(name.split(".")[0])
+        return original(name, *args, **kwargs)
+
+    __builtin__.__import__ = recording_import
+    try:
+        started = time.time()
+        __import__(module)
+        seconds = time.time() - started
+    finally:
+        __builtin__.__import__ = original
+    return {"seconds": seconds, "imported": sorted(imported)}
+
+
+def run(module, runs):
+    """
+    Import a module in a number of fresh interpreters.
+
+    :type module: str
+    :param module: The name of the module to import.
+    :type runs: int
+    :param runs: The number of interpreters to start.
+    :rtype: (float, list)
+    :return: The median number of seconds the import took, and the modules it imported.
+    """
+    results = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", module])
+        results.append(json.loads(output.splitlines()[-1]))
+    seconds = sorted(result["seconds"] for result in results)
+    return seconds[len(seconds) // 2], results[0]["imported"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--runs", type=int, default=10, help="number of times to import every entry point, default 10")
+    parser.add_argument("--check", action="store_true", help="fail if the service imports too much or too slowly")
+    parser.add_argument("--max-ms", type=float, default=50.0,
+                        help="the longest the service may take to import when checking, default 50 ms")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(measure(args.child)))
+        return 0
+
+    print("%-10s %10s  %s" % ("module", "median ms", "deferred modules imported"))
+    failures = []
+    for module in ENTRY_POINTS:
+        seconds, imported = run(module, args.runs)
+        deferred = [name for name in DEFERRED if name in imported]
+        print("%-10s %10.2f  %s" % (module, seconds * 1000, ", ".join(deferred) or "-"))
+        if module == "service":
+            if deferred:
+                failures.append("the service imports %s at startup" % ", ".join(deferred))
+            if seconds * 1000 > args.max_ms:
+                failures.append("the service takes %.2f ms to import, more than %.2f ms" % (seconds * 1000,
+                                                                                          args.max_ms))
+
+    if args.check and failures:
+        for failure in failures:
+            print("FAIL: %s" % failure)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Compare the number of addon settings reads during a cleaning run with and without the settings snapshot.
+
+Run from the addon folder with a Python 2 interpreter:
+  ``python benchmarks/bench_settings.py [number of movies] [number of episodes]``
+"""
+
+import sys
+import time
+
+import fakes
+
+
+class LiveSettings(object):
+    """Reads every setting straight from Kodi, the way the addon did before settings snapshots were introduced."""
+
+    def __init__(self, read_setting):
+        self.read_setting = read_setting
+
+    def __getitem__(self, setting):
+        return self.read_setting(setting)
+
+
+def run(snapshot, movies, episodes):
+    kodi = fakes.install({"clean_movies": "true", "clean_tv_shows": "true", "cleaning_type": "1",
+                          "clean_related": "true", "delete_folders": "true", "debugging_enabled": "true"})
+    fakes.populate(kodi, movies=movies, episodes=episodes)
+
+    import default
+    import settings
+    import utils
+
+    # Count the reads of loading the snapshot as well, which is all the reading a run does
+    kodi.calls.clear()
+    start = time.time()
+    settings.reload_settings()
+    if not snapshot:
+        live = LiveSettings(settings.read_setting)
+        for module in (default, settings, utils):
+            module.get_settings = lambda: live
+
+    cleaner = default.Cleaner()
+    cleaner.clean_all()
+    elapsed = time.time() - start
+    return kodi.calls, elapsed
+
+
+def main(movies=1000, episodes=5000):
+    print("Cleaning %d movies and %d episodes" % (movies, episodes))
+    print("%-10s %15s %15s %10s" % ("mode", "Addon()", "getSetting()", "seconds"))
+    for label, snapshot in (("before", False), ("after", True)):
+        for name in ("default", "settings", "utils"):
+            sys.modules.pop(name, None)
+        calls, elapsed = run(snapshot, movies, episodes)
+        print("%-10s %15d %15d %10.2f" % (label, calls["xbmcaddon.Addon"], calls["Addon.getSetting"], elapsed))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
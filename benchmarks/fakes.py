@@ -0,0 +1,465 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+In-process stand-ins for the Kodi modules (``xbmc``, ``xbmcaddon``, ``xbmcgui`` and ``xbmcvfs``).
+
+They allow the addon to be imported and measured outside of Kodi. Every call into a fake module is counted, so
+benchmarks can compare how often the addon talks to Kodi.
+
+*Example*
+  ``kodi = fakes.install()``
+"""
+
+import collections
+import json
+import os
+import sys
+import tempfile
+import time
+import types
+import xml.etree.ElementTree as ElementTree
+
+ADDON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def default_settings():
+    """
+    Read the default value of every setting from the addon's settings.xml.
+
+    :rtype: dict
+    :return: The default value of every setting, keyed by setting id.
+    """
+    defaults = {}
+    tree = ElementTree.parse(os.path.join(ADDON_DIR, "resources", "settings.xml"))
+    for setting in tree.iter("setting"):
+        if setting.get("id"):
+            defaults[setting.get("id")] = setting.get("default", "0" if setting.get("type") == "enum" else "")
+    return defaults
+
+
+# Seconds each call takes on a storage backend, and the number of bytes per second read or written
+LATENCY_PROFILES = {
+    "none": {},
+    "local": {"exists": 0.00002, "stat": 0.00002, "listdir": 0.0001, "delete": 0.0001, "rename": 0.0001,
+              "copy": 0.0002, "mkdirs": 0.0001, "rmdir": 0.0001, "open": 0.00005, "bandwidth": 150 * 1024 ** 2},
+    "nfs": {"exists": 0.0005, "stat": 0.0005, "listdir": 0.002, "delete": 0.001, "rename": 0.001, "copy": 0.002,
+            "mkdirs": 0.001, "rmdir": 0.001, "open": 0.001, "bandwidth": 100 * 1024 ** 2},
+    "smb": {"exists": 0.002, "stat": 0.002, "listdir": 0.005, "delete": 0.003, "rename": 0.003, "copy": 0.005,
+            "mkdirs": 0.003, "rmdir": 0.003, "open": 0.003, "bandwidth": 80 * 1024 ** 2},
+}
+
+
+class FakeVFS(object):
+    """
+    An in-memory file system that mimics the behaviour of ``xbmcvfs``.
+
+    Files are stored as a mapping of path to size in bytes. Directories are created implicitly for every file. The
+    contents of every directory are indexed, so listing a directory does not depend on the size of the file system.
+
+    Every call takes the time set in its latency profile. That time is added up in ``simulated``, and only actually
+    waited for if ``sleep`` is set, which is needed to measure the effect of doing several calls at the same time.
+    """
+
+    def __init__(self, calls, latency="none", sleep=False):
+        self.calls = calls
+        self.files = {}
+        self.dirs = set()
+        self.children = collections.defaultdict(lambda: (set(), set()))
+        self.latency = LATENCY_PROFILES[latency]
+        self.sleep = sleep
+        self.simulated = 0.0
+
+    def wait(self, operation, size=0):
+        seconds = self.latency.get(operation, 0.0)
+        if size and self.latency.get("bandwidth"):
+            seconds += float(size) / self.latency["bandwidth"]
+        if seconds:
+            self.simulated += seconds
+            if self.sleep:
+                time.sleep(seconds)
+
+    def add_file(self, path, size=0):
+        if path not in self.files:
+            self.children[os.path.dirname(path)][1].add(os.path.basename(path))
+        self.files[path] = size
+        self._add_parents(path)
+
+    def _remove_file(self, path):
+        size = self.files.pop(path)
+        self.children[os.path.dirname(path)][1].discard(os.path.basename(path))
+        return size
+
+    def _add_parents(self, path):
+        folder = os.path.dirname(path)
+        while folder and folder not in self.dirs:
+            self.dirs.add(folder)
+            parent = os.path.dirname(folder)
+            if parent == folder:
+                break
+            self.children[parent][0].add(os.path.basename(folder))
+            folder = parent
+
+    def exists(self, path):
+        self.calls["xbmcvfs.exists"] += 1
+        self.wait("exists")
+        return path in self.files or path.rstrip("/") in self.dirs
+
+    def stat(self, path):
+        self.calls["xbmcvfs.Stat"] += 1
+        self.wait("stat")
+        size = self.files.get(path, 0)
+
+        class Stat(object):
+            def st_size(self):
+                return size
+
+        return Stat()
+
+    def delete(self, path):
+        self.calls["xbmcvfs.delete"] += 1
+        self.wait("delete")
+        if path not in self.files:
+            return False
+        self._remove_file(path)
+        return True
+
+    @staticmethod
+    def _host(path):
+        return path.split("/")[2] if "://" in path else ""
+
+    def rename(self, source, destination):
+        self.calls["xbmcvfs.rename"] += 1
+        self.wait("rename")
+        if source not in self.files or os.path.dirname(destination) not in self.dirs:
+            return False
+        if self._host(source) != self._host(destination):
+            return False  # Like Kodi, files cannot be renamed to another server
+        if destination in self.files:
+            self._remove_file(destination)
+        self.add_file(destination, self._remove_file(source))
+        return True
+
+    def copy(self, source, destination):
+        self.calls["xbmcvfs.copy"] += 1
+        if source not in self.files:
+            self.wait("copy")
+            return False
+        self.wait("copy", self.files[source])
+        self.add_file(destination, self.files[source])
+        return True
+
+    def mkdirs(self, path):
+        self.calls["xbmcvfs.mkdirs"] += 1
+        self.wait("mkdirs")
+        self._add_parents(path.rstrip("/") + "/")
+        return True
+
+    def rmdir(self, path):
+        self.calls["xbmcvfs.rmdir"] += 1
+        self.wait("rmdir")
+        path = path.rstrip("/")
+        if path not in self.dirs or self.children[path][1]:
+            return False
+        self.dirs.discard(path)
+        self.children.pop(path, None)
+        self.children[os.path.dirname(path)][0].discard(os.path.basename(path))
+        return True
+
+    def listdir(self, path):
+        self.calls["xbmcvfs.listdir"] += 1
+        self.wait("listdir")
+        path = path.rstrip("/")
+        if path not in self.dirs:
+            return [], []
+        subdirs, files = self.children[path]
+        return list(subdirs), list(files)
+
+    def open(self, path, mode="r"):
+        vfs = self
+        vfs.wait("open")
+
+        if "w" in mode:
+            self.add_file(path, 0)
+
+        class File(object):
+            position = 0
+
+            def size(self):
+                vfs.calls["xbmcvfs.File.size"] += 1
+                return vfs.files.get(path, 0)
+
+            def seek(self, offset, whence=0):
+                self.position = offset
+
+            def read(self, count):
+                vfs.calls["xbmcvfs.File.read"] += 1
+                count = max(0, min(count, vfs.files.get(path, 0) - self.position))
+                vfs.wait("read", count)
+                self.position += count
+                return "\0" * count
+
+            def write(self, data):
+                vfs.calls["xbmcvfs.File.write"] += 1
+                vfs.wait("write", len(data))
+                vfs.files[path] = vfs.files.get(path, 0) + len(data)
+                return True
+
+            def close(self):
+                pass
+
+        return File()
+
+
+class FakeLibrary(object):
+    """
+    A fake Kodi video library that answers the JSON-RPC requests issued by the addon.
+
+    Filters on play count, file name and the date a video was last played are evaluated; any other filter condition is
+    considered to be met. The videos matching a filter are remembered until a video is added, so paging through a
+    large library does not evaluate the filter again for every page.
+    """
+    result_keys = {
+        "VideoLibrary.GetMovies": "movies",
+        "VideoLibrary.GetEpisodes": "episodes",
+        "VideoLibrary.GetMusicVideos": "musicvideos"
+    }
+    details = {
+        "VideoLibrary.GetMovieDetails": ("movies", "movieid", "moviedetails"),
+        "VideoLibrary.GetEpisodeDetails": ("episodes", "episodeid", "episodedetails"),
+        "VideoLibrary.GetMusicVideoDetails": ("musicvideos", "musicvideoid", "musicvideodetails")
+    }
+
+    def __init__(self, calls):
+        self.calls = calls
+        self.videos = {"movies": [], "episodes": [], "musicvideos": []}
+        self.by_id = {"movies": {}, "episodes": {}, "musicvideos": {}}
+        self.matched = {}
+        self.sources = []
+
+    def add(self, video_type, **details):
+        details.setdefault("id", len(self.videos[video_type]) + 1)
+        self.videos[video_type].append(details)
+        self.by_id[video_type][details["id"]] = details
+        self.matched.clear()
+
+    def matches(self, video, rule):
+        if "and" in rule:
+            return all(self.matches(video, r) for r in rule["and"])
+        if "or" in rule:
+            return any(self.matches(video, r) for r in rule["or"])
+        if rule["field"] == "playcount" and rule["operator"] == "greaterthan":
+            return video.get("playcount", 0) > int(rule["value"])
+        if rule["field"] == "filename" and rule["operator"] == "is":
+            filename = video.get("file", "")
+            return rule["value"] in (filename, os.path.basename(filename))
+        if rule["field"] == "lastplayed" and rule["operator"] == "after":
+            return video.get("lastplayed", "") > rule["value"]
+        return True
+
+    def execute(self, request):
+        self.calls["xbmc.executeJSONRPC"] += 1
+        request = json.loads(request)
+        if isinstance(request, list):
+            self.calls["JSONRPC batch requests"] += len(request)
+            return "[%s]" % ",".join(self.respond(item) for item in request)
+        return self.respond(request)
+
+    def respond(self, request):
+        method, params = request["method"], request["params"]
+
+        if method == "Files.GetSources":
+            sources = [{"file": source, "label": os.path.basename(source.rstrip("/"))} for source in self.sources]
+            return json.dumps({"id": request.get("id"), "jsonrpc": "2.0", "result": {"sources": sources}})
+
+        if method in self.details:
+            key, id_field, result_field = self.details[method]
+            video = self.by_id[key].get(params[id_field])
+            if video is not None:
+                result = {result_field: dict((p, video.get(p, "")) for p in params.get("properties", []))}
+                return json.dumps({"id": request.get("id"), "jsonrpc": "2.0", "result": result})
+            return json.dumps({"id": request.get("id"), "jsonrpc": "2.0",
+                               "error": {"code": -32602, "message": "Invalid params."}})
+
+        key = self.result_keys[method]
+        properties = params.get("properties", [])
+        rule = params.get("filter", {"and": []})
+        cache_key = key, json.dumps(rule, sort_keys=True)
+        if cache_key not in self.matched:
+            self.matched[cache_key] = [v for v in self.videos[key] if self.matches(v, rule)]
+        watched = self.matched[cache_key]
+        limits = params.get("limits", {})
+        start, end = limits.get("start", 0), limits.get("end", len(watched))
+        items = [dict((p, v.get(p, "")) for p in properties) for v in watched[start:end]]
+        result = {"limits": {"start": start, "end": start + len(items), "total": len(watched)}}
+        if items:
+            result[key] = items
+        return json.dumps({"id": request.get("id"), "jsonrpc": "2.0", "result": result})
+
+
+class FakeKodi(object):
+    """
+    Holds the state behind the fake Kodi modules: the settings, the file system, the library and the call counters.
+    """
+
+    def __init__(self, settings=None, latency="none", sleep=False):
+        self.calls = collections.Counter()
+        self.settings = default_settings()
+        self.settings.update(settings or {})
+        self.vfs = FakeVFS(self.calls, latency, sleep)
+        self.library = FakeLibrary(self.calls)
+        self.playing = False
+        self.aborting = False
+        self.log_lines = []
+        self.profile = tempfile.mkdtemp(prefix="filecleaner-")
+
+    def modules(self):
+        """
+        Build the fake ``xbmc``, ``xbmcaddon``, ``xbmcgui`` and ``xbmcvfs`` modules.
+
+        :rtype: dict
+        :return: The fake modules, keyed by module name.
+        """
+        kodi = self
+
+        xbmc = types.ModuleType("xbmc")
+        for i, level in enumerate(["LOGDEBUG", "LOGINFO", "LOGNOTICE", "LOGWARNING", "LOGERROR", "LOGSEVERE",
+                                   "LOGFATAL", "LOGNONE"]):
+            setattr(xbmc, level, i)
+
+        def log(msg, level=xbmc.LOGNOTICE):
+            kodi.calls["xbmc.log"] += 1
+            kodi.log_lines.append(msg)
+
+        class Player(object):
+            def isPlaying(self):
+                return kodi.playing
+
+        class Monitor(object):
+            def abortRequested(self):
+                return kodi.aborting
+
+            def waitForAbort(self, timeout=None):
+                return kodi.aborting
+
+        xbmc.log = log
+        xbmc.Player = Player
+        xbmc.Monitor = Monitor
+        xbmc.translatePath = lambda path: path
+        xbmc.makeLegalFilename = lambda path: path
+        xbmc.executeJSONRPC = kodi.library.execute
+        xbmc.executebuiltin = lambda command: None
+        xbmc.executescript = lambda script: None
+        xbmc.getCondVisibility = lambda condition: False
+        xbmc.sleep = lambda milliseconds: None
+
+        xbmcaddon = types.ModuleType("xbmcaddon")
+
+        class Addon(object):
+            def __init__(self, addon_id=None):
+                kodi.calls["xbmcaddon.Addon"] += 1
+
+            def getSetting(self, setting):
+                kodi.calls["Addon.getSetting"] += 1
+                return unicode(kodi.settings.get(setting, ""))
+
+            def setSetting(self, id, value):
+                kodi.settings[id] = value
+
+            def getAddonInfo(self, info):
+                return {"name": "Kodi File Cleaner", "version": "4.1.0", "icon": os.path.join(ADDON_DIR, "icon.png"),
+                        "path": ADDON_DIR, "profile": kodi.profile}.get(info, "")
+
+            def getLocalizedString(self, msg_id):
+                return u"#%d" % msg_id
+
+        xbmcaddon.Addon = Addon
+
+        xbmcgui = types.ModuleType("xbmcgui")
+
+        class Dialog(object):
+            def yesno(self, *args, **kwargs):
+                return False
+
+            def ok(self, *args, **kwargs):
+                return True
+
+            def notification(self, *args, **kwargs):
+                pass
+
+        class WindowXMLDialog(object):
+            def __init__(self, *args, **kwargs):
+                pass
+
+        xbmcgui.Dialog = Dialog
+        xbmcgui.WindowXMLDialog = WindowXMLDialog
+
+        xbmcvfs = types.ModuleType("xbmcvfs")
+        for name in ["exists", "delete", "rename", "copy", "mkdirs", "rmdir", "listdir"]:
+            setattr(xbmcvfs, name, getattr(kodi.vfs, name))
+        xbmcvfs.File = kodi.vfs.open
+        xbmcvfs.Stat = kodi.vfs.stat
+
+        return {"xbmc": xbmc, "xbmcaddon": xbmcaddon, "xbmcgui": xbmcgui, "xbmcvfs": xbmcvfs}
+
+
+def install(settings=None, latency="none", sleep=False):
+    """
+    Register the fake Kodi modules so that the addon's modules can be imported.
+
+    :type settings: dict
+    :param settings: (Optional) Setting values that override the defaults from settings.xml.
+    :type latency: str
+    :param latency: (Optional) The latency profile of the file system, one of the keys of ``LATENCY_PROFILES``.
+    :type sleep: bool
+    :param sleep: (Optional) Whether file system calls actually wait for their latency. Defaults to only adding it up.
+    :rtype: FakeKodi
+    :return: The state behind the fake modules, used to populate the library and inspect call counts.
+    """
+    kodi = FakeKodi(settings, latency, sleep)
+    sys.modules.update(kodi.modules())
+    if ADDON_DIR not in sys.path:
+        sys.path.insert(0, ADDON_DIR)
+    return kodi
+
+
+def populate(kodi, movies=0, episodes=0, root="/media", stacked=0, related=(".nfo",)):
+    """
+    Fill the fake library and file system with watched movies and episodes, each with its related files next to it.
+
+    :type kodi: FakeKodi
+    :param kodi: The fake Kodi to populate.
+    :type movies: int
+    :param movies: The number of movies to generate.
+    :type episodes: int
+    :param episodes: The number of episodes to generate, spread over shows of 20 episodes each.
+    :type root: str
+    :param root: The folder under which the videos are stored.
+    :type stacked: int
+    :param stacked: (Optional) Stack every so many movies in two parts. Defaults to not stacking any movies.
+    :type related: tuple
+    :param related: (Optional) The suffixes of the files related to every video. Defaults to an NFO file.
+    """
+    for i in xrange(movies):
+        folder = "%s/Movies/Movie %d (2000)" % (root, i)
+        title = "Movie %d (2000)" % i
+        if stacked and i % stacked == stacked - 1:
+            parts = ["%s/%s-cd%d.avi" % (folder, title, part) for part in (1, 2)]
+            path = "stack://" + " , ".join(parts)
+        else:
+            parts = ["%s/%s.mkv" % (folder, title)]
+            path = parts[0]
+        for part in parts:
+            kodi.vfs.add_file(part, 4 * 1024 ** 3 / len(parts))
+        for suffix in related:
+            kodi.vfs.add_file("%s/%s%s" % (folder, title, suffix), 2048)
+        kodi.library.add("movies", file=path, title="Movie %d" % i, playcount=1,
+                          lastplayed="2020-01-01 20:00:00")
+    for i in xrange(episodes):
+        show, episode = divmod(i, 20)
+        path = "%s/TV/Show %d/Season 1/Show %d S01E%02d.mkv" % (root, show, show, episode + 1)
+        kodi.vfs.add_file(path, 1024 ** 3)
+        for suffix in related:
+            kodi.vfs.add_file(os.path.splitext(path)[0] + suffix, 2048)
+        kodi.library.add("episodes", file=path, showtitle="Show %d" % show, playcount=1,
+                          lastplayed="2020-01-01 20:00:00")
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import xbmc
+from utils import debug
+
+PAUSE_INTERVAL = 1  # Seconds between checks whether playback has stopped
+
+
+class Cancelled(Exception):
+    """
+    Raised at a cancellation point once a cleaning run has to stop.
+
+    :type reason: str
+    :param reason: Why the run was stopped.
+    """
+
+    def __init__(self, reason):
+        super(Cancelled, self).__init__(reason)
+        self.reason = reason
+
+
+class RunControl(object):
+    """
+    The RunControl decides whether a cleaning run may carry on, at cancellation points between file system operations.
+
+    A run stops as soon as Kodi is shutting down, or once it has used up its time budget. If the run should not clean
+    during playback, it pauses for as long as a video is playing, and picks up where it left off once playback stops.
+    Time spent paused counts towards the budget, so a run never keeps Kodi busy for longer than configured. Once a run
+    has been stopped it stays stopped, so every worker stops at its next cancellation point. The videos that were not
+    cleaned yet are left in the intent log, to be cleaned by the next run.
+
+    *Example*
+      ``control.checkpoint()  # Raises Cancelled if the run has to stop``
+    """
+
+    def __init__(self, budget=0, pause_on_playback=False, monitor=None, player=None):
+        """
+        :type budget: int
+        :param budget: (Optional) The number of minutes the run may take, or 0 for no limit. Defaults to 0.
+        :type pause_on_playback: bool
+        :param pause_on_playback: (Optional) Whether to pause while a video is playing. Defaults to False.
+        """
+        self.monitor = monitor or xbmc.Monitor()
+        self.player = player or xbmc.Player()
+        self.deadline = time.time() + budget * 60 if budget > 0 else None
+        self.pause_on_playback = pause_on_playback
+        self.reason = None
+        self.paused = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def cancel(self, reason):
+        """
+        Stop the run at the next cancellation point of every worker.
+
+        :type reason: str
+        :param reason: Why the run is stopped.
+        """
+        with self.lock:
+            if self.reason is None:
+                debug("Stopping the cleaning run: %s.", reason, level=xbmc.LOGWARNING)
+                self.reason = reason
+
+    def out_of_time(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def stopped(self):
+        """
+        Check whether the run has to stop, waiting first for playback to stop if the run should not clean during it.
+
+        :rtype: bool
+        :return: True if the run has to stop, False if it may carry on.
+        """
+        if self.reason is None:
+            if self.monitor.abortRequested():
+                self.cancel("Kodi is shutting down")
+            elif self.out_of_time():
+                self.cancel("the time budget is used up")
+            elif self.pause_on_playback and self.player.isPlaying():
+                self.pause()
+        return self.reason is not None
+
+    def pause(self):
+        """Wait for playback to stop, Kodi to shut down or the time budget to run out, whichever comes first."""
+        debug("Playback started. Pausing cleaning.")
+        started = time.time()
+        while self.reason is None and self.player.isPlaying():
+            if self.monitor.waitForAbort(PAUSE_INTERVAL):
+                self.cancel("Kodi is shutting down")
+            elif self.out_of_time():
+                self.cancel("the time budget is used up")
+        with self.lock:
+            self.paused += time.time() - started
+        if self.reason is None:
+            debug("Playback stopped. Resuming cleaning after %.0f seconds.", time.time() - started)
+
+    def checkpoint(self):
+        """
+        A cancellation point. Waits while the run is paused.
+
+        :raises Cancelled: If the run has to stop.
+        """
+        if self.stopped():
+            raise Cancelled(self.reason)
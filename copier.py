@@ -0,0 +1,263 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+
+import xbmc
+import xbmcvfs
+from utils import debug
+
+CHUNK_SIZE = 16 * 1024 * 1024  # 16 MB
+TEMP_SUFFIX = ".part"
+PROGRESS_STEP = 10  # Log progress every 10%
+
+
+def is_local(path):
+    """Check whether a path is on the local file system, rather than a share or another virtual file system."""
+    return "://" not in path
+
+
+_sendfile = []
+
+
+def get_sendfile():
+    """
+    Look up the ``sendfile`` system call of the C library the first time it is needed. Python 2 does not provide it, so
+    it is called through ctypes. Only Linux (including Android) can send a file to another regular file.
+
+    :rtype: callable
+    :return: A function taking the output and input file descriptors, the offset and the number of bytes to copy, and
+        returning the number of bytes copied. None if the system call is not available.
+    """
+    if not _sendfile:
+        function = None
+        if sys.platform.startswith("linux"):
+            try:
+                import ctypes
+                libc = ctypes.CDLL(None, use_errno=True)
+                native = libc.sendfile64  # Takes a 64-bit offset, even on 32-bit systems such as the Raspberry Pi
+                native.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+                native.restype = ctypes.c_ssize_t
+
+                def sendfile(out_fd, in_fd, offset, count):
+                    position = ctypes.c_int64(offset)
+                    written = native(out_fd, in_fd, ctypes.byref(position), count)
+                    if written < 0:
+                        error = ctypes.get_errno()
+                        raise OSError(error, os.strerror(error))
+                    return written
+                function = sendfile
+            except (ImportError, OSError, AttributeError) as err:
+                debug("The kernel copy routine is not available: %s", err)
+        _sendfile.append(function)
+    return _sendfile[0]
+
+
+class CopyResult(object):
+    """
+    The outcome of copying a single file.
+
+    :type source: str
+    :param source: The file that was copied.
+    :type copied: int
+    :param copied: The number of bytes copied, not including those that were already copied by a previous attempt.
+    :type duration: float
+    :param duration: The number of seconds the copy took.
+    :type success: bool
+    :param success: Whether the copy completed and was moved in place.
+    """
+    __slots__ = ("source", "copied", "duration", "success")
+
+    def __init__(self, source, copied, duration, success):
+        self.source = source
+        self.copied = copied
+        self.duration = duration
+        self.success = success
+
+    @property
+    def throughput(self):
+        """The number of bytes copied per second."""
+        return self.copied / self.duration if self.duration > 0 else 0.0
+
+
+class Copier(object):
+    """
+    The Copier copies files in chunks, for use when a file cannot simply be renamed to its destination.
+
+    A file is first copied to a temporary file next to the destination, which is only renamed to the destination once
+    every byte of the source was copied and its size matches that of the source. Files whose size cannot be determined
+    are copied through ``xbmcvfs.copy`` instead. A destination therefore never holds a partial file. If copying is
+    interrupted, because Kodi is shutting down or an error occurs, the temporary file is kept. The next attempt to copy
+    the same file resumes where the previous one stopped, as long as the destination is on the local file system.
+
+    On Linux, copies between local files use the kernel's ``sendfile`` system call, so the data does not pass through
+    Python at all. Elsewhere, or if the file system does not support it, local files are copied in chunks through
+    Python. Any other copy goes through ``xbmcvfs`` with large buffers.
+
+    *Example*
+      ``success = Copier(FileSystem()).copy(source, destination)``
+    """
+
+    def __init__(self, fs, chunk_size=CHUNK_SIZE, abort=None):
+        """
+        :type fs: FileSystem
+        :param fs: The file system used for renaming and deleting files, so its cached listings stay up to date.
+        :type chunk_size: int
+        :param chunk_size: (Optional) The number of bytes to copy at once. Defaults to ``CHUNK_SIZE``.
+        :type abort: callable
+        :param abort: (Optional) A function that returns True when copying should stop. It is checked between chunks.
+        """
+        self.fs = fs
+        self.chunk_size = chunk_size
+        self.abort = abort or (lambda: False)
+        self.results = []
+
+    def copy(self, source, destination):
+        """
+        Copy a file to its destination through a temporary file, resuming a previous attempt if possible.
+
+        :type source: str
+        :param source: The file to copy.
+        :type destination: str
+        :param destination: The path of the copy.
+        :rtype: bool
+        :return: True if the file was copied completely, False otherwise.
+        """
+        temp = destination + TEMP_SUFFIX
+        size = self.fs.size(source)
+        started = time.time()
+        if not size or size < 0:
+            # The length of the source is unknown, so a complete copy cannot be told apart from an empty one
+            debug("Size of %r is unknown. Copying it through Kodi instead.", source, level=xbmc.LOGWARNING)
+            success = self.fs.copy(source, destination)
+            self.results.append(CopyResult(source, 0, time.time() - started, success))
+            return success
+
+        copied = reached = 0
+        try:
+            if is_local(source) and is_local(temp):
+                copied, reached = self.copy_local(source, temp, size)
+            else:
+                copied, reached = self.copy_vfs(source, temp, size)
+        except (IOError, OSError) as err:
+            debug("Copying %r failed: %s", source, err, level=xbmc.LOGERROR)
+
+        self.fs.forget(temp)  # The temporary file was written directly, so its cached size is out of date
+        complete = reached == size and self.fs.size(temp) == size
+        success = complete and self.fs.rename(temp, destination)
+        result = CopyResult(source, copied, time.time() - started, success)
+        self.results.append(result)
+        if success:
+            debug("Copied %d bytes of %r in %.1f seconds (%.1f MB/s).", copied, source, result.duration,
+                  result.throughput / 1024 / 1024)
+        elif complete:
+            debug("Could not rename %r to %r.", temp, destination, level=xbmc.LOGERROR)
+        else:
+            debug("Copy of %r is incomplete. It will be resumed from %r next time.", source, temp,
+                  level=xbmc.LOGWARNING)
+        return success
+
+    def resume_offset(self, temp, size):
+        """
+        Determine where to continue copying, based on the temporary file left behind by a previous attempt.
+
+        :type temp: str
+        :param temp: The temporary file.
+        :type size: int
+        :param size: The size of the source file.
+        :rtype: int
+        :return: The number of bytes that were already copied, or 0 to start over.
+        """
+        if not os.path.exists(temp):
+            return 0
+        offset = os.path.getsize(temp)
+        if offset > size:
+            os.remove(temp)
+            return 0
+        if offset:
+            debug("Resuming copy to %r at %d of %d bytes.", temp, offset, size)
+        return offset
+
+    def copy_local(self, source, temp, size):
+        """
+        Copy a file between local paths, continuing the temporary file left behind by a previous attempt.
+
+        :rtype: (int, int)
+        :return: The number of bytes copied, and the number of bytes of the source that are now in the temporary file.
+        """
+        offset = start = self.resume_offset(temp, size)
+        sendfile = get_sendfile()
+        # The kernel refuses to send to files opened for appending, so position the temporary file explicitly
+        with open(source, "rb") as src, open(temp, "r+b" if offset else "wb") as dst:
+            dst.seek(offset)
+            while offset < size and not self.abort():
+                count = min(self.chunk_size, size - offset)
+                written = None
+                if sendfile is not None:
+                    try:
+                        written = sendfile(dst.fileno(), src.fileno(), offset, count)
+                    except OSError as err:
+                        debug("Copying %r through the kernel failed: %s. Copying it in chunks instead.", source, err,
+                              level=xbmc.LOGWARNING)
+                        sendfile = None
+                if written is None:
+                    # Both files are positioned explicitly, as sending does not move the Python file objects along
+                    src.seek(offset)
+                    dst.seek(offset)
+                    data = src.read(count)
+                    dst.write(data)
+                    written = len(data)
+                if not written:
+                    break
+                offset += written
+                self.fs.governor.transfer(written)
+                self.progress(temp, offset, size)
+            dst.flush()
+            os.fsync(dst.fileno())
+        return offset - start, offset
+
+    def copy_vfs(self, source, temp, size):
+        """
+        Copy a file through ``xbmcvfs``. Network destinations cannot be appended to, so they always start over.
+
+        :rtype: (int, int)
+        :return: The number of bytes copied, and the number of bytes of the source that are now in the temporary file.
+        """
+        offset = start = self.resume_offset(temp, size) if is_local(temp) else 0
+        src = xbmcvfs.File(source)
+        try:
+            if offset:
+                src.seek(offset, 0)
+                dst = open(temp, "ab")
+            else:
+                dst = xbmcvfs.File(temp, "w")
+            try:
+                while offset < size and not self.abort():
+                    data = src.read(min(self.chunk_size, size - offset))
+                    if not data or dst.write(data) is False:
+                        break
+                    offset += len(data)
+                    self.fs.governor.transfer(len(data))
+                    self.progress(temp, offset, size)
+            finally:
+                dst.close()
+        finally:
+            src.close()
+        return offset - start, offset
+
+    def progress(self, path, copied, size):
+        """Log the progress of a copy each time another ``PROGRESS_STEP`` percent has been copied."""
+        step = max(1, size * PROGRESS_STEP // 100)
+        if copied // step != (copied - min(copied, self.chunk_size)) // step or copied == size:
+            debug("Copied %d of %d bytes to %r (%d%%).", copied, size, path, copied * 100 // max(1, size))
+
+    def report(self):
+        """Write the throughput of all copies made so far to the debug log."""
+        copies = [result for result in self.results if result.success]
+        copied = sum(result.copied for result in copies)
+        duration = sum(result.duration for result in copies)
+        if copies:
+            debug("Copied %d files (%d bytes) at an average of %.1f MB/s.", len(copies), copied,
+                  copied / duration / 1024 / 1024 if duration else 0.0)
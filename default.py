@@ -2,9 +2,28 @@
 # -*- coding: utf-8 -*-
 
 import json
-
-import xbmcvfs
+import time
+import urllib
+
+import xbmcgui
+import diskspace
+from diskspace import DeviceMap
+from control import Cancelled, RunControl
+from copier import Copier
+from exclusions import ExclusionMatcher
+from executor import HostLimitedExecutor
+import governor
+from governor import IoGovernor
+import intents
+from intents import IntentLog
+import metrics
+from metrics import Metrics
+from planner import PRUNE, Plan, Task, score, select
+from pruner import FolderPruner
+import utils
 from utils import *
+from vfs import FileSystem
+from watermarks import Watermarks, next_day, parse_lastplayed
 
 
 # Addon info
@@ -15,6 +34,124 @@ __author__ = "Anthirian, drewzh"
 __icon__ = xbmc.translatePath(__addon__.getAddonInfo("icon")).decode("utf-8")
 
 
+class JsonRpcError(Exception):
+    """
+    An error returned by Kodi for a single JSON-RPC request.
+
+    :type code: int
+    :param code: The JSON-RPC error code.
+    :type message: str
+    :param message: The description of the error.
+    """
+
+    def __init__(self, code, message):
+        super(JsonRpcError, self).__init__("%s (%s)" % (message, code))
+        self.code = code
+        self.message = message
+
+
+class JsonRpc(object):
+    """
+    The JsonRpc class sends requests to Kodi's JSON-RPC interface, several at a time if possible.
+
+    Requests are sent as JSON-RPC 2.0 batches, so any number of them costs a single round-trip, and each response is
+    matched to its request by id. Errors are reported per request, so one failing request does not affect the others.
+    Requests can also be sent ahead of time, for instance the first page of every video type, in which case the
+    prefetched response is handed out as soon as the same request is made.
+
+    *Example*
+      ``movies, episodes = JsonRpc().batch([("VideoLibrary.GetMovies", {}), ("VideoLibrary.GetEpisodes", {})])``
+    """
+
+    def __init__(self):
+        self.prefetched = {}
+        self.round_trips = 0
+        self.requests = 0
+
+    @staticmethod
+    def key(method, params):
+        """Identify a request by its method and parameters, regardless of the order of its parameters."""
+        return method, json.dumps(params, sort_keys=True)
+
+    def call(self, method, params=None):
+        """
+        Send a single request, or take its response from the prefetched responses.
+
+        :type method: str
+        :param method: The JSON-RPC method to call.
+        :type params: dict
+        :param params: (Optional) The parameters of the method.
+        :rtype: dict
+        :return: The result of the request.
+        :raises JsonRpcError: If Kodi returned an error for the request.
+        """
+        params = params or {}
+        key = self.key(method, params)
+        if key in self.prefetched:
+            result = self.prefetched.pop(key)
+        else:
+            result = self.batch([(method, params)])[0]
+        if isinstance(result, JsonRpcError):
+            raise result
+        return result
+
+    def prefetch(self, calls):
+        """
+        Send a number of requests in a single round-trip, and keep their responses until they are requested.
+
+        :type calls: list
+        :param calls: The method and parameters of every request.
+        """
+        calls = [(method, params or {}) for method, params in calls]
+        for (method, params), result in zip(calls, self.batch(calls)):
+            self.prefetched[self.key(method, params)] = result
+
+    def batch(self, calls):
+        """
+        Send a number of requests in a single round-trip.
+
+        :type calls: list
+        :param calls: The method and parameters of every request.
+        :rtype: list
+        :return: The result of every request, in the same order. Requests that failed have a ``JsonRpcError`` instead.
+        """
+        if not calls:
+            return []
+        requests = [{"jsonrpc": "2.0", "method": method, "params": params or {}, "id": request_id}
+                    for request_id, (method, params) in enumerate(calls, 1)]
+        self.round_trips += 1
+        self.requests += len(requests)
+        response = self.send(requests if len(requests) > 1 else requests[0])
+        if isinstance(response, dict):
+            if len(requests) > 1 and response.get("id") is None:
+                # Kodi rejected the batch as a whole, so fall back to sending the requests one by one
+                debug("Batch of %d requests was rejected: %r", len(requests), response.get("error"),
+                      level=xbmc.LOGWARNING)
+                return [result for call in calls for result in self.batch([call])]
+            response = [response]
+
+        responses = dict((item.get("id"), item) for item in response if isinstance(item, dict))
+        results = []
+        for request in requests:
+            item = responses.get(request["id"], {"error": {"code": -32603, "message": "No response"}})
+            if "result" in item:
+                results.append(item["result"])
+            else:
+                error = item.get("error") or {}
+                debug("%s failed: %r", request["method"], error, level=xbmc.LOGWARNING)
+                results.append(JsonRpcError(error.get("code"), error.get("message")))
+        return results
+
+    @staticmethod
+    def send(request):
+        """Send a request or a batch of requests to Kodi and decode the response."""
+        try:
+            return json.loads(xbmc.executeJSONRPC(json.dumps(request)))
+        except ValueError as err:
+            debug("Could not decode the JSON-RPC response: %s", err, level=xbmc.LOGERROR)
+            return {"id": None, "error": {"code": -32700, "message": str(err)}}
+
+
 class Cleaner(object):
     """
     The Cleaner class allows users to clean up their movie, TV show and music video collection by removing watched
@@ -36,6 +173,7 @@ class Cleaner(object):
     CLEANING_TYPE_DELETE = "1"
     DEFAULT_ACTION_CLEAN = "0"
     DEFAULT_ACTION_LOG = "1"
+    DEFAULT_ACTION_PREVIEW = "2"
 
     movie_filter_fields = ["title", "plot", "plotoutline", "tagline", "votes", "rating", "time", "writers",
                            "playcount", "lastplayed", "inprogress", "genre", "country", "year", "director",
@@ -67,116 +205,732 @@ class Cleaner(object):
         MOVIES: ["file", "title"],
         MUSIC_VIDEOS: ["file", "artist"]
     }
+    details = {
+        TVSHOWS: ("VideoLibrary.GetEpisodeDetails", "episodeid", "episodedetails"),
+        MOVIES: ("VideoLibrary.GetMovieDetails", "movieid", "moviedetails"),
+        MUSIC_VIDEOS: ("VideoLibrary.GetMusicVideoDetails", "musicvideoid", "musicvideodetails")
+    }
+    notification_types = NOTIFICATION_TYPES
+    ranking_properties = {
+        TVSHOWS: ["lastplayed", "rating"],
+        MOVIES: ["lastplayed", "rating"],
+        MUSIC_VIDEOS: ["lastplayed"]
+    }
     stacking_indicators = ["part", "pt", "cd", "dvd", "disk", "disc"]
 
-    def __init__(self):
-        debug("%s version %s loaded." % (__addon__.getAddonInfo("name").decode("utf-8"),
-                                         __addon__.getAddonInfo("version").decode("utf-8")))
+    def __init__(self, settings=None):
+        """
+        :type settings: dict
+        :param settings: (Optional) A settings snapshot to use for every run, instead of the current addon settings.
+        """
+        self.fixed_settings = settings
+        self.settings = settings if settings is not None else get_settings()
+        self.control = RunControl()
+        self.governor = IoGovernor()
+        self.fs = FileSystem(self.control.checkpoint, self.governor)
+        self.copier = Copier(self.fs, abort=self.control.stopped)
+        self.exclusions = ExclusionMatcher.from_settings(self.settings)
+        self.watermarks = Watermarks(os.path.join(utils.get_profile(), "watermarks.json"))
+        self.disk_space = diskspace.get_monitor()
+        self.devices = DeviceMap()
+        self.rpc = JsonRpc()
+        self.metrics = Metrics()
+        self.intents = IntentLog(os.path.join(utils.get_profile(), INTENT_LOG))
+        self.sources = None
+        self.touched, self.prune_ids = set(), []
+        debug("%s version %s loaded.", __addon__.getAddonInfo("name").decode("utf-8"),
+              __addon__.getAddonInfo("version").decode("utf-8"))
+
+    def prepare(self):
+        """
+        Reset all state kept during a cleaning run, and pick up the current addon settings, unless the cleaner was given
+        a settings snapshot of its own.
 
-    def clean(self, video_type):
+        When moving videos, the library sources are looked up once, so that the device of every source and of the
+        holding folder only has to be determined once per run. The time budget of the run starts counting here.
+        """
+        self.settings = self.fixed_settings if self.fixed_settings is not None else get_settings()
+        configure_logging(self.settings)
+        self.control = RunControl(self.settings[time_budget], self.settings[clean_when_idle])
+        self.governor = IoGovernor(self.settings[playback_bandwidth] * governor.MEGABYTE,
+                                   self.settings[playback_operations], playing=self.control.player.isPlaying,
+                                   wait=self.control.monitor.waitForAbort)
+        self.fs = FileSystem(self.control.checkpoint, self.governor)
+        self.copier = Copier(self.fs, abort=self.control.stopped)
+        self.exclusions = ExclusionMatcher.from_settings(self.settings)
+        self.watermarks = Watermarks(os.path.join(utils.get_profile(), "watermarks.json"))
+        self.rpc = JsonRpc()
+        self.metrics = Metrics()
+        self.intents = IntentLog(os.path.join(utils.get_profile(), INTENT_LOG))
+        self.sources = None
+        self.touched, self.prune_ids = set(), []
+        if self.settings[cleaning_type] == self.CLEANING_TYPE_MOVE:
+            self.sources = self.get_sources()
+            self.devices = DeviceMap(self.sources + [self.settings[holding_folder]])
+        else:
+            self.devices = DeviceMap()
+
+    def get_sources(self):
+        """
+        Look up the folders of the video sources in the Kodi library.
+
+        :rtype: list
+        :return: The folders of all video sources, with sources spanning multiple folders split into their folders.
+        """
+        folders = []
+        try:
+            for source in self.rpc.call("Files.GetSources", {"media": "video"}).get("sources", []):
+                path = source["file"].encode("utf-8")
+                if path.startswith("multipath://"):
+                    folders.extend(urllib.unquote(p) for p in path[len("multipath://"):].split("/") if p)
+                else:
+                    folders.append(path)
+        except JsonRpcError as err:
+            debug("Could not retrieve the video sources: %s", err, level=xbmc.LOGWARNING)
+        return folders
+
+    def clean(self, video_type, only=None):
         """
         Clean all watched videos of the provided type.
 
+        Cleaning happens in two phases. First a plan is made of every file that will be moved or deleted, and every
+        folder that may be left empty. The plan is then executed. Videos are cleaned one after another, unless
+        concurrent cleaning is enabled in the addon settings. In that case a pool of worker threads cleans several
+        videos at the same time, limiting the number of videos cleaned simultaneously on each storage host.
+
         :type video_type: str
         :param video_type: The type of videos to clean (one of TVSHOWS, MOVIES, MUSIC_VIDEOS).
+        :type only: list
+        :param only: (Optional) The files of the only videos that should be considered for cleaning.
         :rtype: (list, int)
         :return: A list of the filenames that were cleaned, as well as the number of files cleaned.
         """
-        cleaned_files = []
-        count = 0
-        clean_this_video_type = False
+        plan = self.plan(video_type, only)
+        if plan is None:
+            return [], 0
+        return self.execute(plan)
+
+    def plan(self, video_type, only=None, dry_run=False, ranked=False):
+        """
+        Find the watched videos of the provided type and plan how they are to be cleaned, without touching any files.
+
+        :type video_type: str
+        :param video_type: The type of videos to plan (one of TVSHOWS, MOVIES, MUSIC_VIDEOS).
+        :type only: list
+        :param only: (Optional) The files of the only videos that should be considered for cleaning.
+        :type dry_run: bool
+        :param dry_run: (Optional) Whether the plan is only previewed. This leaves the state of delta queries as is.
+        :type ranked: bool
+        :param ranked: (Optional) Whether to retrieve the properties needed to rank the videos. Defaults to False.
+        :rtype: Plan
+        :return: The plan, or None if videos of this type should not be cleaned.
+        """
+        if not self.is_enabled(video_type):
+            debug("Cleaning of %s is disabled. Skipping.", video_type)
+            return None
+
+        moving = self.settings[cleaning_type] == self.CLEANING_TYPE_MOVE
+        if moving and self.settings[holding_folder] == "":
+            # No destination set, prompt user to set one now
+            if xbmcgui.Dialog().yesno(__title__, *map(translate, (32521, 32522, 32523))):
+                xbmc.executebuiltin("Addon.OpenSettings(%s)" % __addonID__)
+            return None
+
+        properties = list(self.properties[video_type])
+        if ranked:
+            # Videos that are not selected must be found again next time, so delta queries cannot be used
+            properties.extend(self.ranking_properties[video_type])
+            expired_videos = self.get_expired_videos(video_type, only, properties)
+        elif only is None and self.settings[delta_queries] and not dry_run:
+            expired_videos = self.get_delta_videos(video_type)
+        else:
+            expired_videos = self.get_expired_videos(video_type, only)
+        expired_videos = self.metrics.timed(metrics.QUERY, expired_videos)
+
+        # Without a target, only videos on volumes that are low on free space are cleaned
+        per_volume = self.settings[clean_when_low_disk_space] and self.settings[check_each_volume] and not ranked
+        plan = Plan(video_type, prune=self.settings[delete_folders])
+        for video in expired_videos:
+            filename, title = video[:2]
+            paths = self.unstack(filename)
+            with self.metrics.phase(metrics.FILTER):
+                reason = self.check(filename, paths, per_volume)
+            if reason is not None:
+                plan.skip(filename, reason)
+                self.metrics.count("videos_skipped", label=reason)
+                continue
+
+            destination = self.get_destination(title) if moving else None
+            devices = (self.devices.device(paths[0]), self.devices.device(destination)) if moving else None
+            with self.metrics.phase(metrics.RELATED):
+                related = self.find_related_files(filename) if self.settings[clean_related] else []
+            plan.add(Task(filename, title, paths, destination, related, dict(zip(properties[2:], video[2:])), devices))
+
+        plan.finish()
+        debug("Planned %d %s in %.2f seconds.", len(plan), video_type, plan.duration)
+        return plan
+
+    def check(self, filename, paths, per_volume=False):
+        """
+        Check whether a watched video may be cleaned.
+
+        :type filename: str
+        :param filename: The path to the video, as stored in the Kodi library.
+        :type paths: list
+        :param paths: The paths of the files that make up the video.
+        :type per_volume: bool
+        :param per_volume: (Optional) Whether the volume the video is on must be low on free space. Defaults to False.
+        :rtype: str
+        :return: The reason to skip the video, or None if it may be cleaned.
+        """
+        if not self.fs.exists(paths[0]):
+            debug("%r was already deleted. Skipping.", filename, level=xbmc.LOGWARNING)
+            return "missing"
+        if self.is_excluded(paths[0]):
+            debug("Detected a file on an excluded path. Skipping %r.", filename)
+            return "excluded"
+        if per_volume and self.disk_space.free_percentage(paths[0]) > self.settings[disk_space_threshold]:
+            debug("The disk %r is stored on is not low on free space. Skipping.", filename)
+            return "enough free space"
+        return None
+
+    def is_enabled(self, video_type):
+        """
+        Check whether videos of a type should be cleaned, according to the addon settings.
+
+        :type video_type: str
+        :param video_type: The type of videos (one of TVSHOWS, MOVIES, MUSIC_VIDEOS).
+        :rtype: bool
+        :return: True if cleaning of this type is enabled, False otherwise.
+        """
         if video_type == self.TVSHOWS:
-            clean_this_video_type = get_setting(clean_tv_shows)
+            return self.settings[clean_tv_shows]
         elif video_type == self.MOVIES:
-            clean_this_video_type = get_setting(clean_movies)
+            return self.settings[clean_movies]
         elif video_type == self.MUSIC_VIDEOS:
-            clean_this_video_type = get_setting(clean_music_videos)
-
-        if clean_this_video_type:
-            for filename, title in self.get_expired_videos(video_type):
-                unstacked_path = self.unstack(filename)
-                if xbmcvfs.exists(unstacked_path[0]):
-                    if get_setting(cleaning_type) == self.CLEANING_TYPE_MOVE:
-                        if get_setting(holding_folder) == "":
-                            # No destination set, prompt user to set one now
-                            if xbmcgui.Dialog().yesno(__title__, *map(translate, (32521, 32522, 32523))):
-                                xbmc.executebuiltin("Addon.OpenSettings(%s)" % __addonID__)
-                            break
-                        if get_setting(create_subdirs):
-                            if isinstance(title, unicode):
-                                title = title.encode("utf-8")
-                            new_path = os.path.join(get_setting(holding_folder), str(title))
-                        else:
-                            new_path = get_setting(holding_folder)
-                        move_result = self.move_file(filename, new_path)
-                        if move_result == 1:
-                            debug("File(s) moved successfully.")
-                            count += 1
-                            if len(unstacked_path) > 1:
-                                cleaned_files.extend(unstacked_path)
-                            else:
-                                cleaned_files.append(filename)
-                            self.clean_related_files(filename, new_path)
-                            self.delete_empty_folders(os.path.dirname(filename))
-                        elif move_result == -1:
-                            debug("Moving errors occurred. Skipping related files and directories.", xbmc.LOGWARNING)
-                            xbmcgui.Dialog().ok(*map(translate, (32611, 32612, 32613, 32614)))
-                    elif get_setting(cleaning_type) == self.CLEANING_TYPE_DELETE:
-                        if self.delete_file(filename):
-                            debug("File(s) deleted successfully.")
-                            count += 1
-                            if len(unstacked_path) > 1:
-                                cleaned_files.extend(unstacked_path)
-                            else:
-                                cleaned_files.append(filename)
-                            self.clean_related_files(filename)
-                            self.delete_empty_folders(os.path.dirname(filename))
+            return self.settings[clean_music_videos]
+        return False
+
+    def prefetch(self, video_types, dry_run=False, ranked=False):
+        """
+        Retrieve the first page of videos of every enabled type in a single round-trip, before planning starts.
+
+        The requests are the same as those ``plan()`` makes for the first page of each type with the same arguments,
+        so planning takes those pages from the prefetched responses instead of asking Kodi again.
+
+        :type video_types: list
+        :param video_types: The types of videos that are going to be planned.
+        :type dry_run: bool
+        :param dry_run: (Optional) Whether the plans are only previewed. Defaults to False.
+        :type ranked: bool
+        :param ranked: (Optional) Whether the properties needed to rank the videos are retrieved. Defaults to False.
+        """
+        calls = []
+        for video_type in filter(self.is_enabled, video_types):
+            properties = list(self.properties[video_type])
+            if ranked:
+                properties.extend(self.ranking_properties[video_type])
+                filters = self.get_filters(video_type)
+            elif self.settings[delta_queries] and not dry_run:
+                filters, properties = self.get_delta_filters(video_type, self.watermarks.since(video_type))
+            else:
+                filters = self.get_filters(video_type)
+            calls.append(self.page_request(video_type, filters, properties, 0))
+        if len(calls) > 1:
+            debug("Retrieving the first page of %d video types at once.", len(calls))
+            with self.metrics.phase(metrics.QUERY):
+                self.rpc.prefetch(calls)
+
+    def execute(self, plan, intent_ids=None):
+        """
+        Clean the videos in a plan, then remove the folders that were left empty.
+
+        The folders that may be left empty are only removed at the end of the run, by ``prune_folders()``, as other
+        plans may empty them further. If the run is stopped halfway, the videos that were not cleaned are carried over
+        to the next run, along with those folders. Their intents remain pending, so the next run cleans them first.
+
+        :type plan: Plan
+        :param plan: The plan to execute.
+        :type intent_ids: dict
+        :param intent_ids: (Optional) The ids of the intents that were already recorded for the tasks in the plan, keyed
+            by the ``id()`` of the task. Defaults to recording new intents.
+        :rtype: (list, int)
+        :return: A list of the filenames that were cleaned, as well as the number of files cleaned.
+        """
+        # Record what is going to happen before anything happens, so an interrupted run can be finished later
+        if intent_ids is None:
+            intent_ids = self.intents.begin(plan)
+        if self.settings[concurrent_cleaning]:
+            executor = HostLimitedExecutor(self.settings[concurrent_workers],
+                                           self.settings[concurrent_workers_per_host])
+            debug("Cleaning %s using %d workers, at most %d per host.", plan.video_type, executor.max_workers,
+                  executor.max_per_host)
+            results = executor.map(self.execute_task, plan.tasks, host=lambda task: task.host)
+        else:
+            results = (self.execute_task(task) for task in plan.tasks)
+
+        cleaned_files, cleaned_tasks, failed, done, carried_over = [], [], [], [], 0
+        try:
+            for task, paths, result in results:
+                if result is None or result == -1 and self.control.cancelled:
+                    carried_over += 1
+                elif result == -1:
+                    failed.append(intent_ids[id(task)])
+                    xbmcgui.Dialog().ok(*map(translate, (32611, 32612, 32613, 32614)))
                 else:
-                    debug("%r was already deleted. Skipping." % filename, xbmc.LOGWARNING)
+                    done.append(intent_ids[id(task)])
+                    if len(done) >= intents.DONE_BATCH:
+                        self.intents.done(*done)
+                        done = []
+                    if result == 1:
+                        cleaned_files.extend(paths)
+                        cleaned_tasks.append(task)
+        finally:
+            self.intents.done(*done)
+        self.intents.retry(*failed)
+
+        if carried_over:
+            debug("Carrying %d %s over to the next run.", carried_over, plan.video_type)
+            self.metrics.count("videos_carried_over", carried_over, label=plan.video_type)
+        else:
+            self.touched.update(plan.folders(cleaned_tasks))
+            if None in intent_ids:
+                self.prune_ids.append(intent_ids[None])
+        self.metrics.count("videos_cleaned", len(cleaned_tasks), label=plan.video_type)
+        if self.settings[delta_queries] and cleaned_tasks:
+            self.watermarks.done(plan.video_type, [task.filename for task in cleaned_tasks])
+            self.save_watermarks()
+
+        plan.cleaned = cleaned_tasks
+        return cleaned_files, len(cleaned_tasks)
+
+    def plan_to_target(self, items=None, dry_run=False):
+        """
+        Plan the cleaning of all watched videos and rank them, so that only the highest ranked videos need cleaning.
+
+        The watched videos of all types are ranked according to the priorities set in the addon settings, after
+        looking up the sizes of all their files at once.
+
+        :type items: dict
+        :param items: (Optional) The library ids of the only videos to consider, keyed by video type.
+        :type dry_run: bool
+        :param dry_run: (Optional) Whether the plans are only previewed. Defaults to False.
+        :rtype: (list, list)
+        :return: The plans for every video type, and all of their tasks ranked from highest to lowest score.
+        """
+        plans = []
+        if items is None:
+            self.prefetch([self.MOVIES, self.MUSIC_VIDEOS, self.TVSHOWS], dry_run, ranked=True)
+        for video_type in [self.MOVIES, self.MUSIC_VIDEOS, self.TVSHOWS]:
+            if items is None:
+                plan = self.plan(video_type, dry_run=dry_run, ranked=True)
+            elif items.get(video_type):
+                plan = self.plan(video_type, self.get_files(video_type, items[video_type]), dry_run, ranked=True)
+            else:
+                continue
+            if plan is not None:
+                plans.append(plan)
+
+        tasks = [task for plan in plans for task in plan.tasks]
+        sizes = self.fs.sizes([path for task in tasks for path in task.paths + task.related])
+        for task in tasks:
+            task.size = sum(sizes[path] for path in task.paths + task.related)
+
+        now = time.time()
+        weights = self.settings[rank_by_age], self.settings[rank_by_rating], self.settings[rank_by_size]
+        tasks.sort(key=lambda task: score(task, *weights, now=now), reverse=True)
+        debug("Ranked %d videos with a total size of %d bytes.", len(tasks), sum(task.size for task in tasks))
+        return plans, tasks
+
+    def replay(self):
+        """
+        Finish cleaning the videos that an earlier run started cleaning but did not finish, for example because Kodi
+        was shut down or the run was out of time.
+
+        The videos are cleaned as recorded in the intent log, without querying the library. Videos of a type that is no
+        longer enabled are left in the log until it is enabled again. Videos that could not be cleaned after several
+        attempts are given up on. The folders that may have been left empty are removed along with those of the
+        current run, by ``prune_folders()``.
+
+        :rtype: (dict, list)
+        :return: The number of videos cleaned keyed by video type, and the paths of the files that were cleaned.
+        """
+        summary, cleaned = {}, []
+        try:
+            pending = self.intents.pending()
+            if pending:
+                debug("Resuming %d unfinished operations of an earlier run.", len(pending))
+                plans, intent_ids, prunes, given_up = {}, {}, [], []
+                for intent in pending:
+                    if intent["attempt"] > intents.MAX_ATTEMPTS:
+                        debug("Giving up on %r after %d attempts.", intent.get("filename", intent.get("folders")),
+                              intents.MAX_ATTEMPTS, level=xbmc.LOGWARNING)
+                        given_up.append(intent["id"])
+                    elif intent["action"] == PRUNE:
+                        prunes.append(intent)
+                    elif not self.is_enabled(intent["type"]):
+                        debug("Leaving %r for later, as cleaning %s is disabled.", intent["filename"], intent["type"])
+                    else:
+                        plan = plans.setdefault(intent["type"],
+                                                Plan(intent["type"], prune=self.settings[delete_folders]))
+                        task = IntentLog.task(intent)
+                        plan.add(task)
+                        intent_ids[id(task)] = intent["id"]
+                self.intents.done(*given_up)
+
+                for plan in plans.values():
+                    plan.finish()
+                    cleaned_files, count = self.execute(plan, intent_ids)
+                    if count > 0:
+                        cleaned.extend(cleaned_files)
+                        summary[plan.video_type] = count
+                for intent in prunes:
+                    self.touched.update(f.encode("utf-8") if isinstance(f, unicode) else f for f in intent["folders"])
+                    self.prune_ids.append(intent["id"])
+        except Cancelled as stop:
+            debug("Stopped finishing the earlier run because %s.", stop.reason, level=xbmc.LOGWARNING)
+        return summary, cleaned
+
+    def prune_folders(self):
+        """
+        Remove the folders left empty by this run, and by earlier runs that did not get to it, in a single pass.
+
+        Every parent of the folders videos were cleaned from is checked as well, up to the library source it is in.
+        Files with one of the extensions in the ignored file types setting do not keep a folder from being removed.
+
+        :rtype: list
+        :return: The folders that were removed.
+        """
+        removed = []
+        if self.touched:
+            if self.sources is None:
+                self.sources = self.get_sources()
+            ignored = [extension.strip() for extension in self.settings[ignore_extensions].split(",")]
+            pruner = FolderPruner(self.fs, self.sources + [self.settings[holding_folder]], ignored)
+            with self.metrics.phase(metrics.FOLDERS):
+                removed = pruner.prune(self.touched)
+            self.metrics.count("folders_removed", len(removed))
+            self.touched = set()
+        self.intents.done(*self.prune_ids)
+        self.prune_ids = []
+        return removed
+
+    def compact_intents(self):
+        """Shrink the intent log to the intents that are still pending, once a run is over."""
+        try:
+            self.intents.compact()
+        except (IOError, OSError) as err:
+            debug("Could not compact the intent log: %s", err, level=xbmc.LOGERROR)
+
+    def clean_to_target(self, items=None):
+        """
+        Clean the highest ranked watched videos until enough space has been freed.
+
+        If free space is checked for every volume, each volume is cleaned until it gets back above the threshold on its
+        own. If some of the selected videos cannot be cleaned, the next videos in line are cleaned instead.
+
+        :type items: dict
+        :param items: (Optional) The library ids of the only videos to consider, keyed by video type.
+        :rtype: dict
+        :return: The list of filenames that were cleaned and the number of videos cleaned, keyed by video type.
+        """
+        plans, ranked = self.plan_to_target(items)
+        owners = dict((id(task), plan) for plan in plans for task in plan.tasks)
+        queues = self.queue_by_volume(ranked)
+        needed = self.bytes_needed(queues)
+        freed = dict.fromkeys(needed, 0)
+        results = {}
+        while not self.control.cancelled:
+            batch = self.select_to_target(queues, needed, freed)
+            if not batch:
+                break
+            for plan in plans:
+                subset = plan.subset(task for task in batch if owners[id(task)] is plan)
+                if subset:
+                    cleaned_files, count = self.execute(subset)
+                    for task in subset.cleaned:
+                        freed[self.volume_of(task)] += task.size
+                    files, total = results.get(plan.video_type, ([], 0))
+                    results[plan.video_type] = files + cleaned_files, total + count
+
+        self.disk_space.invalidate()
+        for volume in needed:
+            debug("Freed %d of the %d bytes needed on %s.", freed[volume], needed[volume],
+                  volume or self.settings[disk_space_check_path])
+        return results
+
+    def volume_of(self, task):
+        """
+        Identify the volume whose free space decides whether a video is cleaned.
+
+        :type task: Task
+        :param task: The video.
+        :rtype: str
+        :return: The volume the video is stored on, or None if only the disk space check path is checked.
+        """
+        return self.disk_space.volume(task.paths[0]) if self.settings[check_each_volume] else None
+
+    def queue_by_volume(self, ranked):
+        """
+        Split a ranked list of videos by the volume they are stored on, keeping the order within every volume.
+
+        :type ranked: list
+        :param ranked: The tasks, highest score first.
+        :rtype: dict
+        :return: The ranked tasks, keyed by volume.
+        """
+        queues = {}
+        for task in ranked:
+            queues.setdefault(self.volume_of(task), []).append(task)
+        return queues
+
+    def bytes_needed(self, queues):
+        """
+        Determine how many bytes must be freed on every volume to get back above the disk space threshold.
+
+        :type queues: dict
+        :param queues: The tasks, keyed by volume.
+        :rtype: dict
+        :return: The number of bytes to free, keyed by volume.
+        """
+        if not self.settings[check_each_volume]:
+            return {None: utils.bytes_to_free(self.settings)}
+        return dict((volume, self.disk_space.bytes_to_free(tasks[0].paths[0], self.settings[disk_space_threshold]))
+                    for volume, tasks in queues.items())
+
+    def select_to_target(self, queues, needed, freed):
+        """
+        Pick the next videos to clean on every volume that is still short of space, removing them from the queues.
+
+        :type queues: dict
+        :param queues: The ranked tasks, keyed by volume.
+        :type needed: dict
+        :param needed: The number of bytes to free, keyed by volume.
+        :type freed: dict
+        :param freed: The number of bytes freed so far, keyed by volume.
+        :rtype: list
+        :return: The tasks to clean next.
+        """
+        batch = []
+        for volume, tasks in queues.items():
+            shortage = needed.get(volume, 0) - freed.get(volume, 0)
+            if shortage > 0:
+                selected = select(tasks, shortage)
+                queues[volume] = tasks[len(selected):]
+                batch.extend(selected)
+        return batch
+
+    def execute_task(self, task):
+        """
+        Clean a single video from a plan, along with its related files, unless the run is stopped first.
+
+        :type task: Task
+        :param task: The video to clean.
+        :rtype: (Task, list, int)
+        :return: The task, the list of paths that were cleaned, and 1 if the video was cleaned, 0 if it was not, -1
+            if errors occurred while moving, or None if the run was stopped before the video was cleaned.
+        """
+        try:
+            return self.clean_task(task)
+        except Cancelled:
+            return task, [], None
+
+    def clean_task(self, task):
+        """
+        Clean a single video from a plan, along with its related files.
+
+        :type task: Task
+        :param task: The video to clean.
+        :rtype: (Task, list, int)
+        :return: The task, the list of paths that were cleaned, and 1 if the video was cleaned, 0 if it was not, or -1
+            if errors occurred while moving.
+        """
+        cleaned_paths = task.paths if len(task.paths) > 1 else [task.filename]
+        if not task.size:
+            # Sizes must be known before the files are gone, to report how much space was freed. Related files are
+            # small enough to be left out, saving a call per file
+            task.size = sum(self.fs.sizes(task.paths).values())
+
+        if task.destination is not None:
+            with self.metrics.phase(metrics.CLEAN):
+                move_result = self.move_file(task.filename, task.destination, task.rename)
+            if move_result == 1:
+                debug("File(s) moved successfully.")
+                with self.metrics.phase(metrics.RELATED):
+                    self.clean_related_files(task.filename, task.destination, task.related, task.rename)
+                self.metrics.count("bytes_moved", task.size)
+                return task, cleaned_paths, 1
+            elif move_result == -1:
+                debug("Moving errors occurred. Skipping related files and directories.", level=xbmc.LOGWARNING)
+                return task, [], -1
         else:
-            debug("Cleaning of %s is disabled. Skipping." % video_type)
+            with self.metrics.phase(metrics.CLEAN):
+                deleted = self.delete_file(task.filename)
+            if not deleted and task.attempt and not any(self.fs.exists(p) for p in task.paths):
+                debug("%r was deleted by an earlier run, which did not finish.", task.filename)
+                deleted = True
+            if deleted:
+                debug("File(s) deleted successfully.")
+                with self.metrics.phase(metrics.RELATED):
+                    self.clean_related_files(task.filename, related=task.related)
+                self.metrics.count("bytes_deleted", task.size)
+                return task, cleaned_paths, 1
+
+        return task, [], 0
+
+    def get_destination(self, title):
+        """
+        Determine the folder in the holding folder a video should be moved to.
 
-        return cleaned_files, count
+        :type title: str
+        :param title: The title of the video, used to name the subdirectory in the holding folder if needed.
+        :rtype: str
+        :return: The destination folder.
+        """
+        if self.settings[create_subdirs]:
+            if isinstance(title, unicode):
+                title = title.encode("utf-8")
+            return os.path.join(self.settings[holding_folder], str(title))
+        return self.settings[holding_folder]
+
+    def preview(self):
+        """
+        Plan a cleaning run without moving or deleting anything, and write the plan to the addon profile.
 
-    def clean_all(self):
+        :rtype: (int, int, str)
+        :return: The number of videos that would be cleaned, the number of file operations needed and the path of
+            the report.
+        """
+        self.prepare()
+
+        plans = []
+        if self.settings[clean_when_low_disk_space] and self.settings[clean_to_target]:
+            if self.settings[check_each_volume] or utils.bytes_to_free(self.settings) > 0:
+                candidates, ranked = self.plan_to_target(dry_run=True)
+                queues = self.queue_by_volume(ranked)
+                selected = set(id(task) for task in self.select_to_target(queues, self.bytes_needed(queues), {}))
+                plans = [plan.subset(task for task in plan.tasks if id(task) in selected) for plan in candidates]
+        elif (not self.settings[clean_when_low_disk_space] or self.settings[check_each_volume]
+              or utils.disk_space_low(self.settings)):
+            self.prefetch([self.MOVIES, self.MUSIC_VIDEOS, self.TVSHOWS], dry_run=True)
+            for video_type in [self.MOVIES, self.MUSIC_VIDEOS, self.TVSHOWS]:
+                plan = self.plan(video_type, dry_run=True)
+                if plan is not None:
+                    plans.append(plan)
+
+        reports, videos, operations = [], 0, 0
+        for plan in plans:
+            reports.append(plan.report())
+            videos += len(plan)
+            operations += len(plan.operations())
+        if not plans:
+            reports.append("Nothing would be cleaned.")
+        self.fs.report()
+
+        report = "\n\n".join(reports)
+        debug("Cleaning preview:\n%s", report)
+        path = os.path.join(utils.get_profile(), "preview.txt")
+        try:
+            if not os.path.isdir(utils.get_profile()):
+                os.makedirs(utils.get_profile())
+            with open(path, "w") as f:
+                f.write(report.encode("utf-8") if isinstance(report, unicode) else report)
+        except (IOError, OSError) as err:
+            debug("Could not write the preview to %r: %s", path, err, level=xbmc.LOGERROR)
+        return videos, operations, path
+
+    def clean_all(self, items=None):
         """
         Clean up any watched videos in the Kodi library, satisfying any conditions set via the addon settings.
 
+        Instead of scanning the entire library, cleaning can be limited to a number of videos identified by their
+        library ids, such as the videos that were just marked as watched. These videos are subject to the same
+        conditions.
+
+        :type items: dict
+        :param items: (Optional) The library ids of the only videos to clean, keyed by video type.
         :rtype: str
         :return: A single-line (localized) summary of the cleaning results to be used for a notification.
         """
+        self.prepare()
         debug("Starting cleaning routine.")
 
-        if get_setting(clean_when_idle) and xbmc.Player().isPlaying():
-            debug("Kodi is currently playing a file. Skipping cleaning.", xbmc.LOGWARNING)
+        if self.settings[clean_when_idle] and xbmc.Player().isPlaying():
+            debug("Kodi is currently playing a file. Skipping cleaning.", level=xbmc.LOGWARNING)
             return None
+        self.metrics.write(utils.get_profile())
 
-        summary = {}
-        cleaning_results, cleaned_files = [], []
-        if not get_setting(clean_when_low_disk_space) or (get_setting(clean_when_low_disk_space)
-                                                          and utils.disk_space_low()):
-            for video_type in [self.MOVIES, self. MUSIC_VIDEOS, self.TVSHOWS]:
-                cleaned_files, count = self.clean(video_type)
-                if count > 0:
-                    cleaning_results.extend(cleaned_files)
-                    summary[video_type] = count
+        summary, cleaning_results = {}, []
+        try:
+            summary, cleaning_results = self.replay()
+            if self.settings[clean_when_low_disk_space] and self.settings[clean_to_target]:
+                if self.settings[check_each_volume] or utils.bytes_to_free(self.settings) > 0:
+                    for video_type, (cleaned_files, count) in self.clean_to_target(items).items():
+                        if count > 0:
+                            cleaning_results.extend(cleaned_files)
+                            summary[video_type] = summary.get(video_type, 0) + count
+            elif (not self.settings[clean_when_low_disk_space] or self.settings[check_each_volume]
+                  or utils.disk_space_low(self.settings)):
+                if items is None:
+                    self.prefetch([self.MOVIES, self.MUSIC_VIDEOS, self.TVSHOWS])
+                for video_type in [self.MOVIES, self. MUSIC_VIDEOS, self.TVSHOWS]:
+                    self.control.checkpoint()
+                    if items is None:
+                        cleaned_files, count = self.clean(video_type)
+                    elif items.get(video_type):
+                        cleaned_files, count = self.clean(video_type, self.get_files(video_type, items[video_type]))
+                    else:
+                        continue
+                    if count > 0:
+                        cleaning_results.extend(cleaned_files)
+                        summary[video_type] = summary.get(video_type, 0) + count
+            self.prune_folders()
+        except Cancelled as stop:
+            debug("Cleaning stopped because %s. The remaining videos will be cleaned by the next run.", stop.reason,
+                  level=xbmc.LOGWARNING)
+        self.compact_intents()
+        if self.control.paused:
+            debug("Cleaning was paused for %.0f seconds during playback.", self.control.paused)
+        self.fs.report(sum(summary.values()))
+        self.copier.report()
+        self.governor.report()
+        self.disk_space.invalidate()
+        debug("Sent %d JSON-RPC requests in %d round-trips.", self.rpc.requests, self.rpc.round_trips)
+        self.record_metrics()
 
         # Check if we need to perform any post-cleaning operations
         if cleaning_results:
             # Write cleaned file names to the log
-            Log().prepend(cleaning_results)
+            Log(self.settings).prepend(cleaning_results)
 
-            # Finally clean the library to account for any deleted videos.
-            if get_setting(clean_kodi_library):
+            # Finally clean the library to account for any deleted videos, unless the run had to stop
+            if self.settings[clean_kodi_library] and not self.control.cancelled:
                 xbmc.sleep(2000)  # Sleep 2 seconds to make sure file I/O is done.
 
                 if xbmc.getCondVisibility("Library.IsScanningVideo"):
-                    debug("The video library is being updated. Skipping library cleanup.", xbmc.LOGWARNING)
+                    debug("The video library is being updated. Skipping library cleanup.", level=xbmc.LOGWARNING)
                 else:
                     xbmc.executebuiltin("XBMC.CleanLibrary(video, false)")
 
         return self.summarize(summary)
 
+    def record_metrics(self):
+        """
+        Add the work done by the file system, the copier and the JSON-RPC client to the metrics of the run, and write
+        them to the addon profile.
+        """
+        for operation, count in self.fs.calls.items():
+            self.metrics.count("fs_operations", count, label=operation)
+        self.metrics.count("rpc_requests", self.rpc.requests)
+        self.metrics.count("rpc_round_trips", self.rpc.round_trips)
+        self.metrics.count("bytes_copied", sum(result.copied for result in self.copier.results))
+        self.metrics.count("paused_seconds", self.control.paused)
+        for limit, seconds in self.governor.waited.items():
+            self.metrics.count("throttled_seconds", seconds, label=limit)
+        self.metrics.finish()
+        self.metrics.report()
+        self.metrics.write(utils.get_profile())
+
     def summarize(self, details):
         """
         Create a summary from the cleaning results.
@@ -189,11 +943,11 @@ class Cleaner(object):
 
         # Localize video types
         for vid_type, amount in details.items():
-            if vid_type is self.MOVIES:
+            if vid_type == self.MOVIES:
                 video_type = utils.translate(32515)
-            elif vid_type is self.TVSHOWS:
+            elif vid_type == self.TVSHOWS:
                 video_type = utils.translate(32516)
-            elif vid_type is self.MUSIC_VIDEOS:
+            elif vid_type == self.MUSIC_VIDEOS:
                 video_type = utils.translate(32517)
             else:
                 video_type = ""
@@ -206,155 +960,253 @@ class Cleaner(object):
         else:
             return ""
 
-    def get_expired_videos(self, option):
+    def get_files(self, option, ids):
         """
-        Find videos in the Kodi library that have been watched.
-
-        Respects any other conditions user enables in the addon's settings.
+        Look up the files of a number of videos in the Kodi library.
 
         :type option: str
-        :param option: The type of videos to find (one of the globals MOVIES, MUSIC_VIDEOS or TVSHOWS).
+        :param option: The type of the videos (one of the globals MOVIES, MUSIC_VIDEOS or TVSHOWS).
+        :type ids: list
+        :param ids: The library ids of the videos.
         :rtype: list
-        :return: A list of expired videos, along with a number of extra attributes specific to the video type.
+        :return: The files of the videos that could be found.
+        """
+        method, id_field, result_field = self.details[option]
+        files = []
+        results = self.rpc.batch([(method, {id_field: library_id, "properties": ["file"]}) for library_id in ids])
+        for library_id, result in zip(ids, results):
+            if isinstance(result, JsonRpcError):
+                debug("Could not find the file of %s %d: %s", option, library_id, result, level=xbmc.LOGWARNING)
+            else:
+                files.append(result[result_field]["file"])
+        return files
+
+    def get_filters(self, option, expiration=True):
         """
+        Build the JSON-RPC filters that select the videos that may be cleaned, based on the addon's settings.
 
+        :type option: str
+        :param option: The type of videos to filter (one of the globals MOVIES, MUSIC_VIDEOS or TVSHOWS).
+        :type expiration: bool
+        :param expiration: (Optional) Whether to include the expiration filter, if enabled. Defaults to True.
+        :rtype: list
+        :return: The filters that must all be met.
+        """
         # A non-exhaustive list of pre-defined filters to use during JSON-RPC requests
         # These are possible conditions that must be met before a video can be deleted
         by_playcount = {"field": "playcount", "operator": "greaterthan", "value": "0"}
-        by_date_played = {"field": "lastplayed", "operator": "notinthelast", "value": "%d" % get_setting(expire_after)}
-        by_minimum_rating = {"field": "rating", "operator": "lessthan", "value": "%d" % get_setting(minimum_rating)}
+        by_date_played = {"field": "lastplayed", "operator": "notinthelast",
+                          "value": "%d" % self.settings[expire_after]}
+        by_minimum_rating = {"field": "rating", "operator": "lessthan", "value": "%d" % self.settings[minimum_rating]}
         by_no_rating = {"field": "rating", "operator": "isnot", "value": "0"}
         by_progress = {"field": "inprogress", "operator": "false", "value": ""}
 
         # link settings and filters together
         settings_and_filters = [
-            (get_setting(enable_expiration), by_date_played),
-            (get_setting(clean_when_low_rated), by_minimum_rating),
-            (get_setting(not_in_progress), by_progress)
+            (self.settings[enable_expiration] and expiration, by_date_played),
+            (self.settings[clean_when_low_rated], by_minimum_rating),
+            (self.settings[not_in_progress], by_progress)
         ]
 
         # Only check not rated videos if checking for video ratings at all
-        if get_setting(clean_when_low_rated):
-            settings_and_filters.append((get_setting(ignore_no_rating), by_no_rating))
+        if self.settings[clean_when_low_rated]:
+            settings_and_filters.append((self.settings[ignore_no_rating], by_no_rating))
 
         enabled_filters = [by_playcount]
         for s, f in settings_and_filters:
             if s and f["field"] in self.supported_filter_fields[option]:
                 enabled_filters.append(f)
 
-        debug("[%s] Filters enabled: %r" % (self.methods[option], enabled_filters))
+        return enabled_filters
 
-        filters = {"and": enabled_filters}
+    def get_expired_videos(self, option, only=None, properties=None):
+        """
+        Find videos in the Kodi library that have been watched.
 
-        request = {
-            "jsonrpc": "2.0",
-            "method": self.methods[option],
-            "params": {
-                "properties": self.properties[option],
-                "filter": filters
-            },
-            "id": 1
-        }
+        Respects any other conditions user enables in the addon's settings.
 
-        rpc_cmd = json.dumps(request)
-        response = xbmc.executeJSONRPC(rpc_cmd)
-        debug("[%s] Response: %r" % (self.methods[option], response))
-        result = json.loads(response)
+        :type option: str
+        :param option: The type of videos to find (one of the globals MOVIES, MUSIC_VIDEOS or TVSHOWS).
+        :type only: list
+        :param only: (Optional) The files of the only videos to consider. Defaults to all videos in the library.
+        :type properties: list
+        :param properties: (Optional) The attributes to retrieve. Defaults to the file and title of the videos.
+        :rtype: generator
+        :return: The expired videos, each a list of a number of attributes specific to the video type.
+        """
+        enabled_filters = self.get_filters(option)
+
+        if only is not None:
+            if not only:
+                return
+            # Kodi cannot filter by full path, so narrow the results down by file name and check the path afterwards
+            names = set(os.path.basename(f) if not f.startswith("stack://") else f for f in only)
+            enabled_filters.append({"or": [{"field": "filename", "operator": "is", "value": n} for n in names]})
+            only = set(only)
+
+        properties = properties or self.properties[option]
+        for video in self.query_videos(option, enabled_filters, properties):
+            if only is None or video["file"] in only:
+                yield [video.get(p) for p in properties]
+
+    def get_delta_videos(self, option):
+        """
+        Find expired videos in the Kodi library, only asking Kodi for videos played since the previous scan.
 
-        try:
-            error = result["error"]
-            debug("An error occurred. %r" % error)
-            return None
-        except KeyError as ke:
-            if "error" in ke:
-                pass  # no error
+        Watched videos that have not expired yet are queued until they are due. Queued videos that are due are checked
+        against all conditions again before they are returned. Every video returned stays queued until it is cleaned.
+
+        :type option: str
+        :param option: The type of videos to find (one of the globals MOVIES, MUSIC_VIDEOS or TVSHOWS).
+        :rtype: generator
+        :return: The expired videos, each a list of a number of attributes specific to the video type.
+        """
+        now = time.time()
+        since = self.watermarks.since(option, now)
+        expiration = self.settings[enable_expiration] and "lastplayed" in self.supported_filter_fields[option]
+        found = set()
+        if since is None:
+            # Every watched video is found again by a full scan, so the queue is rebuilt from scratch
+            self.watermarks.clear(option)
+        else:
+            due = self.watermarks.due(option, now)
+            debug("[%s] Checking %d queued videos that are now due.", self.methods[option], len(due))
+            for video in self.get_expired_videos(option, only=due):
+                found.add(video[0])
+                yield video
+            # Kodi compares dates by day, so videos that expired today may only pass its filters tomorrow
+            missed = [f for f in due if f not in found]
+            if missed:
+                debug("[%s] %d queued videos are not expired according to Kodi yet. Checking again tomorrow.",
+                      self.methods[option], len(missed))
+                self.watermarks.postpone(option, missed, next_day(now))
+
+        enabled_filters, properties = self.get_delta_filters(option, since)
+        if since:
+            debug("[%s] Only retrieving videos played after %s.", self.methods[option], since)
+        else:
+            debug("[%s] Retrieving all videos to rebuild the watermark.", self.methods[option])
+
+        latest = None
+        for video in self.query_videos(option, enabled_filters, properties):
+            lastplayed = video.get("lastplayed")
+            if since and lastplayed and lastplayed <= since or video["file"] in found:
+                continue
+            if lastplayed and (latest is None or lastplayed > latest):
+                latest = lastplayed
+
+            played = parse_lastplayed(lastplayed)
+            if expiration and played is not None and played + self.settings[expire_after] * 86400 > now:
+                debug("%r has not expired yet and is queued.", video["file"])
+                self.watermarks.schedule(option, video["file"], video[self.properties[option][1]],
+                                         played + self.settings[expire_after] * 86400)
             else:
-                raise
+                # The watermark passes this video, so keep it queued in case it is skipped or cannot be cleaned now
+                self.watermarks.schedule(option, video["file"], video[self.properties[option][1]], now)
+                yield [video[p] for p in self.properties[option]]
+
+        self.watermarks.advance(option, latest, full_scan=since is None, now=now)
+        self.save_watermarks()
+        debug("[%s] Watermark is now %s, %d videos are queued.", self.methods[option],
+              self.watermarks.since(option, now), self.watermarks.pending(option))
 
-        debug("Building list of expired videos")
-        expired_videos = []
-        response = result["result"]
+    def save_watermarks(self):
         try:
-            debug("Found %d watched %s matching your conditions" % (response["limits"]["total"], option))
-            debug("JSON Response: " + str(response))
-            for video in response[option]:
-                # Gather all properties and add it to this video's information
-                temp = []
-                for p in self.properties[option]:
-                    temp.append(video[p])
-                expired_videos.append(temp)
-        except KeyError as ke:
-            if option in ke:
-                pass  # no expired videos found
-            else:
-                debug("KeyError: %r not found" % ke, xbmc.LOGWARNING)
-                debug("%r" % response, xbmc.LOGWARNING)
-                raise
-        finally:
-            debug("Expired videos: " + str(expired_videos))
-            return expired_videos
+            self.watermarks.save()
+        except (IOError, OSError) as err:
+            debug("Could not save the watermarks: %s", err, level=xbmc.LOGERROR)
 
-    def is_excluded(self, full_path):
-        """Check if the file path is part of the excluded sources.
+    def get_delta_filters(self, option, since):
+        """
+        Build the JSON-RPC filters and properties used to find the videos played since the previous scan.
 
-        :type full_path: str
-        :param full_path: the path to the file that should be checked for exclusion
-        :rtype: bool
-        :return: True if the path matches a user-set excluded path, False otherwise.
+        :type option: str
+        :param option: The type of videos to find (one of the globals MOVIES, MUSIC_VIDEOS or TVSHOWS).
+        :type since: str
+        :param since: The watermark of the video type, or None to retrieve all videos.
+        :rtype: (list, list)
+        :return: The filters that must all be met, and the properties to retrieve.
         """
-        if not get_setting(exclusion_enabled):
-            debug("Path exclusion is disabled.")
-            return False
-        elif not full_path:
-            debug("File path is empty and cannot be checked for exclusions")
-            return False
+        enabled_filters = self.get_filters(option, expiration=False)
+        if since:
+            # Kodi compares dates by day, so videos played earlier that day are skipped afterwards
+            enabled_filters.append({"field": "lastplayed", "operator": "after", "value": since.split(" ")[0]})
+        return enabled_filters, self.properties[option] + ["lastplayed"]
 
-        exclusions = map(get_setting, [exclusion1, exclusion2, exclusion3])
+    def page_request(self, option, filters, properties, start):
+        """
+        Build the JSON-RPC request for a single page of videos.
 
-        if r"://" in full_path:
-            debug("Detected a network path")
-            pattern = re.compile("(?:smb|afp|nfs)://(?:(?:.+):(?:.+)@)?(?P<tail>.*)$", flags=re.U | re.I)
+        :rtype: (str, dict)
+        :return: The method and parameters of the request.
+        """
+        page_size = max(1, int(self.settings[query_page_size]))
+        return self.methods[option], {
+            "properties": properties,
+            "filter": {"and": filters},
+            "limits": {"start": start, "end": start + page_size}
+        }
+
+    def query_videos(self, option, filters, properties):
+        """
+        Retrieve videos from the Kodi library that match the given filters.
 
-            debug("Converting excluded network paths for easier comparison")
-            normalized_exclusions = []
-            for ex in exclusions:
-                # Strip everything but the folder structure
-                try:
-                    if ex and r"://" in ex:
-                        # Only normalize non-empty excluded paths
-                        normalized_exclusions.append(pattern.match(ex).group("tail").lower())
-                except (AttributeError, IndexError, KeyError) as err:
-                    debug("Could not parse the excluded network path %r\n%s" % (ex, err), xbmc.LOGWARNING)
-                    return True
+        Videos are requested from Kodi in pages of a fixed size and yielded as soon as each page arrives, so memory use
+        does not grow with the size of the library. The page size can be configured via the addon settings.
+
+        :type option: str
+        :param option: The type of videos to find (one of the globals MOVIES, MUSIC_VIDEOS or TVSHOWS).
+        :type filters: list
+        :param filters: The filters that must all be met.
+        :type properties: list
+        :param properties: The properties to retrieve for every video.
+        :rtype: generator
+        :return: The videos, each a dict of the requested properties.
+        """
+        debug("[%s] Filters enabled: %r", self.methods[option], filters)
 
-            debug("Conversion result: %r" % normalized_exclusions)
+        page_size = max(1, int(self.settings[query_page_size]))
+        start = 0
+        found = 0
 
-            debug("Proceeding to match a file with the exclusion paths")
-            debug("The file to match is %r" % full_path)
-            result = pattern.match(full_path)
+        while True:
+            try:
+                response = self.rpc.call(*self.page_request(option, filters, properties, start))
+            except JsonRpcError as err:
+                debug("An error occurred. %s", err)
+                return
+            debug("[%s] Response for videos %d to %d: %r", self.methods[option], start, start + page_size, response)
 
             try:
-                debug("Converting file path for easier comparison.")
-                converted_path = result.group("tail").lower()
-                debug("Result: %r" % converted_path)
-                for ex in normalized_exclusions:
-                    debug("Checking against exclusion %r." % ex)
-                    if converted_path.startswith(ex):
-                        debug("File %r matches excluded path %r." % (converted_path, ex))
-                        return True
-
-            except (AttributeError, IndexError, KeyError) as err:
-                debug("Error converting %r. No files will be deleted.\n%s" % (full_path, err), xbmc.LOGWARNING)
-                return True
-        else:
-            debug("Detected a local path")
-            for ex in exclusions:
-                if ex and full_path.startswith(ex):
-                    debug("File %r matches excluded path %r." % (full_path, ex))
-                    return True
+                total = response["limits"]["total"]
+                if start == 0:
+                    debug("Found %d watched %s matching your conditions", total, option)
+                page = response.get(option, [])
+            except KeyError as ke:
+                debug("KeyError: %r not found", ke, level=xbmc.LOGWARNING)
+                debug("%r", response, level=xbmc.LOGWARNING)
+                raise
 
-        debug("No match was found with an excluded path.")
-        return False
+            for video in page:
+                found += 1
+                yield video
+
+            # Results are requested in fixed windows, so only a single page is kept in memory at any time
+            start += page_size
+            if not page or start >= total:
+                break
+
+        debug("Finished retrieving %d %s", found, option)
+
+    def is_excluded(self, full_path):
+        """Check if the file path is part of the excluded sources.
+
+        :type full_path: str
+        :param full_path: the path to the file that should be checked for exclusion
+        :rtype: bool
+        :return: True if the path matches a user-set excluded path, False otherwise.
+        """
+        return self.exclusions.is_excluded(full_path)
 
     def unstack(self, path):
         """Unstack path if it is a stacked movie. See http://kodi.wiki/view/File_stacking for more info.
@@ -367,10 +1219,10 @@ class Cleaner(object):
         if isinstance(path, unicode):
             path = path.encode("utf-8")
         if path.startswith("stack://"):
-            debug("Unstacking %r." % path)
+            debug("Unstacking %r.", path)
             return path.replace("stack://", "").split(" , ")
         else:
-            debug("Unstacking %r is not needed." % path)
+            debug("Unstacking %r is not needed.", path)
             return [path]
 
     def get_stack_bare_title(self, filenames):
@@ -403,7 +1255,7 @@ class Cleaner(object):
         :rtype: bool
         :return: True if (at least one) file was deleted successfully, False otherwise.
         """
-        debug("Attempting to delete %r" % location)
+        debug("Attempting to delete %r", location)
 
         paths = self.unstack(location)
         success = []
@@ -413,76 +1265,49 @@ class Cleaner(object):
             return False
 
         for p in paths:
-            if xbmcvfs.exists(p):
-                success.append(bool(xbmcvfs.delete(p)))
+            if self.fs.exists(p):
+                success.append(bool(self.fs.delete(p)))
             else:
-                debug("File %r no longer exists." % p, xbmc.LOGERROR)
+                debug("File %r no longer exists.", p, level=xbmc.LOGERROR)
                 success.append(False)
 
         return any(success)
 
-    def delete_empty_folders(self, location):
-        """
-        Delete the folder if it is empty. Presence of custom file extensions can be ignored while scanning.
+    def find_related_files(self, source):
+        """Find the files related to another file.
 
-        To achieve this, edit the ignored file types setting in the addon settings.
+        Related files are files that only differ by extension, or that share a prefix in case of stacked movies.
 
-        Example:
-            success = delete_empty_folders(path)
+        Examples of related files include NFO files, thumbnails, subtitles, fanart, etc.
 
-        :type location: str
-        :param location: The path to the folder to be deleted.
-        :rtype: bool
-        :return: True if the folder was deleted successfully, False otherwise.
+        :type source: str
+        :param source: Location of the file whose related files should be found.
+        :rtype: list
+        :return: The paths of the related files, not including the file itself.
         """
-        if not get_setting(delete_folders):
-            debug("Deleting of empty folders is disabled.")
-            return False
-
-        folder = self.unstack(location)[0]  # Stacked paths should have the same parent, use any
-        debug("Checking if %r is empty" % folder)
-        ignored_file_types = [file_ext.strip() for file_ext in get_setting(ignore_extensions).split(",")]
-        debug("Ignoring file types %r" % ignored_file_types)
-
-        subfolders, files = xbmcvfs.listdir(folder)
-        debug("Contents of %r:\nSubfolders: %r\nFiles: %r" % (folder, subfolders, files))
-
-        empty = True
-        try:
-            for f in files:
-                _, ext = os.path.splitext(f)
-                if ext and not ext in ignored_file_types:  # ensure f is not a folder and its extension is not ignored
-                    debug("Found non-ignored file type %r" % ext)
-                    empty = False
-                    break
-        except OSError as oe:
-            debug("Error deriving file extension. Errno " + str(oe.errno), xbmc.LOGERROR)
-            empty = False
-
-        # Only delete directories if we found them to be empty (containing no files or filetypes we ignored)
-        if empty:
-            debug("Directory is empty and will be removed")
-            try:
-                # Recursively delete any subfolders
-                for f in subfolders:
-                    debug("Deleting file at " + str(os.path.join(folder, f)))
-                    self.delete_empty_folders(os.path.join(folder, f))
-
-                # Delete any files in the current folder
-                for f in files:
-                    debug("Deleting file at " + str(os.path.join(folder, f)))
-                    xbmcvfs.delete(os.path.join(folder, f))
-
-                # Finally delete the current folder
-                return xbmcvfs.rmdir(folder)
-            except OSError as oe:
-                debug("An exception occurred while deleting folders. Errno " + str(oe.errno), xbmc.LOGERROR)
-                return False
+        path_list = self.unstack(source)
+        path, name = os.path.split(path_list[0])  # Because stacked movies are in the same folder, only check one
+        if source.startswith("stack://"):
+            name = self.get_stack_bare_title(path_list)
         else:
-            debug("Directory is not empty and will not be removed")
-            return False
+            name, ext = os.path.splitext(name)
 
-    def clean_related_files(self, source, dest_folder=None):
+        if isinstance(path, unicode):
+            path = path.encode("utf-8")
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        path_list = [p.encode("utf-8") if isinstance(p, unicode) else p for p in path_list]
+
+        debug("Attempting to match related files in %r with prefix %r", path, name)
+        related = []
+        for extra_file in self.fs.prefixed(path, name):
+            debug("%r starts with %r.", extra_file, name)
+            extra_file_path = os.path.join(path, extra_file)
+            if extra_file_path not in path_list:
+                related.append(extra_file_path)
+        return related
+
+    def clean_related_files(self, source, dest_folder=None, related=None, rename=None):
         """Clean files related to another file based on the user's preferences.
 
         Related files are files that only differ by extension, or that share a prefix in case of stacked movies.
@@ -493,43 +1318,32 @@ class Cleaner(object):
         :param source: Location of the file whose related files should be cleaned.
         :type dest_folder: str
         :param dest_folder: (Optional) The folder where related files should be moved to. Not needed when deleting.
+        :type related: list
+        :param related: (Optional) The related files, if they were already found. Defaults to searching for them.
+        :type rename: bool
+        :param rename: (Optional) False to copy the related files right away, as they are known to be on another device
+            than the destination. Defaults to trying to rename them first.
         """
-        if get_setting(clean_related):
+        if self.settings[clean_related]:
             debug("Cleaning related files.")
 
-            path_list = self.unstack(source)
-            path, name = os.path.split(path_list[0])  # Because stacked movies are in the same folder, only check one
-            if source.startswith("stack://"):
-                name = self.get_stack_bare_title(path_list)
-            else:
-                name, ext = os.path.splitext(name)
-
-            debug("Attempting to match related files in %r with prefix %r" % (path, name))
-            for extra_file in xbmcvfs.listdir(path)[1]:
-                if isinstance(path, unicode):
-                    path = path.encode("utf-8")
-                if isinstance(extra_file, unicode):
-                    extra_file = extra_file.encode("utf-8")
-                if isinstance(name, unicode):
-                    name = name.encode("utf-8")
-
-                if extra_file.startswith(name):
-                    debug("%r starts with %r." % (extra_file, name))
-                    extra_file_path = os.path.join(path, extra_file)
-                    if get_setting(cleaning_type) == self.CLEANING_TYPE_DELETE:
-                        if extra_file_path not in path_list:
-                            debug("Deleting %r." % extra_file_path)
-                            xbmcvfs.delete(extra_file_path)
-                    elif get_setting(cleaning_type) == self.CLEANING_TYPE_MOVE:
-                        new_extra_path = os.path.join(dest_folder, os.path.basename(extra_file))
-                        if new_extra_path not in path_list:
-                            debug("Moving %r to %r." % (extra_file_path, new_extra_path))
-                            xbmcvfs.rename(extra_file_path, new_extra_path)
+            if related is None:
+                related = self.find_related_files(source)
+            for extra_file_path in related:
+                if self.settings[cleaning_type] == self.CLEANING_TYPE_DELETE:
+                    debug("Deleting %r.", extra_file_path)
+                    self.fs.delete(extra_file_path)
+                elif self.settings[cleaning_type] == self.CLEANING_TYPE_MOVE:
+                    new_extra_path = os.path.join(dest_folder, os.path.basename(extra_file_path))
+                    debug("Moving %r to %r.", extra_file_path, new_extra_path)
+                    if rename is False or not self.fs.rename(extra_file_path, new_extra_path):
+                        if self.copier.copy(extra_file_path, new_extra_path):
+                            self.fs.delete(extra_file_path)
             debug("Finished searching for related files.")
         else:
             debug("Cleaning of related files is disabled.")
 
-    def move_file(self, source, dest_folder):
+    def move_file(self, source, dest_folder, rename=None):
         """Move a file to a new destination. Will create destination if it does not exist.
 
         Example:
@@ -539,6 +1353,9 @@ class Cleaner(object):
         :param source: the source path (absolute)
         :type dest_folder: str
         :param dest_folder: the destination path (absolute)
+        :type rename: bool
+        :param rename: (Optional) False to copy the file right away, as it is known to be on another device than the
+            destination. Defaults to trying to rename the file first.
         :rtype: int
         :return: 1 if (all stacked) files were moved, 0 if not, -1 if errors occurred
         """
@@ -555,59 +1372,62 @@ class Cleaner(object):
             return 0
 
         for p in paths:
-            debug("Attempting to move %r to %r." % (p, dest_folder))
-            if xbmcvfs.exists(p):
-                if not xbmcvfs.exists(dest_folder):
-                    if xbmcvfs.mkdirs(dest_folder):
-                        debug("Created destination %r." % dest_folder)
+            debug("Attempting to move %r to %r.", p, dest_folder)
+            if self.fs.exists(p):
+                if not self.fs.exists(dest_folder):
+                    if self.fs.mkdirs(dest_folder):
+                        debug("Created destination %r.", dest_folder)
                     else:
-                        debug("Destination %r could not be created." % dest_folder, xbmc.LOGERROR)
+                        debug("Destination %r could not be created.", dest_folder, level=xbmc.LOGERROR)
                         return -1
 
                 new_path = os.path.join(dest_folder, os.path.basename(p))
 
                 # TODO: This check might not make sense after ensuring the folder exists
-                if xbmcvfs.exists(new_path):
+                if self.fs.exists(new_path):
                     debug("A file with the same name already exists in the holding folder. Checking file sizes.")
-                    existing_file = xbmcvfs.File(new_path)
-                    file_to_move = xbmcvfs.File(p)
-                    if file_to_move.size() > existing_file.size():
+                    if self.fs.size(p) > self.fs.size(new_path):
                         debug("This file is larger than the existing file. Replacing it with this one.")
-                        existing_file.close()
-                        file_to_move.close()
-                        if bool(xbmcvfs.delete(new_path) and bool(xbmcvfs.rename(p, new_path))):
+                        if bool(self.fs.delete(new_path) and bool(self.fs.rename(p, new_path))):
                             files_moved_successfully += 1
                         else:
                             return -1
                     else:
                         debug("This file isn't larger than the existing file. Deleting it instead of moving.")
-                        existing_file.close()
-                        file_to_move.close()
-                        if bool(xbmcvfs.delete(p)):
+                        if bool(self.fs.delete(p)):
                             files_moved_successfully += 1
                         else:
                             return -1
                 else:
-                    debug("Moving %r to %r." % (p, new_path))
-                    move_success = bool(xbmcvfs.rename(p, new_path))
+                    debug("Moving %r to %r.", p, new_path)
+                    move_success = rename is not False and bool(self.fs.rename(p, new_path))
                     copy_success, delete_success = False, False
                     if not move_success:
-                        debug("Move failed, falling back to copy and delete.", xbmc.LOGWARNING)
-                        copy_success = bool(xbmcvfs.copy(p, new_path))
+                        if rename is False:
+                            debug("%r is on another device than the destination. Copying and deleting.", p)
+                        else:
+                            debug("Move failed, falling back to copy and delete.", level=xbmc.LOGWARNING)
+                        copy_success = self.copier.copy(p, new_path)
                         if copy_success:
                             debug("Copied successfully, attempting delete of source file.")
-                            delete_success = bool(xbmcvfs.delete(p))
+                            delete_success = bool(self.fs.delete(p))
                             if not delete_success:
-                                debug("Could not remove source file. Please remove the file manually.", xbmc.LOGWARNING)
+                                debug("Could not remove source file. Please remove the file manually.",
+                                      level=xbmc.LOGWARNING)
                         else:
-                            debug("Copying failed, please make sure you have appropriate permissions.", xbmc.LOGFATAL)
+                            debug("Copying failed, please make sure you have appropriate permissions.",
+                                  level=xbmc.LOGFATAL)
                             return -1
 
                     if move_success or (copy_success and delete_success):
                         files_moved_successfully += 1
 
+            elif self.fs.exists(os.path.join(dest_folder, os.path.basename(p))):
+                # This part of a stack was moved by an earlier run that was interrupted
+                debug("File %r was already moved.", p)
+                files_moved_successfully += 1
             else:
-                debug("File %r is no longer available." % p, xbmc.LOGWARNING)
+                debug("File %r is no longer available.", p, level=xbmc.LOGWARNING)
 
         return 1 if len(paths) == files_moved_successfully else -1
 
@@ -615,6 +1435,10 @@ if __name__ == "__main__":
     cleaner = Cleaner()
     if get_setting(default_action) == cleaner.DEFAULT_ACTION_LOG:
         xbmc.executescript("special://home/addons/script.filecleaner/viewer.py")
+    elif get_setting(default_action) == cleaner.DEFAULT_ACTION_PREVIEW:
+        videos, operations, report = cleaner.preview()
+        xbmcgui.Dialog().ok(utils.translate(32525), utils.translate(32526) % (videos, operations),
+                            utils.translate(32527), report)
     else:
         results = cleaner.clean_all()
         if results:
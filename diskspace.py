@@ -0,0 +1,363 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import threading
+import time
+
+import xbmc
+import xbmcvfs
+import utils
+
+DEFAULT_TTL = 60  # Seconds before the free space of a volume is checked again
+MOUNTS_FILE = "/proc/mounts"
+share_pattern = re.compile(r"^(?P<type>smb|nfs|afp)://(?:(?P<user>.+):(?P<pass>.+)@)?(?P<host>.+?)/(?P<share>[^/]+)"
+                           r"(?P<rest>.*)$", flags=re.I | re.U)
+
+
+def unescape_mount(field):
+    """
+    Decode the octal escapes the kernel uses for spaces and other special characters in ``/proc/mounts``.
+
+    :type field: str
+    :param field: A device or mount point as listed in ``/proc/mounts``.
+    :rtype: str
+    :return: The decoded field.
+    """
+    return re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), field)
+
+
+def read_mounts(mounts_file=MOUNTS_FILE):
+    """
+    Read the file systems that are currently mounted.
+
+    :type mounts_file: str
+    :param mounts_file: (Optional) The file to read the mounts from. Defaults to ``/proc/mounts``.
+    :rtype: list
+    :return: Tuples of the device, mount point and file system type of every mount. Empty if the file is unavailable.
+    """
+    mounts = []
+    try:
+        with open(mounts_file, "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3:
+                    mounts.append((unescape_mount(fields[0]), unescape_mount(fields[1]), fields[2]))
+    except (IOError, OSError) as err:
+        utils.debug("Could not read the mounted file systems from %r: %s", mounts_file, err, level=xbmc.LOGWARNING)
+    return mounts
+
+
+def is_below(path, folder):
+    """Check whether a path is a folder or is inside of it, comparing whole path components only. Both slashes and
+    backslashes are accepted as path separators, as used on Windows."""
+    path, folder = path.replace("\\", "/"), folder.replace("\\", "/").rstrip("/")
+    return path == folder or path.startswith(folder + "/") or not folder
+
+
+class DiskSpaceMonitor(object):
+    """
+    The DiskSpaceMonitor determines the free space on the volumes the library is stored on.
+
+    Every path is first resolved to the volume it resides on: the mount point of a local path, or the share of a
+    network path. Network shares are looked up in the list of mounted file systems on Linux, so their free space can be
+    checked through the local mount. The free space of each volume is cached for a number of seconds, so checking many
+    paths on the same volume only queries the operating system once.
+
+    *Example*
+      ``percentage = DiskSpaceMonitor().free_percentage("smb://nas/videos/movie.mkv")``
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, mounts_file=MOUNTS_FILE):
+        self.ttl = ttl
+        self.mounts_file = mounts_file
+        self.windows = xbmc.getCondVisibility("System.Platform.Windows")
+        self.mounts = None
+        self.usages = {}
+        self.lock = threading.Lock()
+
+    def get_mounts(self):
+        """The mounted file systems, deepest mount point first. Read once per monitor."""
+        if self.mounts is None:
+            self.mounts = sorted(read_mounts(self.mounts_file), key=lambda mount: len(mount[1]), reverse=True)
+        return self.mounts
+
+    def resolve(self, path):
+        """
+        Find the volume a path resides on, and a local path through which its free space can be checked.
+
+        :type path: str
+        :param path: Any path of any depth on the volume.
+        :rtype: (str, str)
+        :return: A key identifying the volume, and the path to check. The path to check is None if the volume is not
+            accessible through the local file system.
+        """
+        if r"://" in path:
+            match = share_pattern.match(path)
+            if not match:
+                utils.debug("Could not extract required data from %r", path, level=xbmc.LOGERROR)
+                return path, None
+            share = match.groupdict()
+            volume = "%s://%s/%s" % (share["type"].lower(), share["host"].lower(), share["share"])
+            if self.windows:
+                # Windows can check the free space of a share through its UNC path
+                return volume, os.path.normcase(r"\\" + share["host"] + os.sep + share["share"])
+            return volume, self.find_mounted_share(share)
+
+        if self.windows:
+            return os.path.splitdrive(os.path.abspath(path))[0].upper() or path, path
+
+        path = os.path.normpath(path)
+        for device, mount_point, fs_type in self.get_mounts():
+            if is_below(path, mount_point):
+                return mount_point, path
+        return path, path
+
+    def find_mounted_share(self, share):
+        """
+        Look for a network share among the file systems mounted on this system.
+
+        :type share: dict
+        :param share: The protocol, host, share and the rest of the path, as matched by ``share_pattern``.
+        :rtype: str
+        :return: The local path of the share, or None if it is not mounted.
+        """
+        host, name, rest = share["host"].lower(), share["share"], share["rest"]
+        for device, mount_point, fs_type in self.get_mounts():
+            if share["type"].lower() == "smb" and fs_type in ("cifs", "smb3", "smbfs"):
+                # CIFS devices look like //host/share
+                if device.lower().rstrip("/") == "//%s/%s" % (host, name.lower()):
+                    return mount_point.rstrip("/") + rest
+            elif share["type"].lower() == "nfs" and fs_type.startswith("nfs"):
+                # NFS devices look like host:/export, where the export may span several path components
+                device_host, _, export = device.partition(":")
+                if device_host.lower() == host and is_below("/" + name + rest, export):
+                    return mount_point.rstrip("/") + ("/" + name + rest)[len(export.rstrip("/")):]
+        return None
+
+    def volume(self, path):
+        """
+        Identify the volume a path resides on.
+
+        :type path: str
+        :param path: Any path of any depth on the volume.
+        :rtype: str
+        :return: The mount point of a local path, or the share of a network path.
+        """
+        return self.resolve(path)[0]
+
+    def usage(self, path):
+        """
+        Determine the free space on a volume, as well as its size.
+
+        :type path: str
+        :param path: Any path of any depth on the volume.
+        :rtype: (int, int)
+        :return: The number of free bytes and the total number of bytes on the volume; None if errors occur.
+        """
+        volume, local_path = self.resolve(path)
+        now = time.time()
+        with self.lock:
+            cached = self.usages.get(volume)
+            if cached is not None and now - cached[0] < self.ttl:
+                return cached[1]
+
+        usage = self.measure(path, local_path)
+        with self.lock:
+            self.usages[volume] = now, usage
+        return usage
+
+    def measure(self, path, local_path):
+        """
+        Ask the operating system for the free space on a volume, bypassing the cache.
+
+        :type path: str
+        :param path: The path as configured by the user.
+        :type local_path: str
+        :param local_path: The path through which the free space can be checked, or None if there is none.
+        :rtype: (int, int)
+        :return: The number of free bytes and the total number of bytes on the volume; None if errors occur.
+        """
+        utils.debug("Checking for disk space on path: %r", path)
+        if not xbmcvfs.exists(path):
+            utils.notify(utils.translate(32513), 15000, level=xbmc.LOGERROR)
+            return None
+        if local_path is None:
+            # TODO: Network shares that are not mounted cannot be checked yet
+            utils.notify(utils.translate(32524), 15000, level=xbmc.LOGERROR)
+            return None
+
+        if self.windows:
+            from ctypes import byref, c_ulonglong, c_wchar_p, windll  # Only available, and only needed, on Windows
+
+            if not isinstance(local_path, unicode):
+                local_path = local_path.decode("mbcs")
+            bytes_total = c_ulonglong(0)
+            bytes_free = c_ulonglong(0)
+            windll.kernel32.GetDiskFreeSpaceExW(c_wchar_p(local_path), byref(bytes_free), byref(bytes_total), None)
+            usage = bytes_free.value, bytes_total.value
+        else:
+            try:
+                diskstats = os.statvfs(local_path)
+            except OSError as ose:
+                # TODO: Linux cannot check remote share disk space yet
+                utils.notify(utils.translate(32524), 15000, level=xbmc.LOGERROR)
+                utils.debug("Error accessing %r: %r", local_path, ose)
+                return None
+            usage = diskstats.f_bfree * diskstats.f_frsize, diskstats.f_blocks * diskstats.f_frsize
+
+        utils.debug("Hard disk check results for %r: %d bytes free, %d bytes total", local_path, usage[0], usage[1])
+        return usage
+
+    def free_percentage(self, path):
+        """
+        Determine the percentage of free space on a volume.
+
+        :type path: str
+        :param path: Any path of any depth on the volume.
+        :rtype: float
+        :return: The percentage of free space on the volume; 100% if errors occur.
+        """
+        percentage = float(100)
+        usage = self.usage(path)
+        if usage is not None:
+            try:
+                percentage = float(usage[0]) / float(usage[1]) * 100
+            except ZeroDivisionError:
+                utils.notify(utils.translate(32511), 15000, level=xbmc.LOGERROR)
+        utils.debug("Free space: %0.2f%%", percentage)
+        return percentage
+
+    def bytes_to_free(self, path, threshold):
+        """
+        Determine how much space must be freed to get a volume back above a percentage of free space.
+
+        :type path: str
+        :param path: Any path of any depth on the volume.
+        :type threshold: int
+        :param threshold: The minimum percentage of free space.
+        :rtype: int
+        :return: The number of bytes to free; 0 if disk space is not low or if errors occur.
+        """
+        usage = self.usage(path)
+        if usage is None or not usage[1]:
+            return 0
+        free, total = usage
+        target = total * threshold / 100.0
+        return int(target - free) + 1 if free <= target else 0
+
+    def invalidate(self, path=None):
+        """
+        Forget the cached free space of a volume, for example after files were removed from it.
+
+        :type path: str
+        :param path: (Optional) Any path on the volume. Defaults to forgetting all volumes.
+        """
+        with self.lock:
+            if path is None:
+                self.usages.clear()
+            else:
+                self.usages.pop(self.volume(path), None)
+
+
+class DeviceMap(object):
+    """
+    The DeviceMap tells whether two paths reside on the same storage device, so a file can be renamed from one to the
+    other instead of being copied.
+
+    Local paths are identified by the device number of the file system they are on, network paths by their protocol,
+    host and share. Every path is identified through the library root it is in, so the device of each root is only
+    looked up once. Paths outside of all roots are identified through their own folder.
+
+    *Example*
+      ``if DeviceMap(roots).same_device(source, destination): rename(source, destination)``
+    """
+
+    def __init__(self, roots=()):
+        """
+        :type roots: list
+        :param roots: (Optional) The folders to identify paths by, such as the library sources and the holding folder.
+        """
+        self.roots = sorted(set(root.rstrip("/\\") for root in roots if root), key=len, reverse=True)
+        self.devices = {}
+        self.lock = threading.Lock()
+
+    def root_of(self, path):
+        """The deepest root a path is in, or the folder of the path if it is in none of them."""
+        for root in self.roots:
+            if is_below(path, root):
+                return root
+        return os.path.dirname(path.rstrip("/\\"))
+
+    def device(self, path):
+        """
+        Identify the storage device a path resides on.
+
+        :type path: str
+        :param path: The path to identify. It does not have to exist.
+        :rtype: str
+        :return: An identifier that is the same for all paths on the same device, or None if it cannot be determined.
+        """
+        root = self.root_of(path)
+        with self.lock:
+            if root in self.devices:
+                return self.devices[root]
+        device = self.identify(root)
+        utils.debug("Paths in %r are on device %r.", root, device)
+        with self.lock:
+            self.devices[root] = device
+        return device
+
+    @staticmethod
+    def identify(path):
+        """Look up the device of a path, or of the nearest of its parents that exists."""
+        if r"://" in path:
+            match = share_pattern.match(path + "/")
+            if not match:
+                return None
+            return "%s://%s/%s" % (match.group("type").lower(), match.group("host").lower(), match.group("share"))
+
+        if os.name == "nt":
+            return os.path.splitdrive(os.path.abspath(path))[0].upper() or None
+        while path:
+            try:
+                return "dev:%d" % os.stat(path).st_dev
+            except OSError:
+                parent = os.path.dirname(path)
+                if parent == path:
+                    return None
+                path = parent
+        return None
+
+    def same_device(self, source, destination):
+        """
+        Check whether a file can be renamed to a destination instead of copied.
+
+        :type source: str
+        :param source: The file to move.
+        :type destination: str
+        :param destination: The folder to move it to.
+        :rtype: bool
+        :return: True if both are on the same device, False if they are not, or None if this cannot be determined.
+        """
+        source_device, destination_device = self.device(source), self.device(destination)
+        if source_device is None or destination_device is None:
+            return None
+        return source_device == destination_device
+
+
+_monitor = None
+
+
+def get_monitor():
+    """
+    Get the disk space monitor shared by everything running in this Kodi process.
+
+    :rtype: DiskSpaceMonitor
+    :return: The monitor.
+    """
+    global _monitor
+    if _monitor is None:
+        _monitor = DiskSpaceMonitor()
+    return _monitor
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import re
+
+import xbmc
+from utils import debug
+from settings import exclusion_enabled, exclusion1, exclusion2, exclusion3, extra_exclusions
+
+network_path_pattern = re.compile(r"(?:smb|afp|nfs)://(?:(?:.+):(?:.+)@)?(?P<tail>.*)$", flags=re.U | re.I)
+
+
+def decode(path):
+    """
+    Decode a UTF-8 encoded path to unicode, so paths from the settings and from the library compare equally.
+
+    :type path: str | unicode
+    :param path: The path to decode.
+    :rtype: unicode
+    :return: The decoded path.
+    """
+    if isinstance(path, str):
+        return path.decode("utf-8")
+    return path
+
+
+def get_exclusions(settings):
+    """
+    Gather all excluded paths from the settings: the three exclusion paths plus any number of additional paths.
+
+    :type settings: Snapshot
+    :param settings: The settings snapshot to read the exclusions from.
+    :rtype: list
+    :return: All non-empty excluded paths.
+    """
+    exclusions = [settings[ex] for ex in (exclusion1, exclusion2, exclusion3)] + settings[extra_exclusions]
+    return [ex for ex in exclusions if ex]
+
+
+class PrefixTrie(object):
+    """
+    A character trie that checks whether any of its stored prefixes is a prefix of a given string.
+
+    A lookup walks the string at most once, so it costs O(length of the string) regardless of the number of prefixes.
+    """
+    END = None
+
+    def __init__(self, prefixes=()):
+        self.root = {}
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[self.END] = prefix
+
+    def match(self, text):
+        """
+        Find the shortest stored prefix of a string.
+
+        :type text: unicode
+        :param text: The string to match.
+        :rtype: unicode | None
+        :return: The matching prefix, or None if no stored prefix matches.
+        """
+        node = self.root
+        if self.END in node:
+            return node[self.END]
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                return None
+            if self.END in node:
+                return node[self.END]
+        return None
+
+
+class ExclusionMatcher(object):
+    """
+    The ExclusionMatcher checks whether files are located on one of the paths the user excluded from cleaning.
+
+    All excluded paths are normalized once when the matcher is built. Network paths are compared without their
+    protocol and credentials, ignoring case. Local paths are compared as is.
+
+    *Example*
+      ``excluded = ExclusionMatcher(["smb://nas/videos/kids"]).is_excluded(path)``
+    """
+
+    def __init__(self, exclusions, enabled=True):
+        self.enabled = enabled
+        self.invalid = False
+        self.local = PrefixTrie()
+        self.network = PrefixTrie()
+
+        for ex in exclusions:
+            ex = decode(ex)
+            self.local.add(ex)
+            if r"://" in ex:
+                match = network_path_pattern.match(ex)
+                if match:
+                    self.network.add(match.group("tail").lower())
+                else:
+                    debug("Could not parse the excluded network path %r", ex, level=xbmc.LOGWARNING)
+                    self.invalid = True
+
+        debug("Built exclusion matcher for %d paths", len(exclusions))
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Build a matcher from the exclusions set through the addon settings.
+
+        :type settings: Snapshot
+        :param settings: The settings snapshot to read the exclusions from.
+        :rtype: ExclusionMatcher
+        :return: A matcher for all excluded paths, disabled if exclusions are disabled in the settings.
+        """
+        if not settings[exclusion_enabled]:
+            return cls([], enabled=False)
+        return cls(get_exclusions(settings))
+
+    def is_excluded(self, full_path):
+        """
+        Check if the file path is part of the excluded sources.
+
+        :type full_path: str
+        :param full_path: the path to the file that should be checked for exclusion
+        :rtype: bool
+        :return: True if the path matches a user-set excluded path, False otherwise.
+        """
+        if not self.enabled:
+            debug("Path exclusion is disabled.")
+            return False
+        elif not full_path:
+            debug("File path is empty and cannot be checked for exclusions")
+            return False
+
+        full_path = decode(full_path)
+        if r"://" in full_path:
+            if self.invalid:
+                debug("An excluded network path could not be parsed. No files will be deleted.", level=xbmc.LOGWARNING)
+                return True
+
+            match = network_path_pattern.match(full_path)
+            if not match:
+                debug("Error converting %r. No files will be deleted.", full_path, level=xbmc.LOGWARNING)
+                return True
+            excluded_by = self.network.match(match.group("tail").lower())
+        else:
+            excluded_by = self.local.match(full_path)
+
+        if excluded_by is not None:
+            debug("File %r matches excluded path %r.", full_path, excluded_by)
+            return True
+
+        debug("No match was found with an excluded path.")
+        return False
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import Counter
+
+from utils import debug
+
+BYTES = "bytes"
+OPERATIONS = "operations"
+MEGABYTE = 1024 * 1024
+WAIT_STEP = 1  # Maximum number of seconds to wait before checking again whether playback is still going on
+
+
+class TokenBucket(object):
+    """
+    The TokenBucket limits the rate at which something is used, such as bytes or operations per second.
+
+    Tokens are added at a fixed rate, up to a burst of one second's worth. Taking more tokens than there are puts the
+    bucket in debt, which the caller has to wait out before taking more. This allows a single large amount, such as a
+    chunk of a copy, without having to split it up.
+
+    *Example*
+      ``time.sleep(TokenBucket(10 * MEGABYTE).take(len(chunk)))``
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, amount):
+        """
+        Take a number of tokens from the bucket.
+
+        :type amount: int
+        :param amount: The number of tokens to take.
+        :rtype: float
+        :return: The number of seconds to wait before using them, to stay within the rate.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+
+class IoGovernor(object):
+    """
+    The IoGovernor slows down file system operations while a video is playing, so playback streaming from the same
+    storage does not start buffering.
+
+    Every file system operation and every byte copied passes through the governor. While a video plays, the number of
+    operations and the number of bytes per second are each limited by a token bucket. As soon as playback stops, any
+    remaining wait is cut short and the cleaner continues at full speed. The time spent waiting is kept per limit, to
+    report how much a run was slowed down, along with the amounts that had to wait.
+
+    *Example*
+      ``governor.transfer(len(chunk))``
+    """
+
+    def __init__(self, byte_rate=0, operation_rate=0, playing=None, wait=None):
+        """
+        :type byte_rate: int
+        :param byte_rate: (Optional) The number of bytes per second during playback, or 0 for no limit. Defaults to 0.
+        :type operation_rate: int
+        :param operation_rate: (Optional) The number of operations per second during playback, or 0 for no limit.
+            Defaults to 0.
+        :type playing: callable
+        :param playing: (Optional) A function that returns True while a video is playing.
+        :type wait: callable
+        :param wait: (Optional) A function that waits a number of seconds, returning True to stop waiting early, like
+            ``xbmc.Monitor().waitForAbort``. Defaults to ``time.sleep``.
+        """
+        self.buckets = {BYTES: TokenBucket(byte_rate) if byte_rate > 0 else None,
+                        OPERATIONS: TokenBucket(operation_rate) if operation_rate > 0 else None}
+        self.playing = playing or (lambda: False)
+        self.wait = wait or time.sleep
+        self.throttled = Counter()
+        self.waited = Counter()
+        self.lock = threading.Lock()
+
+    def operation(self):
+        """Account for a single file system operation, waiting if there were too many of them."""
+        self.throttle(OPERATIONS, 1)
+
+    def transfer(self, amount):
+        """
+        Account for a number of bytes that are read or written, waiting if too many were transferred.
+
+        :type amount: int
+        :param amount: The number of bytes.
+        """
+        self.throttle(BYTES, amount)
+
+    def throttle(self, limit, amount):
+        """
+        Take an amount from the bucket of a limit, and wait until it fits within the rate, or playback stops.
+
+        :type limit: str
+        :param limit: The limit to apply (one of BYTES or OPERATIONS).
+        :type amount: int
+        :param amount: The amount to take.
+        """
+        bucket = self.buckets[limit]
+        if bucket is None or not amount or not self.playing():
+            return
+        delay = bucket.take(amount)
+        if delay <= 0:
+            return
+        started = time.time()
+        deadline = started + delay
+        while delay > 0:
+            if self.wait(min(delay, WAIT_STEP)) or not self.playing():
+                break
+            delay = deadline - time.time()
+        with self.lock:
+            self.throttled[limit] += amount
+            self.waited[limit] += time.time() - started
+
+    def report(self):
+        """Write how much the governor slowed down the run to the debug log."""
+        if self.throttled:
+            debug("Throttled %d operations and %.1f MB during playback, waiting %.1f and %.1f seconds respectively.",
+                  self.throttled[OPERATIONS], float(self.throttled[BYTES]) / MEGABYTE, self.waited[OPERATIONS],
+                  self.waited[BYTES])
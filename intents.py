@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import itertools
+import time
+from collections import Counter
+
+from journal import Journal
+from planner import MOVE, DELETE, PRUNE, Task
+from utils import debug
+
+MAX_SIZE = 16 * 1024 * 1024  # 16 MB, only reached if the log cannot be compacted for many runs
+MAX_ATTEMPTS = 3  # Number of times an operation is tried before it is given up on
+DONE_BATCH = 50  # Number of cleaned videos that are marked as done with a single write to disk
+
+
+class IntentLog(object):
+    """
+    The IntentLog records every video that is about to be cleaned, before any of its files are touched.
+
+    When a plan is executed, an intent is written for each of its videos, as well as for the folders that may be left
+    empty, and synced to disk in one go. Intents are marked as done once their videos have been cleaned, in batches of
+    ``DONE_BATCH`` videos that are synced to disk once. Videos whose batch was not written yet are found to be cleaned
+    already when they are replayed, and are skipped. If Kodi is shut down halfway, the intents that were not marked as
+    done tell exactly which videos were left partially cleaned, such as stacked movies of which only some parts were
+    moved, or videos whose related files remain. These can be finished on the next start, without querying the library,
+    which would no longer report them as they are missing some of their files.
+
+    Intents of videos that a run did not get to before it was stopped are left pending as well, which carries them over
+    to the next run. The log is stored in an append-only journal, which survives being cut off in the middle of a
+    record. It is compacted to the intents that are still pending once they have been replayed.
+
+    *Example*
+      ``ids = IntentLog(path).begin(plan)``
+    """
+
+    def __init__(self, path):
+        self.journal = Journal(path, MAX_SIZE)
+        self.prefix = "%x" % int(time.time() * 1000)
+        self.counter = itertools.count()
+
+    def next_id(self):
+        return "%s-%d" % (self.prefix, next(self.counter))
+
+    def begin(self, plan):
+        """
+        Record the intent to clean every video in a plan, and to remove the folders that may be left empty.
+
+        :type plan: Plan
+        :param plan: The plan that is about to be executed.
+        :rtype: dict
+        :return: The id of the intent of every task, keyed by the ``id()`` of the task. The intent to remove the
+            folders is stored under None.
+        """
+        records, ids = [], {}
+        for task in plan.tasks:
+            ids[id(task)] = self.next_id()
+            records.append({"id": ids[id(task)], "action": DELETE if task.destination is None else MOVE,
+                            "type": plan.video_type, "filename": task.filename, "title": task.title,
+                            "paths": task.paths, "destination": task.destination, "related": task.related,
+                            "attempt": task.attempt + 1})
+        folders = plan.folders()
+        if folders:
+            ids[None] = self.next_id()
+            records.append({"id": ids[None], "action": PRUNE, "folders": folders, "attempt": 1})
+        self.journal.extend(records)
+        return ids
+
+    def done(self, *ids):
+        """
+        Mark intents as done, so they are not replayed.
+
+        :type ids: str
+        :param ids: The ids of the intents.
+        """
+        self.journal.extend([{"done": intent} for intent in ids if intent is not None])
+
+    def retry(self, *ids):
+        """
+        Record that cleaning failed, so the intents are tried again by the next run, up to ``MAX_ATTEMPTS`` times.
+
+        :type ids: str
+        :param ids: The ids of the intents.
+        """
+        if ids:
+            self.journal.extend([{"retry": intent} for intent in ids])
+
+    def pending(self):
+        """
+        Find the intents that were recorded but never marked as done.
+
+        Intents that were carried over because a run was stopped keep their attempt number, while every failure counts
+        as another attempt.
+
+        :rtype: list
+        :return: The pending intents, oldest first, with the number of the attempt the next run would make.
+        """
+        try:
+            records = list(self.journal.scan())
+        except (IOError, OSError, ValueError) as err:
+            debug("Could not read the intent log: %s", err)
+            return []
+        finished = set(record["done"] for _, record in records if "done" in record)
+        failures = Counter(record["retry"] for _, record in records if "retry" in record)
+        pending = [record for _, record in reversed(records) if "id" in record and record["id"] not in finished]
+        for record in pending:
+            record["attempt"] = record.get("attempt", 1) + failures[record["id"]]
+        return pending
+
+    def compact(self):
+        """Rewrite the log to only contain the intents that are still pending, or remove it if there are none."""
+        pending = self.pending()
+        if pending:
+            self.journal.rewrite(pending)
+        else:
+            self.journal.clear()
+
+    @staticmethod
+    def task(intent):
+        """
+        Recreate the task of a video from its intent.
+
+        :type intent: dict
+        :param intent: An intent to move or delete a video.
+        :rtype: Task
+        :return: The task, marked as an attempt to finish an earlier one.
+        """
+        def encode(path):
+            return path.encode("utf-8") if isinstance(path, unicode) else path
+
+        task = Task(encode(intent["filename"]), intent["title"], [encode(p) for p in intent["paths"]],
+                    encode(intent.get("destination")), [encode(p) for p in intent.get("related", [])])
+        task.attempt = intent.get("attempt", 1)
+        return task
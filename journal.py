@@ -0,0 +1,276 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import struct
+
+DEFAULT_MAX_SIZE = 5 * 1024 * 1024  # 5 MB
+
+
+def replace(source, destination):
+    """
+    Move a file over another one. This is a single, atomic step, except on Windows, where Python 2 cannot rename a file
+    over an existing one, so the destination is removed first.
+    """
+    if os.name == "nt" and os.path.exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
+
+
+class Journal(object):
+    """
+    The Journal class stores records in an append-only file, with one JSON document per line.
+
+    Next to the journal, an index file holds the byte offset of every record as a fixed-size integer. This allows
+    reading the newest records first, or any record by number, without reading the whole journal. Existing records are
+    never rewritten when a record is added. Once the journal grows beyond its maximum size, it is rotated: the current
+    files are renamed to ``<name>.1`` and ``<name>.1.idx``, replacing the previous generation.
+
+    A record that was only partially written, for example because Kodi crashed, is discarded the next time the journal
+    is opened for writing.
+
+    *Example*
+      ``Journal(path).append({"time": time.time(), "files": files})``
+    """
+    OFFSET = struct.Struct("<Q")
+    SCAN_CHUNK = 256  # Number of offsets read from the index at once
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.max_size = max(1, int(max_size))
+
+    @property
+    def previous(self):
+        """The journal of the previous generation, created by the last rotation."""
+        return Journal(self.path + ".1", self.max_size)
+
+    def append(self, record):
+        """
+        Append a record to the journal, rotating it afterwards if it has grown beyond its maximum size.
+
+        :type record: dict
+        :param record: The record to store. It must be serializable to JSON.
+        """
+        self.extend([record])
+
+    def extend(self, records):
+        """
+        Append a number of records to the journal at once, so they only have to be synced to disk once.
+
+        :type records: list
+        :param records: The records to store, oldest first. They must be serializable to JSON.
+        """
+        if not records:
+            return
+        self._ensure_folder()
+        self.recover()
+        lines = [json.dumps(record, separators=(",", ":")) + "\n" for record in records]
+
+        with open(self.path, "ab") as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write("".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+        offsets = []
+        for line in lines:
+            offsets.append(offset)
+            offset += len(line)
+        with open(self.index_path, "ab") as f:
+            f.write("".join(self.OFFSET.pack(o) for o in offsets))
+
+        if offset > self.max_size:
+            self.rotate()
+
+    def count(self):
+        """
+        Count the records in this generation of the journal.
+
+        :rtype: int
+        :return: The number of indexed records.
+        """
+        try:
+            return os.path.getsize(self.index_path) // self.OFFSET.size
+        except OSError:
+            return 0
+
+    def offsets(self, start=0, stop=None):
+        """
+        Read a range of record offsets from the index.
+
+        :type start: int
+        :param start: The number of the first record.
+        :type stop: int
+        :param stop: (Optional) The number of the record to stop before. Defaults to the number of records.
+        :rtype: list
+        :return: The byte offsets of the records in the journal.
+        """
+        count = self.count()
+        stop = count if stop is None else min(stop, count)
+        if start >= stop:
+            return []
+        with open(self.index_path, "rb") as f:
+            f.seek(start * self.OFFSET.size)
+            data = f.read((stop - start) * self.OFFSET.size)
+        return [self.OFFSET.unpack_from(data, i)[0] for i in xrange(0, len(data), self.OFFSET.size)]
+
+    def read(self, number):
+        """
+        Read a single record by number, where 0 is the oldest record.
+
+        :type number: int
+        :param number: The number of the record.
+        :rtype: dict
+        :return: The record.
+        """
+        offsets = self.offsets(number, number + 1)
+        if not offsets:
+            raise IndexError("Record %d is not in the journal" % number)
+        with open(self.path, "rb") as f:
+            f.seek(offsets[0])
+            return json.loads(f.readline())
+
+    def newest(self, limit=None):
+        """
+        Read records starting with the most recent one, continuing into the previous generation.
+
+        :type limit: int
+        :param limit: (Optional) The maximum number of records to read. Defaults to all records.
+        :rtype: generator
+        :return: The records, newest first.
+        """
+        for position, record in self.scan():
+            if limit is not None and position >= limit:
+                return
+            yield record
+
+    def scan(self, skip=0):
+        """
+        Read records starting with the most recent one, continuing into the previous generation.
+
+        Skipped records are never read: their offsets are looked up in the index, and the index itself is read in small
+        chunks. This allows paging through the journal while only reading the records that are displayed.
+
+        :type skip: int
+        :param skip: (Optional) The number of most recent records to skip. Defaults to 0.
+        :rtype: generator
+        :return: Tuples of the position of each record, counting from 0 for the most recent record, and the record.
+        """
+        position = 0
+        for journal in (self, self.previous):
+            count = journal.count()
+            if not count or skip >= position + count:
+                position += count
+                continue
+
+            stop = count - max(0, skip - position)
+            position += count - stop
+            with open(journal.path, "rb") as f:
+                while stop > 0:
+                    start = max(0, stop - self.SCAN_CHUNK)
+                    for offset in reversed(journal.offsets(start, stop)):
+                        f.seek(offset)
+                        yield position, json.loads(f.readline())
+                        position += 1
+                    stop = start
+
+    def rotate(self):
+        """Move the current journal to the previous generation, discarding the previous one."""
+        previous = self.previous
+        for source, destination in ((self.path, previous.path), (self.index_path, previous.index_path)):
+            if os.path.exists(destination):
+                os.remove(destination)
+            if os.path.exists(source):
+                os.rename(source, destination)
+
+    def rewrite(self, records):
+        """
+        Replace all generations of the journal with the given records. The new journal is written to a temporary file
+        first and then moved over the current one, so the journal is never left half-written or missing. The index is
+        removed before the journal is replaced, so it never describes the wrong journal. If Kodi crashes before the new
+        index is in place, the index is rebuilt from the journal the next time it is written to. The previous generation
+        is only removed once the new journal is in place.
+
+        :type records: list
+        :param records: The records to keep, oldest first.
+        """
+        self._ensure_folder()
+        temp = Journal(self.path + ".tmp", self.max_size)
+        temp.clear()
+        offset = 0
+        with open(temp.path, "wb") as f, open(temp.index_path, "wb") as index:
+            for record in records:
+                line = json.dumps(record, separators=(",", ":")) + "\n"
+                f.write(line)
+                index.write(self.OFFSET.pack(offset))
+                offset += len(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        replace(temp.path, self.path)
+        os.rename(temp.index_path, self.index_path)
+        previous = self.previous
+        for path in (previous.path, previous.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def clear(self):
+        """Remove all generations of the journal."""
+        for path in (self.path, self.index_path, self.previous.path, self.previous.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def recover(self):
+        """
+        Make sure the index covers exactly the complete records in the journal.
+
+        Records missing from the index are indexed, and a partially written record at the end of the journal is removed.
+        """
+        if not os.path.exists(self.path):
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+            return
+
+        size = os.path.getsize(self.path)
+        count = self.count()
+        offsets = self.offsets(count - 1, count) if count else []
+        if offsets and offsets[0] >= size:
+            # The index refers to data that is not there, so rebuild it entirely
+            count, offsets = 0, []
+            open(self.index_path, "wb").close()
+
+        with open(self.path, "rb+") as f:
+            position = offsets[0] if offsets else 0
+            f.seek(position)
+            if offsets:
+                line = f.readline()
+                if not line.endswith("\n"):
+                    # The last indexed record is incomplete, so forget it
+                    with open(self.index_path, "rb+") as index:
+                        index.truncate((count - 1) * self.OFFSET.size)
+                    f.truncate(position)
+                    return
+                position += len(line)
+
+            missing = []
+            for line in iter(f.readline, ""):
+                if not line.endswith("\n"):
+                    f.truncate(position)
+                    break
+                missing.append(position)
+                position += len(line)
+
+        if missing:
+            with open(self.index_path, "ab") as index:
+                for offset in missing:
+                    index.write(self.OFFSET.pack(offset))
+
+    def _ensure_folder(self):
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
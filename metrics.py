@@ -0,0 +1,192 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from utils import debug
+
+JSON_FILE = "metrics.json"
+PROMETHEUS_FILE = "filecleaner.prom"
+PREFIX = "filecleaner"
+QUERY = "query"
+FILTER = "filter"
+CLEAN = "clean"
+RELATED = "related"
+FOLDERS = "folders"
+PHASES = (QUERY, FILTER, CLEAN, RELATED, FOLDERS)
+
+# The description of every metric, and the name of its label if it has one
+descriptions = {
+    "phase_seconds": ("Seconds spent in each phase of the last cleaning run, summed over all workers.", "phase"),
+    "videos_cleaned": ("Videos cleaned during the last cleaning run.", "type"),
+    "videos_skipped": ("Watched videos that were not cleaned during the last cleaning run.", "reason"),
+    "videos_carried_over": ("Videos left for the next run because the last cleaning run was stopped.", "type"),
+    "fs_operations": ("File system calls made during the last cleaning run.", "operation"),
+    "rpc_requests": ("JSON-RPC requests sent during the last cleaning run.", None),
+    "rpc_round_trips": ("JSON-RPC round-trips made during the last cleaning run.", None),
+    "bytes_deleted": ("Bytes of video files deleted during the last cleaning run.", None),
+    "bytes_moved": ("Bytes of video files moved to the holding folder during the last cleaning run.", None),
+    "bytes_copied": ("Bytes copied because they could not be renamed during the last cleaning run.", None),
+    "folders_removed": ("Empty folders removed at the end of the last cleaning run.", None),
+    "run_start_timestamp_seconds": ("Time the last cleaning run started.", None),
+    "run_end_timestamp_seconds": ("Time the last cleaning run finished, or 0 if it is still running.", None),
+    "run_duration_seconds": ("Seconds the last cleaning run took.", None),
+    "paused_seconds": ("Seconds the last cleaning run was paused during playback.", None),
+    "throttled_seconds": ("Seconds the last cleaning run was slowed down during playback, per limit.", "limit"),
+    "run_in_progress": ("Whether a cleaning run is in progress, or did not finish.", None),
+}
+
+
+class Metrics(object):
+    """
+    The Metrics class records how long each phase of a cleaning run takes, and how much work is done in it.
+
+    The phases are querying the library, filtering the watched videos, moving or deleting them, cleaning their related
+    files and removing the folders left empty. Counters keep track of the requests sent to Kodi, the file system calls
+    made and the number of bytes freed. The metrics are written to the addon profile as JSON, and as a textfile for
+    the Prometheus node exporter, once when the run starts and again when it finishes. A run that keeps reporting to be
+    in progress has either been running for too long or did not finish at all.
+
+    *Example*
+      ``with metrics.phase(metrics.CLEAN): delete(video)``
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.timings = dict.fromkeys(PHASES, 0.0)
+        self.counters = Counter()
+        self.labelled = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Add the time spent in a block of code to a phase.
+
+        :type name: str
+        :param name: The phase (one of the PHASES).
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - started)
+
+    def timed(self, name, iterable):
+        """
+        Add the time spent waiting for the items of an iterable to a phase, such as the pages of a query.
+
+        :type name: str
+        :param name: The phase (one of the PHASES).
+        :type iterable: iterable
+        :param iterable: The items to time.
+        :rtype: generator
+        :return: The same items.
+        """
+        iterator = iter(iterable)
+        while True:
+            started = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.time() - started)
+                return
+            self.add_time(name, time.time() - started)
+            yield item
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def count(self, name, amount=1, label=None):
+        """
+        Increase a counter.
+
+        :type name: str
+        :param name: The name of the counter.
+        :type amount: int
+        :param amount: (Optional) The amount to add. Defaults to 1.
+        :type label: str
+        :param label: (Optional) The label value to count under, such as the type of a video.
+        """
+        with self.lock:
+            if label is None:
+                self.counters[name] += amount
+            else:
+                self.labelled.setdefault(name, Counter())[label] += amount
+
+    def finish(self):
+        """Record that the run has finished."""
+        self.finished = time.time()
+
+    def values(self):
+        """
+        Collect all metrics.
+
+        :rtype: dict
+        :return: Every metric, with labelled metrics as a dict keyed by their label value.
+        """
+        with self.lock:
+            values = dict(self.counters)
+            values.update((name, dict(counter)) for name, counter in self.labelled.items())
+            values["phase_seconds"] = dict(self.timings)
+        values["run_start_timestamp_seconds"] = self.started
+        values["run_end_timestamp_seconds"] = self.finished or 0
+        values["run_duration_seconds"] = (self.finished or time.time()) - self.started
+        values["run_in_progress"] = 0 if self.finished else 1
+        return values
+
+    def to_prometheus(self):
+        """
+        Format all metrics in the Prometheus text exposition format.
+
+        :rtype: str
+        :return: A gauge for every metric.
+        """
+        lines = []
+        for name, value in sorted(self.values().items()):
+            description, label = descriptions.get(name, (name.replace("_", " ").capitalize() + ".", "label"))
+            metric = "%s_%s" % (PREFIX, name)
+            lines.append("# HELP %s %s" % (metric, description))
+            lines.append("# TYPE %s gauge" % metric)
+            if isinstance(value, dict):
+                for key, amount in sorted(value.items()):
+                    escaped = unicode(key).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+                    lines.append("%s{%s=\"%s\"} %s" % (metric, label, escaped.encode("utf-8"), repr(float(amount))))
+            else:
+                lines.append("%s %s" % (metric, repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+    def write(self, folder):
+        """
+        Write all metrics to a JSON file and a Prometheus textfile.
+
+        Both files are first written to a temporary file and then renamed, so readers never see a partial file.
+
+        :type folder: str
+        :param folder: The folder to write the files to.
+        """
+        try:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            for name, contents in ((JSON_FILE, json.dumps(self.values(), indent=2, sort_keys=True)),
+                                   (PROMETHEUS_FILE, self.to_prometheus())):
+                path = os.path.join(folder, name)
+                with open(path + ".tmp", "w") as f:
+                    f.write(contents)
+                if os.name == "nt" and os.path.exists(path):
+                    os.remove(path)  # Windows cannot rename onto an existing file
+                os.rename(path + ".tmp", path)
+        except (IOError, OSError) as err:
+            debug("Could not write the metrics to %r: %s", folder, err)
+
+    def report(self):
+        """Write the time spent in every phase to the debug log."""
+        debug(lambda: "Time spent per phase: %s." % ", ".join("%s %.2fs" % (name, self.timings[name])
+                                                              for name in PHASES))
@@ -0,0 +1,261 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+from executor import get_host
+from watermarks import parse_lastplayed
+
+MOVE = "move"
+COPY = "copy"
+DELETE = "delete"
+PRUNE = "prune"
+GIGABYTE = 1024 ** 3
+
+
+class Operation(object):
+    """
+    A single file system operation that is part of a plan.
+
+    :type action: str
+    :param action: What to do with the path (one of MOVE, COPY, DELETE or PRUNE).
+    :type source: str
+    :param source: The file or folder the operation applies to.
+    :type destination: str
+    :param destination: (Optional) The new path of the file when it is moved.
+    """
+    __slots__ = ("action", "source", "destination")
+
+    def __init__(self, action, source, destination=None):
+        self.action = action
+        self.source = source
+        self.destination = destination
+
+    def __repr__(self):
+        if self.destination is None:
+            return "%s %r" % (self.action, self.source)
+        return "%s %r to %r" % (self.action, self.source, self.destination)
+
+
+class Task(object):
+    """
+    A single video to clean, along with every file that is cleaned with it.
+
+    :type filename: str
+    :param filename: The path to the video, as stored in the Kodi library.
+    :type title: str
+    :param title: The title of the video.
+    :type paths: list
+    :param paths: The paths of the files that make up the video, which is more than one for stacked videos.
+    :type destination: str
+    :param destination: The folder the video is moved to, or None if it is deleted.
+    :type related: list
+    :param related: The paths of the files related to the video that are cleaned along with it.
+    :type details: dict
+    :param details: (Optional) Additional properties of the video from the library, used to rank videos.
+    :type devices: tuple
+    :param devices: (Optional) The devices the video and its destination are on, if known.
+    """
+    __slots__ = ("filename", "title", "paths", "destination", "related", "details", "devices", "size", "host",
+                 "folder", "attempt")
+
+    def __init__(self, filename, title, paths, destination=None, related=None, details=None, devices=None):
+        self.filename = filename
+        self.title = title
+        self.paths = paths
+        self.destination = destination
+        self.related = related or []
+        self.details = details or {}
+        self.devices = devices
+        self.size = 0
+        self.host = get_host(paths[0])
+        self.folder = os.path.dirname(paths[0])  # Stacked paths have the same parent, use any
+        self.attempt = 0  # The number of earlier runs that started cleaning this video, but did not finish
+
+    @property
+    def rename(self):
+        """
+        Whether the video can be moved by renaming it, because it is on the same device as its destination.
+
+        :rtype: bool
+        :return: True if it can be renamed, False if it must be copied, or None if this is not known.
+        """
+        if self.destination is None or self.devices is None or None in self.devices:
+            return None
+        return self.devices[0] == self.devices[1]
+
+    def operations(self):
+        """
+        List the operations needed to clean this video.
+
+        :rtype: list
+        :return: The operations on the video itself, followed by those on its related files.
+        """
+        if self.destination is None:
+            return [Operation(DELETE, p) for p in self.paths + self.related]
+        action = COPY if self.rename is False else MOVE
+        return [Operation(action, p, os.path.join(self.destination, os.path.basename(p)))
+                for p in self.paths + self.related]
+
+
+class Plan(object):
+    """
+    The Plan class holds everything a cleaning run is going to do, before any file is touched.
+
+    A plan is built by ``Cleaner.plan()`` and applied by ``Cleaner.execute()``. Its tasks are ordered by storage host
+    and folder, so that consecutive operations hit the same server and the same directory, with moves that require
+    copying last. The folders that may be left empty are only listed once, no matter how many videos they contained.
+    The same plan can be reported without executing it, to preview a cleaning run.
+
+    *Example*
+      ``print Cleaner().plan(Cleaner.MOVIES, videos).report()``
+    """
+
+    def __init__(self, video_type, prune=False):
+        self.video_type = video_type
+        self.prune = prune
+        self.tasks = []
+        self.cleaned = []
+        self.skipped = []
+        self.duration = 0.0
+        self.started = time.time()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, task):
+        """
+        Add a video to the plan.
+
+        :type task: Task
+        :param task: The video to clean.
+        """
+        self.tasks.append(task)
+
+    def skip(self, filename, reason):
+        """
+        Record a video that will not be cleaned, so it shows up in the report.
+
+        :type filename: str
+        :param filename: The path to the video.
+        :type reason: str
+        :param reason: Why the video is skipped.
+        """
+        self.skipped.append((filename, reason))
+
+    def subset(self, tasks):
+        """
+        Create a plan for some of the videos in this plan.
+
+        :type tasks: list
+        :param tasks: The tasks to include.
+        :rtype: Plan
+        :return: A new plan containing only the given tasks.
+        """
+        plan = Plan(self.video_type, self.prune)
+        plan.tasks = list(tasks)
+        plan.finish()
+        plan.duration = self.duration
+        return plan
+
+    def finish(self):
+        """
+        Order the tasks for locality and record how long planning took.
+
+        Videos that can be renamed go first, as they take no time at all. Videos that must be copied follow, grouped by
+        the devices they are copied between.
+        """
+        self.tasks.sort(key=lambda task: (task.rename is False, task.devices if task.rename is False else None,
+                                          task.host, task.folder, task.filename))
+        self.duration = time.time() - self.started
+
+    def folders(self, tasks=None):
+        """
+        List the folders that may be left empty, each only once, deepest first so subfolders go before their parents.
+
+        :type tasks: list
+        :param tasks: (Optional) The tasks to consider. Defaults to all tasks in the plan.
+        :rtype: list
+        :return: The folders to remove if they are empty, or an empty list if removing folders is disabled.
+        """
+        if not self.prune:
+            return []
+        folders = set(task.folder for task in (self.tasks if tasks is None else tasks))
+        return sorted(folders, key=lambda folder: (get_host(folder), -folder.rstrip("/\\").count("/"), folder))
+
+    def operations(self):
+        """
+        List every operation in the order it will be executed.
+
+        :rtype: list
+        :return: The operations of all tasks, followed by the removal of folders that are left empty.
+        """
+        operations = [operation for task in self.tasks for operation in task.operations()]
+        operations.extend(Operation(PRUNE, folder) for folder in self.folders())
+        return operations
+
+    def report(self):
+        """
+        Describe the plan in a human readable form, one operation per line.
+
+        :rtype: str
+        :return: A summary of the plan, followed by every operation and every skipped video.
+        """
+        operations = self.operations()
+        lines = ["%s: %d videos, %d operations, planned in %.2f seconds" % (self.video_type, len(self.tasks),
+                                                                          len(operations), self.duration)]
+        lines.extend("  %r" % operation for operation in operations)
+        lines.extend("  skip %r (%s)" % (filename, reason) for filename, reason in self.skipped)
+        return "\n".join(lines)
+
+
+def score(task, age_weight=1, rating_weight=0, size_weight=0, now=None):
+    """
+    Determine how eager we are to clean a video, when only some videos have to be cleaned to free up space.
+
+    Every day since the video was last played, every rating point below 10 and every gigabyte of the video's size
+    adds one point, multiplied by the weight of that property. Videos without a rating get no points for it.
+
+    :type task: Task
+    :param task: The video to score. Its size must be known.
+    :type age_weight: int
+    :param age_weight: (Optional) The weight of the number of days since the video was last played. Defaults to 1.
+    :type rating_weight: int
+    :param rating_weight: (Optional) The weight of a low rating. Defaults to 0.
+    :type size_weight: int
+    :param size_weight: (Optional) The weight of the size of the video. Defaults to 0.
+    :type now: float
+    :param now: (Optional) The current time. Defaults to the system time.
+    :rtype: float
+    :return: The score of the video. Videos with higher scores are cleaned first.
+    """
+    points = 0.0
+    played = parse_lastplayed(task.details.get("lastplayed"))
+    if played is not None:
+        points += age_weight * max(0.0, ((now or time.time()) - played) / 86400.0)
+    rating = task.details.get("rating")
+    if rating:
+        points += rating_weight * max(0.0, 10 - float(rating))
+    points += size_weight * float(task.size) / GIGABYTE
+    return points
+
+
+def select(tasks, needed):
+    """
+    Pick the first videos of a ranked list until they add up to the number of bytes needed.
+
+    :type tasks: list
+    :param tasks: The tasks, highest score first. Their sizes must be known.
+    :type needed: int
+    :param needed: The number of bytes to free.
+    :rtype: list
+    :return: The tasks to clean, in the same order.
+    """
+    selected, total = [], 0
+    for task in tasks:
+        if total >= needed:
+            break
+        selected.append(task)
+        total += task.size
+    return selected
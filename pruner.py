@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+
+from diskspace import is_below
+from utils import debug
+from vfs import folder_key
+
+
+def depth(folder):
+    """The number of path components of a folder, used to handle subfolders before their parents."""
+    return folder_key(folder).replace("\\", "/").count("/")
+
+
+class FolderPruner(object):
+    """
+    The FolderPruner removes the folders that were left empty by a cleaning run, in a single pass at the end of the run.
+
+    Starting from every folder a video was cleaned from, each parent folder up to the library source containing it is
+    considered as well, so an emptied season folder does not leave behind an empty show folder. The sources themselves
+    are never removed. If a folder is not inside any known source, only that folder is considered.
+
+    A folder is empty if it only contains files with an ignored extension, and subfolders that are empty themselves.
+    Every folder is listed at most once, no matter how many cleaned videos it contained, and the folders are removed
+    deepest first, along with the ignored files in them.
+
+    *Example*
+      ``removed = FolderPruner(fs, sources, [".nfo", ".jpg"]).prune(folders)``
+    """
+
+    def __init__(self, fs, roots, ignored_extensions):
+        """
+        :type fs: FileSystem
+        :param fs: The file system of the cleaning run, whose cached listings are reused.
+        :type roots: list
+        :param roots: The folders to stop at, such as the library sources and the holding folder.
+        :type ignored_extensions: list
+        :param ignored_extensions: The extensions of the files that do not keep a folder from being empty.
+        """
+        self.fs = fs
+        self.roots = sorted(set(folder_key(root) for root in roots if root), key=depth, reverse=True)
+        self.ignored_extensions = set(ignored_extensions)
+        self.empty = {}
+
+    def root_of(self, folder):
+        """
+        Find the deepest root that contains a folder.
+
+        :rtype: str
+        :return: The root, or None if the folder is not inside any root.
+        """
+        for root in self.roots:
+            if is_below(folder, root):
+                return root
+        return None
+
+    def candidates(self, folders):
+        """
+        Collect the folders and their parents up to, but not including, the root they are in.
+
+        :type folders: iterable
+        :param folders: The folders videos were cleaned from.
+        :rtype: set
+        :return: Every folder that may have been left empty.
+        """
+        candidates = set()
+        for folder in folders:
+            folder = folder_key(folder)
+            root = self.root_of(folder)
+            while folder not in candidates and folder != root:
+                candidates.add(folder)
+                parent = os.path.dirname(folder)
+                if root is None or parent == folder or not is_below(parent, root):
+                    break
+                folder = parent
+        return candidates
+
+    def is_ignored(self, filename):
+        _, extension = os.path.splitext(filename)
+        return not extension or extension in self.ignored_extensions
+
+    def is_empty(self, folder):
+        """
+        Check whether a folder only contains ignored files and empty subfolders, listing every folder only once.
+
+        :type folder: str
+        :param folder: The folder to check.
+        :rtype: bool
+        :return: True if the folder can be removed, False otherwise.
+        """
+        folder = folder_key(folder)
+        if folder not in self.empty:
+            subfolders, files = self.fs.listdir(folder)
+            self.empty[folder] = (all(self.is_ignored(f) for f in files) and
+                                  all(self.is_empty(os.path.join(folder, sub)) for sub in subfolders))
+        return self.empty[folder]
+
+    def prune(self, folders):
+        """
+        Remove the folders that were left empty, and the parents they leave empty, deepest first.
+
+        :type folders: iterable
+        :param folders: The folders videos were cleaned from.
+        :rtype: list
+        :return: The folders that were removed.
+        """
+        candidates = self.candidates(folders)
+        debug("Checking %d folders for being empty.", len(candidates))
+        for folder in sorted(candidates, key=depth, reverse=True):
+            self.is_empty(folder)
+
+        # Besides the candidates, only remove the empty subfolders of folders that are removed themselves
+        removable = set()
+        for folder in sorted((f for f, empty in self.empty.items() if empty), key=depth):
+            if folder in candidates or os.path.dirname(folder) in removable:
+                removable.add(folder)
+
+        removed = []
+        for folder in sorted(removable, key=depth, reverse=True):
+            _, files = self.fs.listdir(folder)
+            for f in files:
+                debug("Deleting file at %s", os.path.join(folder, f))
+                self.fs.delete(os.path.join(folder, f))
+            if self.fs.rmdir(folder):
+                debug("Removed empty folder %r.", folder)
+                removed.append(folder)
+            else:
+                debug("Could not remove empty folder %r.", folder)
+        return removed
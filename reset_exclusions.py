@@ -19,5 +19,6 @@ def reset_exclusions():
         __addon__.setSetting(id="exclusion1", value="")
         __addon__.setSetting(id="exclusion2", value="")
         __addon__.setSetting(id="exclusion3", value="")
+        __addon__.setSetting(id="extra_exclusions", value="")
 
 reset_exclusions()
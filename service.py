@@ -1,19 +1,105 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import json
+import threading
+
 from xbmc import Monitor
 
-from default import Cleaner
+from utils import NOTIFICATION_TYPES, configure_logging, debug, notify
 from settings import *
-from utils import debug, notify
+
+# The cleaning engine is only imported once there is something to clean, to keep Kodi's startup fast
+_cleaner = None
+
+
+def get_cleaner():
+    """
+    Load the cleaning engine on first use.
+
+    :rtype: Cleaner
+    :return: The cleaner shared by all runs of the service.
+    """
+    global _cleaner
+    if _cleaner is None:
+        from default import Cleaner
+        _cleaner = Cleaner()
+    return _cleaner
+
+
+class SettingsMonitor(Monitor):
+    """
+    Keeps the settings snapshot up to date by reloading it only when Kodi reports the addon settings have changed.
+
+    It also keeps track of the videos that were marked as watched, so these can be cleaned without scanning the entire
+    library.
+    """
+    def __init__(self):
+        Monitor.__init__(self)
+        self.lock = threading.Lock()
+        self.updates = {}
+
+    def onSettingsChanged(self):
+        debug("Settings changed. Reloading the settings snapshot.")
+        configure_logging(reload_settings())
+
+    def onNotification(self, sender, method, data):
+        if method != "VideoLibrary.OnUpdate" or not (get_setting(service_enabled) and get_setting(clean_on_update)):
+            return
+
+        try:
+            data = json.loads(data)
+            item = data["item"]
+            video_type = NOTIFICATION_TYPES.get(item["type"])
+            watched = data.get("playcount", 0) > 0
+        except (ValueError, KeyError, TypeError) as err:
+            debug("Could not parse library update %r: %r", data, err, level=xbmc.LOGWARNING)
+            return
+
+        if video_type and watched:
+            debug("Queueing %s %d for cleaning.", video_type, item["id"])
+            with self.lock:
+                self.updates.setdefault(video_type, set()).add(item["id"])
+
+    def has_updates(self):
+        with self.lock:
+            return bool(self.updates)
+
+    def take_updates(self):
+        """
+        Retrieve the videos that were marked as watched since the last call, and start a new queue.
+
+        :rtype: dict
+        :return: The library ids of the watched videos, keyed by video type.
+        """
+        with self.lock:
+            updates, self.updates = self.updates, {}
+        return dict((video_type, sorted(ids)) for video_type, ids in updates.items())
+
+
+def waiting_for_idle():
+    """
+    Check whether cleaning has to wait because a video is playing, in which case ``Cleaner.clean_all()`` skips the run.
+    Queued videos are only taken from the queue when they can be cleaned, so they are not lost to a skipped run.
+
+    :rtype: bool
+    :return: True if cleaning only happens while Kodi is idle and a video is playing, False otherwise.
+    """
+    return get_setting(clean_when_idle) and xbmc.Player().isPlaying()
 
 
 def autostart():
     """
     Starts the cleaning service.
+
+    Besides cleaning the entire library at a fixed interval, the service can clean videos right after they have been
+    marked as watched. In that case the periodic scan acts as a fallback for videos that only expire later.
+
+    Only this scheduler is loaded when Kodi starts, and library update notifications are queued without the cleaning
+    engine. The engine is loaded by the first cleaning run, which only starts after the delayed start, while the service
+    is enabled.
     """
-    cleaner = Cleaner()
-    monitor = Monitor()
+    monitor = SettingsMonitor()
 
     service_sleep = 4  # Lower than 4 causes too much stress on resource limited systems such as RPi
     ticker = 0
@@ -25,16 +111,25 @@ def autostart():
             delayed_start_ticker = get_setting(delayed_start) * 60 / service_sleep
 
             if delayed_completed and ticker >= scan_interval_ticker:
-                results = cleaner.clean_all()
+                if not waiting_for_idle():
+                    monitor.take_updates()  # Anything queued is covered by the full scan
+                results = get_cleaner().clean_all()
                 if results:
                     notify(results)
                 ticker = 0
             elif not delayed_completed and ticker >= delayed_start_ticker:
                 delayed_completed = True
-                results = cleaner.clean_all()
+                if not waiting_for_idle():
+                    monitor.take_updates()
+                results = get_cleaner().clean_all()
                 if results:
                     notify(results)
                 ticker = 0
+            elif (delayed_completed and get_setting(clean_on_update) and monitor.has_updates()
+                  and not waiting_for_idle()):
+                results = get_cleaner().clean_all(monitor.take_updates())
+                if results:
+                    notify(results)
 
             xbmc.sleep(service_sleep * 1000)
             ticker += 1
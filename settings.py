@@ -13,6 +13,7 @@ ignore_extensions = "ignore_extensions"
 clean_related = "clean_related"
 delayed_start = "delayed_start"
 scan_interval = "scan_interval"
+clean_on_update = "clean_on_update"
 
 notifications_enabled = "notifications_enabled"
 notify_when_idle = "notify_when_idle"
@@ -25,6 +26,7 @@ clean_movies = "clean_movies"
 clean_tv_shows = "clean_tv_shows"
 clean_music_videos = "clean_music_videos"
 clean_when_idle = "clean_when_idle"
+time_budget = "time_budget"
 
 enable_expiration = "enable_expiration"
 expire_after = "expire_after"
@@ -36,47 +38,127 @@ ignore_no_rating = "ignore_no_rating"
 clean_when_low_disk_space = "clean_when_low_disk_space"
 disk_space_threshold = "disk_space_threshold"
 disk_space_check_path = "disk_space_check_path"
+clean_to_target = "clean_to_target"
+rank_by_age = "rank_by_age"
+rank_by_rating = "rank_by_rating"
+rank_by_size = "rank_by_size"
+check_each_volume = "check_each_volume"
 
 holding_folder = "holding_folder"
 create_subdirs = "create_subdirs"
 
 not_in_progress = "not_in_progress"
 
+log_max_size = "log_max_size"
+
+query_page_size = "query_page_size"
+delta_queries = "delta_queries"
+concurrent_cleaning = "concurrent_cleaning"
+concurrent_workers = "concurrent_workers"
+concurrent_workers_per_host = "concurrent_workers_per_host"
+playback_bandwidth = "playback_bandwidth"
+playback_operations = "playback_operations"
+
 exclusion_enabled = "exclusion_enabled"
 exclusion1 = "exclusion1"
 exclusion2 = "exclusion2"
 exclusion3 = "exclusion3"
+extra_exclusions = "extra_exclusions"
 
 bools = [service_enabled, delete_folders, clean_related, notifications_enabled, notify_when_idle, debugging_enabled,
          clean_kodi_library, clean_movies, clean_tv_shows, clean_music_videos, clean_when_idle, enable_expiration,
          clean_when_low_rated, ignore_no_rating, clean_when_low_disk_space, create_subdirs,
-         not_in_progress, exclusion_enabled]
+         not_in_progress, exclusion_enabled, concurrent_cleaning, clean_on_update,
+         delta_queries, clean_to_target, check_each_volume]
 strings = [ignore_extensions, cleaning_type, default_action]
-numbers = [delayed_start, scan_interval, expire_after, minimum_rating, disk_space_threshold]
+numbers = [delayed_start, scan_interval, expire_after, minimum_rating, disk_space_threshold, query_page_size,
+           concurrent_workers, concurrent_workers_per_host, log_max_size, rank_by_age, rank_by_rating, rank_by_size,
+           time_budget, playback_bandwidth, playback_operations]
 paths = [disk_space_check_path, holding_folder, create_subdirs, exclusion1, exclusion2, exclusion3]
+path_lists = [extra_exclusions]
 
+PATH_LIST_SEPARATOR = "|"
 
-def get_setting(setting):
+
+setting_types = dict([(s, "path_list") for s in path_lists] +
+                     [(s, "path") for s in paths] +
+                     [(s, "number") for s in numbers] +
+                     [(s, "string") for s in strings] +
+                     [(s, "bool") for s in bools])
+
+
+class Snapshot(object):
     """
-    Get the value for a specified setting.
+    An immutable, typed copy of all addon settings, taken at a single point in time.
 
-    Note: Make sure to check the return type of the setting you get.
+    Reading a value from a snapshot is a plain dictionary lookup, so it is safe to do so inside tight loops. Take a new
+    snapshot through ``reload_settings()`` whenever the user changes the addon's settings.
+    """
+    __slots__ = ["_values"]
+
+    def __init__(self, values):
+        object.__setattr__(self, "_values", dict(values))
+
+    def __getitem__(self, setting):
+        try:
+            return self._values[setting]
+        except KeyError:
+            utils.debug("Failed loading %r value. Type %r cannot be handled.", setting, type(setting),
+                        level=xbmc.LOGWARNING)
+            return None
+
+    def __contains__(self, setting):
+        return setting in self._values
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings snapshots are read-only")
 
+    def __delattr__(self, name):
+        raise AttributeError("Settings snapshots are read-only")
+
+    def get(self, setting, default=None):
+        return self._values.get(setting, default)
+
+    def items(self):
+        return self._values.items()
+
+
+_snapshot = None
+
+
+def read_setting(setting, addon=None):
+    """
+    Read the value for a specified setting directly from Kodi, bypassing the settings snapshot.
+
+    Note: This constructs an Addon object if none is provided. Use ``get_setting()`` unless a fresh value is needed.
+
+    :type setting: str
     :param setting: The setting you want to retrieve the value of.
-    :return: The value corresponding to the provided setting. This can be a float, a bool, a string or None.
+    :type addon: Addon
+    :param addon: (Optional) The Addon object to read the setting from.
+    :return: The value corresponding to the provided setting. This can be a float, a bool, a string, a list or None.
     """
-    if setting in bools:
-        return bool(Addon("script.filecleaner").getSetting(setting) == "true")
-    elif setting in numbers:
-        return float(Addon("script.filecleaner").getSetting(setting))
-    elif setting in strings:
-        return str(Addon("script.filecleaner").getSetting(setting))
-    elif setting in paths:
-        return xbmc.translatePath(Addon("script.filecleaner").getSetting(setting).encode("utf-8"))
-    else:
-        utils.debug("Failed loading %r value. Type %r cannot be handled." % (setting, type(setting)), xbmc.LOGWARNING)
+    setting_type = setting_types.get(setting)
+    if setting_type is None:
+        utils.debug("Failed loading %r value. Type %r cannot be handled.", setting, type(setting),
+                    level=xbmc.LOGWARNING)
         return None
 
+    if addon is None:
+        addon = Addon("script.filecleaner")
+    value = addon.getSetting(setting)
+
+    if setting_type == "bool":
+        return bool(value == "true")
+    elif setting_type == "number":
+        return float(value)
+    elif setting_type == "string":
+        return str(value)
+    elif setting_type == "path_list":
+        return [xbmc.translatePath(p.strip().encode("utf-8")) for p in value.split(PATH_LIST_SEPARATOR) if p.strip()]
+    else:
+        return xbmc.translatePath(value.encode("utf-8"))
+
 
 def load_all():
     """
@@ -84,11 +166,45 @@ def load_all():
 
     Note: Make sure to check the return type of settings you get.
 
-    :rtype: dict
+    :rtype: Snapshot
     :return: All settings and their current values.
     """
-    settings = dict()
-    for s in bools + strings + numbers + paths:
-        print s
-        settings[s] = get_setting(s)
-    return settings
+    addon = Addon("script.filecleaner")
+    return Snapshot((s, read_setting(s, addon)) for s in setting_types)
+
+
+def get_settings():
+    """
+    Get the current settings snapshot. The snapshot is loaded on first use and then reused until it is reloaded.
+
+    :rtype: Snapshot
+    :return: The most recent snapshot of all settings.
+    """
+    global _snapshot
+    if _snapshot is None:
+        _snapshot = load_all()
+    return _snapshot
+
+
+def reload_settings():
+    """
+    Replace the current settings snapshot with a fresh one. Call this when Kodi reports the settings have changed.
+
+    :rtype: Snapshot
+    :return: The new snapshot of all settings.
+    """
+    global _snapshot
+    _snapshot = load_all()
+    return _snapshot
+
+
+def get_setting(setting):
+    """
+    Get the value for a specified setting from the current settings snapshot.
+
+    Note: Make sure to check the return type of the setting you get.
+
+    :param setting: The setting you want to retrieve the value of.
+    :return: The value corresponding to the provided setting. This can be a float, a bool, a string or None.
+    """
+    return get_settings()[setting]
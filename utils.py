@@ -2,12 +2,9 @@
 # -*- coding: utf-8 -*-
 
 import os
-import re
 import time
-from ctypes import *
 
-import xbmcgui
-import xbmcvfs
+from journal import Journal
 from settings import *
 
 
@@ -15,62 +12,173 @@ from settings import *
 __addonID__ = "script.filecleaner"
 __addon__ = Addon(__addonID__)
 __title__ = __addon__.getAddonInfo("name")
-__profile__ = xbmc.translatePath(__addon__.getAddonInfo("profile")).decode("utf-8")
-__icon__ = xbmc.translatePath(__addon__.getAddonInfo("icon")).decode("utf-8")
+
+MAX_MESSAGE_LENGTH = 4096  # Longer debug messages are truncated
+INTENT_LOG = "intents.journal"  # The write-ahead log of the cleaner, stored in the addon profile
+# The video types of the cleaner, keyed by the item types of Kodi's library update notifications
+NOTIFICATION_TYPES = {"episode": "episodes", "movie": "movies", "musicvideo": "musicvideos"}
+_debugging = None
+_paths = {}
+
+
+def get_addon_path(info):
+    """
+    Look up a path of the addon, such as its profile folder or icon, translating it only the first time it is needed.
+
+    :type info: str
+    :param info: The addon info holding the path (e.g. "profile" or "icon").
+    :rtype: unicode
+    :return: The translated path.
+    """
+    if info not in _paths:
+        _paths[info] = xbmc.translatePath(__addon__.getAddonInfo(info)).decode("utf-8")
+    return _paths[info]
+
+
+def get_profile():
+    """
+    :rtype: unicode
+    :return: The folder where the addon stores its data.
+    """
+    return get_addon_path("profile")
 
 
 class Log(object):
     """
     The Log class will handle the writing of cleaned files to a log file in the addon settings.
 
-    This log file will be automatically created upon first prepending data to it.
+    Every cleaning run is stored as a separate record in an append-only journal, which is rotated once it grows beyond
+    the size set through the addon settings. The journal will be automatically created upon first prepending data to it.
 
     Supported operations are prepend, trim, clear and get.
     """
-    def __init__(self):
-        self.logpath = os.path.join(__profile__, "cleaner.log")
+    DATE_FORMAT = "%d/%m/%Y  -  %H:%M:%S"
+
+    def __init__(self, settings=None):
+        if settings is None:
+            settings = get_settings()
+        self.logpath = os.path.join(get_profile(), "cleaner.log")
+        self.journal = Journal(os.path.join(get_profile(), "cleaner.journal"), settings[log_max_size] * 1024 * 1024)
 
     def prepend(self, data):
         """
-        Prepend the given data to the current log file. Will create a new log file if none exists.
+        Add the given data to the log as a new run. Existing runs are never rewritten.
 
         :type data: list
-        :param data: A list of strings to prepend to the log file.
+        :param data: A list of strings to add to the log file.
         """
+        if not data:
+            debug("No data to write. Stopping.")
+            return
+
         try:
-            debug("Prepending the log file with new data.")
-            debug("Backing up current log.")
-            f = open(self.logpath, "a+")  # use append mode to make sure it is created if non-existent
-            previous_data = f.read()
-        except (IOError, OSError) as err:
-            debug("%s" % err, xbmc.LOGERROR)
+            debug("Writing new log data.")
+            self.import_legacy_log()
+            files = [line.decode("utf-8") if isinstance(line, str) else line for line in data]
+            self.journal.append({"time": time.time(), "files": files})
+            debug("New data written to log file.")
+        except (IOError, OSError, ValueError) as err:
+            debug("%s", err, level=xbmc.LOGERROR)
+
+    def import_legacy_log(self):
+        """
+        Move the contents of a log file written by an older version of this addon into the journal.
+        """
+        if os.path.exists(self.logpath) and not self.journal.count():
+            debug("Importing the existing log file.")
+            with open(self.logpath, "r") as f:
+                contents = f.read()
+            if contents.strip():
+                self.journal.append({"time": None, "text": contents.decode("utf-8", "replace")})
+            os.rename(self.logpath, self.logpath + ".old")
+
+    def format(self, record):
+        """
+        Format a single run for display.
+
+        :type record: dict
+        :param record: The journal record of the run.
+        :rtype: str
+        :return: The run's date and the files that were cleaned during it.
+        """
+        if record.get("time") is None:
+            return record.get("text", u"").encode("utf-8")
+        lines = ["[B][%s][/B]\n" % time.strftime(self.DATE_FORMAT, time.localtime(record["time"]))]
+        lines.extend(" - %s\n" % f.encode("utf-8") for f in record.get("files", []))
+        lines.append("\n")
+        return "".join(lines)
+
+    def page(self, start=0, runs=10, query=None):
+        """
+        Retrieve a single page of runs from the log, newest runs first.
+
+        Only the runs that are displayed (or searched) are read from disk, using the offsets stored in the journal
+        index.
+
+        :type start: int
+        :param start: (Optional) The position of the run to start at, where 0 is the newest run. Defaults to 0.
+        :type runs: int
+        :param runs: (Optional) The maximum number of runs on a page. Defaults to 10.
+        :type query: str
+        :param query: (Optional) Only include runs in which a cleaned file contains this text, ignoring case.
+        :rtype: (str, int)
+        :return: The contents of the page, and the position to start the next page at (None if this is the last page).
+        """
+        if query:
+            query = (query.decode("utf-8") if isinstance(query, str) else query).lower()
+        try:
+            self.import_legacy_log()
+            pages, next_start = [], None
+            for position, record in self.journal.scan(start):
+                if len(pages) == runs:
+                    next_start = position
+                    break
+                if not query or self.matches(record, query):
+                    pages.append(self.format(record))
+            return "".join(pages), next_start
+        except (IOError, OSError, ValueError) as err:
+            debug("%s", err, level=xbmc.LOGERROR)
+            return "", None
+
+    @staticmethod
+    def matches(record, query):
+        """
+        Check whether a run contains a search query.
+
+        :type record: dict
+        :param record: The journal record of the run.
+        :type query: unicode
+        :param query: The lower case text to search for.
+        :rtype: bool
+        :return: True if any of the cleaned files contains the query, False otherwise.
+        """
+        if record.get("time") is None:
+            return query in record.get("text", u"").lower()
+        return any(query in f.lower() for f in record.get("files", []))
+
+    @staticmethod
+    def shorten(record, lines):
+        """
+        Cut a run down to its first lines, the way the top of the log file used to be kept.
+
+        :type record: dict
+        :param record: The journal record of the run.
+        :type lines: int
+        :param lines: The number of lines of the run to keep, including its date and the blank line after it.
+        :rtype: dict
+        :return: A copy of the record with only the files (or text) that fit.
+        """
+        record = dict(record)
+        if record.get("time") is None:
+            record["text"] = u"".join(record.get("text", u"").splitlines(True)[:lines])
         else:
-            f.close()
-
-            try:
-                debug("Writing new log data.")
-                f = open(self.logpath, "w")
-                if data:
-                    f.write("[B][%s][/B]\n" % time.strftime("%d/%m/%Y  -  %H:%M:%S"))
-                    for line in data:
-                        if isinstance(line, unicode):
-                            line = line.encode("utf-8")
-                        f.write(" - %s\n" % line)
-                    f.write("\n")
-                    debug("New data written to log file.")
-                else:
-                    debug("No data to write. Stopping.")
-
-                debug("Appending previous log file contents.")
-                f.writelines(previous_data)
-            except (IOError, OSError) as err:
-                debug("%s" % err, xbmc.LOGERROR)
-            else:
-                f.close()
+            record["files"] = record.get("files", [])[:max(0, lines - 2)]
+        return record
 
     def trim(self, lines_to_keep=25):
         """
-        Trim the log file to contain a maximum number of lines.
+        Trim the log file to contain a maximum number of lines. The oldest run that is kept is cut short if it does not
+        fit entirely, and the newest run is always kept, even if only its date fits.
 
         :type lines_to_keep: int
         :param lines_to_keep: The number of lines to preserve. Any lines beyond this number get erased. Defaults to 25.
@@ -79,26 +187,23 @@ class Log(object):
         """
         try:
             debug("Trimming log file contents.")
-            f = open(self.logpath, "r")
-            debug("Saving the top %d lines." % lines_to_keep)
-            lines = []
-            for i in xrange(lines_to_keep):
-                lines.append(f.readline())
-        except (IOError, OSError) as err:
-            debug("%s" % err, xbmc.LOGERROR)
+            self.import_legacy_log()
+            debug("Saving the top %d lines.", lines_to_keep)
+            records, lines = [], 0
+            for record in self.journal.newest():
+                length = self.format(record).count("\n")
+                if lines + length > lines_to_keep:
+                    if lines < lines_to_keep or not records:
+                        records.append(self.shorten(record, max(1, lines_to_keep - lines)))
+                    break
+                lines += length
+                records.append(record)
+            debug("Removing all log contents and restoring %d runs.", len(records))
+            self.journal.rewrite(reversed(records))
+        except (IOError, OSError, ValueError) as err:
+            debug("%s", err, level=xbmc.LOGERROR)
         else:
-            f.close()
-
-            try:
-                debug("Removing all log contents.")
-                f = open(self.logpath, "w")
-                debug("Restoring saved log contents.")
-                f.writelines(lines)
-            except (IOError, OSError) as err:
-                debug("%s" % err, xbmc.LOGERROR)
-            else:
-                f.close()
-                return self.get()
+            return self.get()
 
     def clear(self):
         """
@@ -109,30 +214,41 @@ class Log(object):
         """
         try:
             debug("Clearing log file contents.")
-            f = open(self.logpath, "r+")
-            f.truncate()
+            self.import_legacy_log()
+            self.journal.clear()
         except (IOError, OSError) as err:
-            debug("%s" % err, xbmc.LOGERROR)
+            debug("%s", err, level=xbmc.LOGERROR)
         else:
-            f.close()
             return self.get()
 
     def get(self):
         """
-        Retrieve the contents of the log file. Creates a new log if none is found.
+        Retrieve the contents of the log file, newest runs first.
 
         :rtype: str
         :return: The contents of the log file.
         """
         try:
             debug("Retrieving log file contents.")
-            f = open(self.logpath, "a+")
-        except (IOError, OSError) as err:
-            debug("%s" % err, xbmc.LOGERROR)
-        else:
-            contents = f.read()
-            f.close()
-            return contents
+            self.import_legacy_log()
+            return "".join(self.format(record) for record in self.journal.newest())
+        except (IOError, OSError, ValueError) as err:
+            debug("%s", err, level=xbmc.LOGERROR)
+
+
+def get_disk_usage(path):
+    """Determine the amount of free space on a disk, as well as its size.
+
+    Results are cached per volume for a short while by the shared ``DiskSpaceMonitor``.
+
+    :type path: str
+    :param path: The path to the drive to check. This can be any path of any depth on the desired drive.
+    :rtype: (int, int)
+    :return: The number of free bytes and the total number of bytes on the disk; None if errors occur.
+    """
+    import diskspace
+
+    return diskspace.get_monitor().usage(path)
 
 
 def get_free_disk_space(path):
@@ -143,84 +259,39 @@ def get_free_disk_space(path):
     :rtype: float
     :return: The percentage of free space on the disk; 100% if errors occur.
     """
-    percentage = float(100)
-    debug("Checking for disk space on path: %r" % path)
-    if xbmcvfs.exists(path):
-        if xbmc.getCondVisibility("System.Platform.Windows"):
-            debug("We are checking disk space from a Windows file system")
-            debug("The path to check is %r" % path)
-
-            if r"://" in path:
-                debug("We are dealing with network paths")
-                debug("Extracting information from share %r" % path)
-
-                regex = "(?P<type>smb|nfs|afp)://(?:(?P<user>.+):(?P<pass>.+)@)?(?P<host>.+?)/(?P<share>.+?).*$"
-                pattern = re.compile(regex, flags=re.I | re.U)
-                match = pattern.match(path)
-                try:
-                    share = match.groupdict()
-                    debug("Protocol: %r, User: %r, Password: %r, Host: %r, Share: %r" %
-                          (share["type"], share["user"], share["pass"], share["host"], share["share"]))
-                except AttributeError as ae:
-                    debug("%r\nCould not extract required data from %r" % (ae, path), xbmc.LOGERROR)
-                    return percentage
-
-                debug("Creating UNC paths so Windows understands the shares")
-                path = os.path.normcase(r"\\" + share["host"] + os.sep + share["share"])
-                debug("UNC path: %r" % path)
-                debug("If checks fail because you need credentials, please mount the share first")
-            else:
-                debug("We are dealing with local paths")
-
-            if not isinstance(path, unicode):
-                debug("Converting path to unicode for disk space checks")
-                path = path.decode("mbcs")
-                debug("New path: %r" % path)
-
-            bytes_total = c_ulonglong(0)
-            bytes_free = c_ulonglong(0)
-            windll.kernel32.GetDiskFreeSpaceExW(c_wchar_p(path), byref(bytes_free), byref(bytes_total), None)
-
-            try:
-                percentage = float(bytes_free.value) / float(bytes_total.value) * 100
-                debug("Hard disk check results:")
-                debug("Bytes free: %s" % bytes_free.value)
-                debug("Bytes total: %s" % bytes_total.value)
-            except ZeroDivisionError:
-                notify(translate(32511), 15000, level=xbmc.LOGERROR)
-        else:
-            debug("We are checking disk space from a non-Windows file system")
-            debug("Stripping %r of all redundant stuff." % path)
-            path = os.path.normpath(path)
-            debug("The path now is " + path)
-
-            try:
-                diskstats = os.statvfs(path)
-                percentage = float(diskstats.f_bfree) / float(diskstats.f_blocks) * 100
-                debug("Hard disk check results:")
-                debug("Bytes free: %r" % diskstats.f_bfree)
-                debug("Bytes total: %r" % diskstats.f_blocks)
-            except OSError as ose:
-                # TODO: Linux cannot check remote share disk space yet
-                # notify(translate(32512), 15000, level=xbmc.LOGERROR)
-                notify(translate(32524), 15000, level=xbmc.LOGERROR)
-                debug("Error accessing %r: %r" % (path, ose))
-            except ZeroDivisionError:
-                notify(translate(32511), 15000, level=xbmc.LOGERROR)
-    else:
-        notify(translate(32513), 15000, level=xbmc.LOGERROR)
+    import diskspace
 
-    debug("Free space: %0.2f%%" % percentage)
-    return percentage
+    return diskspace.get_monitor().free_percentage(path)
 
 
-def disk_space_low():
+def disk_space_low(settings=None):
     """Check whether the disk is running low on free space.
 
+    :type settings: Snapshot
+    :param settings: (Optional) The settings snapshot to use. Defaults to the current snapshot.
     :rtype: bool
     :return: True if disk space is below threshold (set through addon settings), False otherwise.
     """
-    return get_free_disk_space(get_setting(disk_space_check_path)) <= get_setting(disk_space_threshold)
+    if settings is None:
+        settings = get_settings()
+    return get_free_disk_space(settings[disk_space_check_path]) <= settings[disk_space_threshold]
+
+
+def bytes_to_free(settings=None):
+    """Determine how much space must be freed to get the disk back above the threshold set in the addon settings.
+
+    :type settings: Snapshot
+    :param settings: (Optional) The settings snapshot to use. Defaults to the current snapshot.
+    :rtype: int
+    :return: The number of bytes to free; 0 if disk space is not low or if errors occur.
+    """
+    import diskspace
+
+    if settings is None:
+        settings = get_settings()
+    needed = diskspace.get_monitor().bytes_to_free(settings[disk_space_check_path], settings[disk_space_threshold])
+    debug("%d bytes must be freed to reach %d%% of free disk space.", needed, settings[disk_space_threshold])
+    return needed
 
 
 def translate(msg_id):
@@ -238,7 +309,7 @@ def translate(msg_id):
         return ""
 
 
-def notify(message, duration=5000, image=__icon__, level=xbmc.LOGNOTICE, sound=True):
+def notify(message, duration=5000, image=None, level=xbmc.LOGNOTICE, sound=True):
     """
     Display a Kodi notification and log the message.
 
@@ -247,28 +318,129 @@ def notify(message, duration=5000, image=__icon__, level=xbmc.LOGNOTICE, sound=T
     :type duration: int
     :param duration: the duration the notification is displayed in milliseconds (defaults to 5000)
     :type image: str
-    :param image: the path to the image to be displayed on the notification (defaults to ``icon.png``)
+    :param image: (Optional) the path to the image to be displayed on the notification (defaults to ``icon.png``)
     :type level: int
     :param level: (Optional) the log level (supported values are found at xbmc.LOG...)
     :type sound: bool
     :param sound: (Optional) Whether or not to play a sound with the notification. (defaults to ``True``)
     """
-    debug(message, level)
+    debug(message, level=level)
     if get_setting(notifications_enabled) and not (get_setting(notify_when_idle) and xbmc.Player().isPlaying()):
-        xbmcgui.Dialog().notification(__title__, message, image, duration, sound)
+        import xbmcgui
+
+        xbmcgui.Dialog().notification(__title__, message, image or get_addon_path("icon"), duration, sound)
+
+
+def configure_logging(settings=None):
+    """
+    Cache whether debug messages should be written, so each call to ``debug()`` only has to check a single flag.
+
+    Call this at the start of every cleaning run and whenever the settings change.
+
+    :type settings: Snapshot
+    :param settings: (Optional) The settings snapshot to use. Defaults to the current snapshot.
+    """
+    global _debugging
+    if settings is None:
+        settings = get_settings()
+    _debugging = bool(settings[debugging_enabled])
 
 
-def debug(message, level=xbmc.LOGNOTICE):
+def debug_enabled():
+    """
+    Check whether debug messages are currently written to the log.
+
+    :rtype: bool
+    :return: True if debugging is enabled in the addon settings, False otherwise.
+    """
+    if _debugging is None:
+        configure_logging()
+    return _debugging
+
+
+def _shorten(text, limit=MAX_MESSAGE_LENGTH):
+    if len(text) > limit:
+        return "%s... (%d more characters)" % (text[:limit], len(text) - limit)
+    return text
+
+
+def _repr_parts(value, limit):
+    """Generate the repr of a value piece by piece, so building it can stop as soon as it gets too long."""
+    if isinstance(value, dict):
+        yield "{"
+        for i, (key, item) in enumerate(value.iteritems()):
+            if i:
+                yield ", "
+            for part in _repr_parts(key, limit):
+                yield part
+            yield ": "
+            for part in _repr_parts(item, limit):
+                yield part
+        yield "}"
+    elif isinstance(value, (list, tuple)):
+        yield "[" if isinstance(value, list) else "("
+        for i, item in enumerate(value):
+            if i:
+                yield ", "
+            for part in _repr_parts(item, limit):
+                yield part
+        yield "]" if isinstance(value, list) else ",)" if len(value) == 1 else ")"
+    elif isinstance(value, basestring):
+        yield repr(value[:limit + 1])
+    else:
+        yield repr(value)
+
+
+class _ShortRepr(object):
+    """
+    Stands in for a container that is passed to ``debug()``, such as a JSON-RPC response. Its repr is cut off at
+    ``MAX_MESSAGE_LENGTH`` characters while it is built, so a huge container is never turned into a string in full.
+    """
+
+    def __init__(self, value, limit=MAX_MESSAGE_LENGTH):
+        self.value = value
+        self.limit = limit
+
+    def __repr__(self):
+        parts, length = [], 0
+        for part in _repr_parts(self.value, self.limit):
+            parts.append(part)
+            length += len(part)
+            if length > self.limit:
+                return "%s... (truncated)" % "".join(parts)[:self.limit]
+        return "".join(parts)
+
+    __str__ = __repr__
+
+
+def debug(message, *args, **kwargs):
     """
     Write a debug message to xbmc.log
 
-    :type message: str
-    :param message: the message to log
+    Formatting is deferred until the message is known to be written. Pass the format arguments separately, or pass a
+    callable that builds the message, to avoid doing any work when debugging is disabled. Long messages and arguments
+    are truncated to ``MAX_MESSAGE_LENGTH`` characters.
+
+    Example:
+        debug("Response: %r", response, level=xbmc.LOGWARNING)
+
+    :type message: str | callable
+    :param message: the message (or format string) to log, or a callable returning the message
+    :param args: (Optional) the arguments to format the message with
     :type level: int
     :param level: (Optional) the log level (supported values are found at xbmc.LOG...)
     """
-    if get_setting(debugging_enabled):
-        if isinstance(message, unicode):
-            message = message.encode("utf-8")
-        for line in message.splitlines():
-            xbmc.log(msg=__title__ + ": " + line, level=level)
+    if not debug_enabled():
+        return
+
+    level = kwargs.get("level", xbmc.LOGNOTICE)
+    if callable(message):
+        message = message()
+    if args:
+        # Cut off huge payloads before formatting them, so their repr is never built in full
+        message = message % tuple(_shorten(a) if isinstance(a, basestring) else
+                                  _ShortRepr(a) if isinstance(a, (dict, list, tuple)) else a for a in args)
+    if isinstance(message, unicode):
+        message = message.encode("utf-8")
+    for line in _shorten(message).splitlines():
+        xbmc.log(msg=__title__ + ": " + line, level=level)
@@ -0,0 +1,466 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import bisect
+import os
+import threading
+from collections import Counter
+
+import xbmcvfs
+from governor import IoGovernor
+from utils import debug
+
+
+def encode(path):
+    """
+    Encode a path to a UTF-8 byte string, so the same path always yields the same cache key.
+
+    :type path: str | unicode
+    :param path: The path to encode.
+    :rtype: str
+    :return: The UTF-8 encoded path.
+    """
+    if isinstance(path, unicode):
+        return path.encode("utf-8")
+    return path
+
+
+def folder_key(path):
+    """
+    Normalize a folder path for use as a cache key, ignoring any trailing path separators.
+
+    :type path: str
+    :param path: The folder path.
+    :rtype: str
+    :return: The normalized folder path.
+    """
+    path = encode(path)
+    stripped = path.rstrip("/\\")
+    return stripped if stripped and not stripped.endswith(":") else path
+
+
+def split(path):
+    """
+    Split a file path into the cache key of its folder and its base name.
+
+    :type path: str
+    :param path: The file path.
+    :rtype: (str, str)
+    :return: The normalized folder path and the name of the file.
+    """
+    folder, name = os.path.split(folder_key(path))
+    return folder_key(folder), name
+
+
+class ListingCache(object):
+    """
+    The ListingCache keeps the contents of every folder listed during a cleaning run.
+
+    Instead of being discarded when a folder changes, cached listings are updated in place for every file or folder
+    that is added or removed through the FileSystem, so a folder is listed at most once per run. The names in every
+    listing are kept sorted, so finding the files that start with a given prefix only takes a binary search, no matter
+    how many files the folder contains.
+    """
+
+    def __init__(self):
+        self.listings = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Retrieve the cached contents of a folder.
+
+        :type path: str
+        :param path: The folder path.
+        :rtype: (list, list) | None
+        :return: Copies of the cached subfolder and file names, or None if the folder is not cached.
+        """
+        with self.lock:
+            listing = self.listings.get(folder_key(path))
+            if listing is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return list(listing[0]), list(listing[1])
+
+    def put(self, path, subfolders, files):
+        """
+        Store the contents of a folder.
+
+        :type path: str
+        :param path: The folder path.
+        :type subfolders: list
+        :param subfolders: The names of the subfolders in the folder.
+        :type files: list
+        :param files: The names of the files in the folder.
+        :rtype: (list, list)
+        :return: Copies of the stored subfolder and file names.
+        """
+        listing = (sorted(encode(d) for d in subfolders), sorted(encode(f) for f in files))
+        with self.lock:
+            self.listings[folder_key(path)] = listing
+        return list(listing[0]), list(listing[1])
+
+    def prefixed(self, path, prefix):
+        """
+        Find the files in a cached folder whose names start with a prefix.
+
+        :type path: str
+        :param path: The folder path.
+        :type prefix: str
+        :param prefix: The start of the file names.
+        :rtype: list | None
+        :return: The names of the matching files in sorted order, or None if the folder is not cached.
+        """
+        prefix = encode(prefix)
+        with self.lock:
+            listing = self.listings.get(folder_key(path))
+            if listing is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            files = listing[1]
+            start = bisect.bisect_left(files, prefix)
+            stop = start
+            while stop < len(files) and files[stop].startswith(prefix):
+                stop += 1
+            return files[start:stop]
+
+    def add(self, path, is_folder=False):
+        """Add a file or folder to the cached listing of its parent, if that listing is cached."""
+        folder, name = split(path)
+        index = 0 if is_folder else 1
+        with self.lock:
+            listing = self.listings.get(folder)
+            if listing is not None:
+                names = listing[index]
+                position = bisect.bisect_left(names, name)
+                if position == len(names) or names[position] != name:
+                    names.insert(position, name)
+
+    def remove(self, path, is_folder=False):
+        """Remove a file or folder from the cached listing of its parent, if that listing is cached."""
+        folder, name = split(path)
+        index = 0 if is_folder else 1
+        with self.lock:
+            listing = self.listings.get(folder)
+            if listing is not None:
+                names = listing[index]
+                position = bisect.bisect_left(names, name)
+                if position < len(names) and names[position] == name:
+                    del names[position]
+            if is_folder:
+                self.listings.pop(folder_key(path), None)
+
+    def contains(self, path):
+        """
+        Look a file or folder up in the cached listing of its parent.
+
+        :type path: str
+        :param path: The path to look up.
+        :rtype: (bool, bool) | None
+        :return: Whether the path exists and whether it is a folder, or None if the parent folder is not cached.
+        """
+        folder, name = split(path)
+        with self.lock:
+            listing = self.listings.get(folder)
+            if listing is None:
+                return None
+            for is_folder, names in ((True, listing[0]), (False, listing[1])):
+                position = bisect.bisect_left(names, name)
+                if position < len(names) and names[position] == name:
+                    return True, is_folder
+            return False, False
+
+    def invalidate(self, path):
+        """Discard the cached listing of a folder, so it is listed again on next use."""
+        with self.lock:
+            self.listings.pop(folder_key(path), None)
+
+
+class StatCache(object):
+    """
+    The StatCache remembers whether paths exist, how large they are and whether they are folders during a cleaning run.
+
+    Like cached listings, the cached state of a path is updated in place whenever it is deleted, renamed, copied or
+    created through the FileSystem, so every path only has to be checked once per run.
+    """
+
+    EXISTS, SIZE, IS_FOLDER = range(3)
+
+    def __init__(self):
+        self.stats = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, field):
+        """
+        Retrieve a cached property of a path.
+
+        :type path: str
+        :param path: The path.
+        :type field: int
+        :param field: The property to retrieve (one of EXISTS, SIZE or IS_FOLDER).
+        :rtype: bool | int | None
+        :return: The cached property, or None if it is not known.
+        """
+        with self.lock:
+            stat = self.stats.get(folder_key(path))
+            value = stat[field] if stat is not None else None
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, path, exists=None, size=None, is_folder=None):
+        """Store the known properties of a path. Properties that are None keep their cached value."""
+        with self.lock:
+            stat = self.stats.setdefault(folder_key(path), [None, None, None])
+            for field, value in ((self.EXISTS, exists), (self.SIZE, size), (self.IS_FOLDER, is_folder)):
+                if value is not None:
+                    stat[field] = value
+
+    def removed(self, path):
+        """Record that a path no longer exists."""
+        with self.lock:
+            self.stats[folder_key(path)] = [False, None, None]
+
+    def moved(self, source, destination):
+        """Record that a file was renamed, taking its properties along."""
+        with self.lock:
+            stat = self.stats.pop(folder_key(source), None) or [None, None, None]
+            stat[self.EXISTS] = True
+            self.stats[folder_key(destination)] = stat
+            self.stats[folder_key(source)] = [False, None, None]
+
+    def invalidate(self, path):
+        """Forget everything about a path, so it is checked again on next use."""
+        with self.lock:
+            self.stats.pop(folder_key(path), None)
+
+
+class FileSystem(object):
+    """
+    The FileSystem class wraps the ``xbmcvfs`` operations used while cleaning, keeping track of their effects.
+
+    Directory listings, as well as the existence, size and type of every path, are cached for the lifetime of the
+    object, so create a new FileSystem for every cleaning run. Whether a path exists is answered from the listing of
+    its folder if that folder was listed before. Every call that reaches ``xbmcvfs`` is counted, as on network shares
+    each of them is a round-trip. Right before every such call, the run is given a chance to stop or pause, and the
+    call is slowed down if needed to keep playback from buffering.
+
+    *Example*
+      ``subfolders, files = FileSystem().listdir(path)``
+    """
+
+    def __init__(self, checkpoint=None, governor=None):
+        """
+        :type checkpoint: callable
+        :param checkpoint: (Optional) A function that is called before every call to ``xbmcvfs``, which may raise an
+            exception to stop the run.
+        :type governor: IoGovernor
+        :param governor: (Optional) The governor that limits the rate of calls to ``xbmcvfs``. Defaults to no limits.
+        """
+        self.listings = ListingCache()
+        self.stats = StatCache()
+        self.calls = Counter()
+        self.checkpoint = checkpoint or (lambda: None)
+        self.governor = governor or IoGovernor()
+        self.lock = threading.Lock()
+
+    def count(self, operation):
+        """Count a call to ``xbmcvfs``, after passing the cancellation point and the governor that precede it."""
+        self.checkpoint()
+        self.governor.operation()
+        with self.lock:
+            self.calls[operation] += 1
+
+    def listdir(self, path):
+        """
+        List the contents of a folder, using the cached listing if available.
+
+        :type path: str
+        :param path: The folder to list.
+        :rtype: (list, list)
+        :return: The names of the subfolders and files in the folder.
+        """
+        listing = self.listings.get(path)
+        if listing is None:
+            self.count("listdir")
+            subfolders, files = xbmcvfs.listdir(path)
+            listing = self.listings.put(path, subfolders, files)
+            self.stats.put(path, exists=True, is_folder=True)
+        return listing
+
+    def exists(self, path):
+        """
+        Check whether a file or folder exists, using the cached state of the path or the listing of its folder.
+
+        :type path: str
+        :param path: The path to check.
+        :rtype: bool
+        :return: True if the path exists, False otherwise.
+        """
+        exists = self.stats.get(path, StatCache.EXISTS)
+        if exists is None:
+            listed = self.listings.contains(path)
+            if listed is not None:
+                exists, is_folder = listed
+                self.stats.put(path, exists=exists, is_folder=is_folder if exists else None)
+            else:
+                self.count("exists")
+                exists = bool(xbmcvfs.exists(path))
+                self.stats.put(path, exists=exists)
+        return exists
+
+    def isdir(self, path):
+        """
+        Check whether a path is an existing folder.
+
+        :type path: str
+        :param path: The path to check.
+        :rtype: bool
+        :return: True if the path is a folder, False if it is a file or does not exist.
+        """
+        is_folder = self.stats.get(path, StatCache.IS_FOLDER)
+        if is_folder is None:
+            listed = self.listings.contains(path)
+            if listed is not None:
+                is_folder = listed[0] and listed[1]
+            else:
+                # Kodi only reports folders as existing when their path ends with a separator
+                self.count("exists")
+                is_folder = bool(xbmcvfs.exists(os.path.join(folder_key(path), "")))
+            self.stats.put(path, is_folder=is_folder, exists=True if is_folder else None)
+        return is_folder
+
+    def prefixed(self, path, prefix):
+        """
+        Find the files in a folder whose names start with a prefix, listing the folder only if it is not cached.
+
+        :type path: str
+        :param path: The folder to search.
+        :type prefix: str
+        :param prefix: The start of the file names.
+        :rtype: list
+        :return: The names of the matching files.
+        """
+        names = self.listings.prefixed(path, prefix)
+        if names is None:
+            self.listdir(path)
+            names = self.listings.prefixed(path, prefix) or []
+        return names
+
+    def size(self, path):
+        """
+        Determine the size of a file with a single stat call, rather than opening it. Only files that appear to be
+        empty are opened, as not every virtual file system supports stat calls.
+
+        :type path: str
+        :param path: The file to inspect.
+        :rtype: int
+        :return: The size of the file in bytes, or 0 if it cannot be opened.
+        """
+        size = self.stats.get(path, StatCache.SIZE)
+        if size is None:
+            self.count("size")
+            size = xbmcvfs.Stat(path).st_size()
+            if not size:
+                self.count("size")
+                f = xbmcvfs.File(path)
+                try:
+                    size = f.size()
+                finally:
+                    f.close()
+            self.stats.put(path, size=size)
+        return size
+
+    def sizes(self, paths):
+        """
+        Determine the sizes of a number of files at once.
+
+        :type paths: list
+        :param paths: The files to inspect.
+        :rtype: dict
+        :return: The size of every file in bytes, keyed by path.
+        """
+        return dict((path, self.size(path)) for path in set(paths))
+
+    def delete(self, path):
+        self.count("delete")
+        success = bool(xbmcvfs.delete(path))
+        if success:
+            self.listings.remove(path)
+            self.stats.removed(path)
+        else:
+            self.listings.invalidate(os.path.dirname(folder_key(path)))
+            self.stats.invalidate(path)
+        return success
+
+    def rename(self, source, destination):
+        self.count("rename")
+        success = bool(xbmcvfs.rename(source, destination))
+        if success:
+            self.listings.remove(source)
+            self.listings.add(destination)
+            self.stats.moved(source, destination)
+        return success
+
+    def copy(self, source, destination):
+        self.count("copy")
+        self.governor.transfer(self.stats.get(source, StatCache.SIZE) or 0)
+        success = bool(xbmcvfs.copy(source, destination))
+        if success:
+            self.listings.add(destination)
+            self.stats.put(destination, exists=True, size=self.stats.get(source, StatCache.SIZE), is_folder=False)
+        else:
+            self.listings.invalidate(os.path.dirname(folder_key(destination)))
+            self.stats.invalidate(destination)
+        return success
+
+    def mkdirs(self, path):
+        self.count("mkdirs")
+        created = self.stats.get(path, StatCache.EXISTS) is False
+        success = bool(xbmcvfs.mkdirs(path))
+        if success:
+            if created and self.listings.get(path) is None:
+                # A folder that did not exist before is empty, so it does not have to be listed
+                self.listings.put(path, [], [])
+            # Any of the parent folders may have been created as well
+            folder = folder_key(path)
+            while os.path.dirname(folder) != folder:
+                self.listings.add(folder, is_folder=True)
+                self.stats.put(folder, exists=True, is_folder=True)
+                folder = os.path.dirname(folder)
+        return success
+
+    def rmdir(self, path):
+        self.count("rmdir")
+        success = bool(xbmcvfs.rmdir(path))
+        if success:
+            self.listings.remove(path, is_folder=True)
+            self.stats.removed(path)
+        return success
+
+    def forget(self, path):
+        """Forget the cached state of a file that was changed without going through the FileSystem."""
+        self.stats.invalidate(path)
+
+    def report(self, videos=0):
+        """
+        Write the cache statistics and the number of calls to ``xbmcvfs`` to the debug log.
+
+        :type videos: int
+        :param videos: (Optional) The number of videos cleaned, to report the number of calls per video.
+        """
+        debug("Directory listings: %d cache hits, %d cache misses.", self.listings.hits, self.listings.misses)
+        debug("File states: %d cache hits, %d cache misses.", self.stats.hits, self.stats.misses)
+        total = sum(self.calls.values())
+        debug(lambda: "File system calls: %d (%s)." % (total, ", ".join("%s: %d" % item
+                                                                        for item in sorted(self.calls.items()))))
+        if videos:
+            debug("File system calls per cleaned video: %.1f", float(total) / videos)
@@ -20,33 +20,81 @@ class LogViewerDialog(xbmcgui.WindowXMLDialog):
 
     It is used to display the contents of a log file, and as such uses a fullscreen window to show as much text as
     possible. It also contains two buttons for trimming and clearing the contents of the log file.
+
+    The log is shown one page of runs at a time, so opening the viewer only reads the most recent runs. The search
+    button filters the runs to those in which a cleaned file matches the text entered.
     """
     CAPTIONID = 201
     TEXTBOXID = 202
     TRIMBUTTONID = 301
     CLEARBUTTONID = 302
     CLOSEBUTTONID = 303
+    PREVIOUSBUTTONID = 304
+    NEXTBUTTONID = 305
+    SEARCHBUTTONID = 306
+    RUNS_PER_PAGE = 10
 
     def __init__(self, xml_filename, script_path, default_skin="Default", default_res="720p", *args, **kwargs):
         self.log = utils.Log()
         self.caption = utils.translate(32603)
+        self.query = None
+        self.pages = [0]  # The position of the first run on each page visited so far
+        self.next_start = None
         xbmcgui.WindowXMLDialog.__init__(self)
 
     def onInit(self):
-        self.getControl(self.CAPTIONID).setLabel(self.caption)
-        self.getControl(self.TEXTBOXID).setText(self.log.get())
+        self.show_page(0)
+
+    def show_page(self, start):
+        """
+        Display a page of runs from the log.
+
+        :type start: int
+        :param start: The position of the first run to display, where 0 is the newest run.
+        :rtype: bool
+        :return: True if the page contains any runs, False otherwise.
+        """
+        text, next_start = self.log.page(start, self.RUNS_PER_PAGE, self.query)
+        if not text and start > 0:
+            return False
+
+        self.next_start = next_start
+        caption = "%s - %s %d" % (self.caption, utils.translate(32616), len(self.pages))
+        if self.query:
+            caption = "%s - %s: %s" % (caption, utils.translate(32619), self.query)
+        self.getControl(self.CAPTIONID).setLabel(caption)
+        self.getControl(self.TEXTBOXID).setText(text)
+        return True
+
+    def restart(self):
+        self.pages = [0]
+        self.show_page(0)
 
     def onClick(self, control_id, *args):
         if control_id == self.TRIMBUTTONID:
             if xbmcgui.Dialog().yesno(utils.translate(32604), utils.translate(32605), utils.translate(32607)):
-                self.getControl(self.TEXTBOXID).setText(self.log.trim())
+                self.log.trim()
+                self.restart()
         elif control_id == self.CLEARBUTTONID:
             if xbmcgui.Dialog().yesno(utils.translate(32604), utils.translate(32606), utils.translate(32607)):
-                self.getControl(self.TEXTBOXID).setText(self.log.clear())
+                self.log.clear()
+                self.restart()
+        elif control_id == self.NEXTBUTTONID:
+            if self.next_start is not None:
+                self.pages.append(self.next_start)
+                if not self.show_page(self.next_start):
+                    self.pages.pop()
+        elif control_id == self.PREVIOUSBUTTONID:
+            if len(self.pages) > 1:
+                self.pages.pop()
+                self.show_page(self.pages[-1])
+        elif control_id == self.SEARCHBUTTONID:
+            self.query = xbmcgui.Dialog().input(utils.translate(32619), self.query or "") or None
+            self.restart()
         elif control_id == self.CLOSEBUTTONID:
             self.close()
         else:
-            utils.debug("Unknown button pressed", xbmc.LOGERROR)
+            utils.debug("Unknown button pressed", level=xbmc.LOGERROR)
 
 
 if __name__ == "__main__":
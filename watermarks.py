@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import time
+
+LASTPLAYED_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_lastplayed(lastplayed):
+    """
+    Convert a date as reported by Kodi to a timestamp.
+
+    :type lastplayed: str
+    :param lastplayed: The date and time, formatted as ``LASTPLAYED_FORMAT``.
+    :rtype: float
+    :return: The number of seconds since the epoch, or None if the date could not be parsed.
+    """
+    try:
+        return time.mktime(time.strptime(lastplayed, LASTPLAYED_FORMAT))
+    except (TypeError, ValueError):
+        return None
+
+
+def next_day(now):
+    """
+    Determine when the next day starts, in local time.
+
+    :type now: float
+    :param now: The current time.
+    :rtype: float
+    :return: The timestamp of midnight after the current time.
+    """
+    tomorrow = time.localtime(now + 86400)
+    return time.mktime((tomorrow.tm_year, tomorrow.tm_mon, tomorrow.tm_mday, 0, 0, 0, 0, 0, -1))
+
+
+class Watermarks(object):
+    """
+    The Watermarks class remembers, per video type, how far the library has been scanned.
+
+    The watermark is the most recent ``lastplayed`` date seen during a scan, so the next scan only needs to ask Kodi for
+    videos that were played after it. Videos that were watched but have not expired yet are kept in a queue along with
+    the time they are due, so they are picked up on time without scanning the library again. Videos stay in the queue
+    until they are cleaned, so videos that were skipped or could not be cleaned are tried again, even though the
+    watermark has passed them. Every so often the watermarks are ignored and the library is scanned in full, to catch
+    anything that changed in other ways. The queue is rebuilt from scratch by such a scan.
+
+    The state is stored as JSON in the addon profile.
+
+    *Example*
+      ``since = Watermarks(path).since(Cleaner.MOVIES)``
+    """
+    FULL_SCAN_INTERVAL = 7 * 24 * 60 * 60  # One week
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        try:
+            with open(self.path, "r") as f:
+                self.state = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def _get(self, video_type):
+        return self.state.setdefault(video_type, {"lastplayed": None, "full_scan": 0, "due": {}})
+
+    def since(self, video_type, now=None):
+        """
+        Get the watermark of a video type.
+
+        :type video_type: str
+        :param video_type: The type of videos.
+        :type now: float
+        :param now: (Optional) The current time. Defaults to the system time.
+        :rtype: str
+        :return: The most recent ``lastplayed`` date seen, or None if the library should be scanned in full.
+        """
+        state = self._get(video_type)
+        if (now or time.time()) - state["full_scan"] > self.FULL_SCAN_INTERVAL:
+            return None
+        return state["lastplayed"]
+
+    def advance(self, video_type, lastplayed, full_scan=False, now=None):
+        """
+        Move the watermark of a video type forward.
+
+        :type video_type: str
+        :param video_type: The type of videos.
+        :type lastplayed: str
+        :param lastplayed: The most recent ``lastplayed`` date seen during the scan, or None if no videos were found.
+        :type full_scan: bool
+        :param full_scan: (Optional) Whether the entire library was scanned. Defaults to False.
+        :type now: float
+        :param now: (Optional) The current time. Defaults to the system time.
+        """
+        state = self._get(video_type)
+        if lastplayed and (not state["lastplayed"] or lastplayed > state["lastplayed"]):
+            state["lastplayed"] = lastplayed
+        if full_scan:
+            state["full_scan"] = now or time.time()
+
+    def schedule(self, video_type, filename, title, due):
+        """
+        Queue a video that has not expired yet.
+
+        :type video_type: str
+        :param video_type: The type of the video.
+        :type filename: str
+        :param filename: The file of the video.
+        :type title: str
+        :param title: The title of the video.
+        :type due: float
+        :param due: The time at which the video expires.
+        """
+        self._get(video_type)["due"][filename] = [due, title]
+
+    def due(self, video_type, now=None):
+        """
+        Find the queued videos that have expired by now. They stay queued until they are cleaned.
+
+        :type video_type: str
+        :param video_type: The type of videos.
+        :type now: float
+        :param now: (Optional) The current time. Defaults to the system time.
+        :rtype: list
+        :return: The files of the videos that are due.
+        """
+        now = now or time.time()
+        return [f for f, (when, _) in self._get(video_type)["due"].items() if when <= now]
+
+    def postpone(self, video_type, files, until):
+        """
+        Check queued videos again later.
+
+        :type video_type: str
+        :param video_type: The type of the videos.
+        :type files: list
+        :param files: The files of the videos.
+        :type until: float
+        :param until: The time at which the videos are due again.
+        """
+        due = self._get(video_type)["due"]
+        for f in files:
+            if f in due:
+                due[f][0] = until
+
+    def done(self, video_type, files):
+        """
+        Remove videos that were cleaned from the queue.
+
+        :type video_type: str
+        :param video_type: The type of the videos.
+        :type files: list
+        :param files: The files of the videos.
+        """
+        due = self._get(video_type)["due"]
+        for f in files:
+            due.pop(f, None)
+
+    def clear(self, video_type):
+        """Empty the queue of a video type, before the library is scanned in full."""
+        self._get(video_type)["due"] = {}
+
+    def pending(self, video_type):
+        """The number of videos of a type that are queued but not due yet."""
+        return len(self._get(video_type)["due"])
+
+    def save(self):
+        """Write the watermarks to disk, replacing the previous state in a single step."""
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        temp = self.path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(self.state, f)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temp, self.path)